@@ -0,0 +1,297 @@
+"""
+Benchmarks of the graph algorithms in main.py on synthetic data.
+Usage: python benchmark.py [quest_cycles] [path_cover] [dialog_graph]
+"""
+import argparse
+import itertools
+import random
+import time
+
+import networkx as nx
+
+from main import (
+    DialogGraph, break_cycles, dag_path_cover, decompose_flow
+)
+
+
+def break_cycles_by_enumeration(graph: nx.DiGraph):
+    """
+    The former cycle breaking of `Database.connect_quests`, which enumerates
+    all the simple cycles after every removal. Kept as the reference.
+    """
+    removed_edges = []
+    for component in list(nx.weakly_connected_components(graph)):
+        while True:
+            cycles = []
+            for cycle in nx.simple_cycles(graph.subgraph(component)):
+                index_min = min(range(len(cycle)), key=lambda x: cycle[x])
+                cycles.append(cycle[index_min:] + cycle[:index_min])
+            if len(cycles) == 0:
+                break
+            nodes_in_cycle = set(sum(cycles, []))
+            victim = sorted(cycles)[0][0]
+            prev_victim = min(
+                graph.predecessors(victim),
+                key=lambda node: (node not in nodes_in_cycle, node)
+            )
+            graph.remove_edge(prev_victim, victim)
+            removed_edges.append((prev_victim, victim))
+    return removed_edges
+
+
+def random_quest_graph(num_quests, num_edges, num_self_loops, seed):
+    """
+    A random graph of suggested next quests. Quest ids are sparse like in the
+    game data.
+    """
+    rng = random.Random(seed)
+    quest_ids = rng.sample(range(1000, 100000), num_quests)
+    graph = nx.DiGraph()
+    graph.add_nodes_from(quest_ids)
+    while graph.number_of_edges() < num_edges:
+        u, v = rng.sample(quest_ids, 2)
+        graph.add_edge(u, v)
+    for u in rng.sample(quest_ids, num_self_loops):
+        graph.add_edge(u, u)
+    return graph
+
+
+def timed(func, graph):
+    graph = graph.copy()
+    start = time.perf_counter()
+    removed_edges = func(graph)
+    return time.perf_counter() - start, removed_edges, graph
+
+
+def bench_quest_cycles(args):
+    # (number of quests, number of edges). The reference is only run on the
+    # graphs small enough for enumerating the cycles.
+    cases = [
+        (10, 20, True),
+        (15, 35, True),
+        (20, 50, True),
+        (200, 600, False),
+        (1000, 4000, False),
+        (2000, 8000, False),
+    ]
+    print(f'{"quests":>8} {"edges":>8} {"removed":>8} '
+          f'{"sccs (s)":>10} {"enumeration (s)":>16}')
+    for num_quests, num_edges, run_reference in cases:
+        for seed in range(args.seeds):
+            graph = random_quest_graph(
+                num_quests, num_edges, num_quests // 10, seed
+            )
+            elapsed, removed_edges, result = timed(break_cycles, graph)
+            assert nx.is_directed_acyclic_graph(result)
+            reference = "-"
+            if run_reference:
+                elapsed_ref, removed_edges_ref, _ = timed(
+                    break_cycles_by_enumeration, graph
+                )
+                # The removal order may differ among the weakly connected
+                # components, but the removed edges must be the same.
+                assert sorted(removed_edges) == sorted(removed_edges_ref), \
+                    (num_quests, num_edges, seed)
+                reference = f'{elapsed_ref:.4f}'
+            print(f'{num_quests:>8} {graph.number_of_edges():>8} '
+                  f'{len(removed_edges):>8} {elapsed:>10.4f} {reference:>16}')
+
+
+def path_cover_by_flow(graph: nx.DiGraph, start_set, end_set):
+    """
+    The minimum-cost flow of `Database._find_covering_traces`, which is kept
+    there for the cyclic graphs. Kept as the reference.
+    """
+    g = nx.DiGraph()
+    for node in graph.nodes:
+        g.add_node(node, demand=1)
+        g.add_node(-node, demand=-1)
+        g.add_edge(node, -node, weight=1)
+    for u, v in graph.edges:
+        g.add_edge(-u, v)
+    for node in start_set:
+        g.add_edge("start", node)
+    for node in end_set:
+        g.add_edge(-node, "end")
+    g.add_edge("end", "start", weight=len(graph.nodes))
+    return decompose_flow(nx.min_cost_flow(g))[0]
+
+
+def random_dialog_dag(num_dialogs, seed):
+    """
+    A random acyclic dialog graph. Each dialog is followed by up to three
+    options among the next few dialogs, like the options of a talk.
+    """
+    rng = random.Random(seed)
+    graph = nx.DiGraph()
+    graph.add_nodes_from(range(1, num_dialogs + 1))
+    for u in range(1, num_dialogs):
+        for _ in range(rng.choice([0, 1, 1, 1, 2, 3])):
+            graph.add_edge(u, rng.randint(u + 1, min(u + 10, num_dialogs)))
+    start_set = {node for node in graph.nodes if graph.in_degree(node) == 0}
+    end_set = {node for node in graph.nodes if graph.out_degree(node) == 0}
+    return graph, start_set, end_set
+
+
+def random_chain_dag(num_dialogs, seed):
+    """
+    A random acyclic dialog graph made of chains of dialogs, like the talks
+    without options, plus a few jumps from one chain into the middle of a
+    later one. It is covered by its chains without revisits.
+    """
+    rng = random.Random(seed)
+    graph = nx.DiGraph()
+    graph.add_nodes_from(range(1, num_dialogs + 1))
+    heads, tails = set(), set()
+    u = 1
+    while u <= num_dialogs:
+        length = min(rng.randint(2, 15), num_dialogs - u + 1)
+        heads.add(u)
+        tails.add(u + length - 1)
+        for v in range(u + 1, u + length):
+            graph.add_edge(v - 1, v)
+        u += length
+    for _ in range(num_dialogs // 20):
+        u = rng.randint(1, num_dialogs)
+        v = rng.randint(u + 1, min(u + 30, num_dialogs + 1))
+        if u not in tails and v <= num_dialogs and v not in heads:
+            graph.add_edge(u, v)
+    start_set = {node for node in graph.nodes if graph.in_degree(node) == 0}
+    end_set = {node for node in graph.nodes if graph.out_degree(node) == 0}
+    return graph, start_set, end_set
+
+
+def bench_path_cover(args):
+    # The graphs with options mostly need revisits, where the matching gives
+    # up and `Database._find_covering_traces` falls back to the flow. The
+    # chains are covered by the matching alone.
+    cases = [
+        ("options", random_dialog_dag, [20, 100, 500, 2000]),
+        ("chains", random_chain_dag, [20, 100, 500, 2000]),
+    ]
+    print(f'{"graphs":>8} {"dialogs":>8} {"edges":>8} {"traces":>8} '
+          f'{"lines":>8} {"fallback":>9} {"matching (s)":>13} '
+          f'{"flow (s)":>10}')
+    for name, random_dag, sizes in cases:
+        for num_dialogs, seed in itertools.product(sizes, range(args.seeds)):
+            graph, start_set, end_set = random_dag(num_dialogs, seed)
+            start = time.perf_counter()
+            traces = dag_path_cover(graph, start_set, end_set)
+            fallback = traces is None
+            if fallback:
+                traces = path_cover_by_flow(graph, start_set, end_set)
+            elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            traces_ref = path_cover_by_flow(graph, start_set, end_set)
+            elapsed_ref = time.perf_counter() - start
+            num_lines = sum(len(trace) for trace in traces)
+            # Both the number of traces and the number of lines, i.e. the
+            # cost of the flow, must be minimal.
+            assert len(traces) == len(traces_ref), (num_dialogs, seed)
+            assert num_lines == sum(len(trace) for trace in traces_ref), \
+                (num_dialogs, seed)
+            print(f'{name:>8} {num_dialogs:>8} {graph.number_of_edges():>8} '
+                  f'{len(traces):>8} {num_lines:>8} {str(fallback):>9} '
+                  f'{elapsed:>13.4f} {elapsed_ref:>10.4f}')
+
+
+def random_dialog_edges(num_dialogs, seed):
+    """
+    The edges of random dialog graphs with loops, as in the NPC chatter.
+    """
+    rng = random.Random(seed)
+    edges = []
+    for u in range(1, num_dialogs):
+        for _ in range(rng.choice([0, 1, 1, 1, 2, 3])):
+            v = rng.randint(max(1, u - 5), min(u + 10, num_dialogs))
+            edges.append((u, v))
+    return edges
+
+
+def dialog_graph_operations(
+    graph, components, sccs, is_acyclic, shortest_path
+):
+    """
+    The operations of the source pipeline on a graph. Returns the elapsed
+    seconds.
+    """
+    start = time.perf_counter()
+    for u, v in list(graph.edges)[::7]:
+        graph.remove_edge(u, v)
+        graph.add_edge(u, v)
+    sum(graph.in_degree(node) + graph.degree(node) for node in graph.nodes)
+    for node in graph.nodes:
+        list(graph.predecessors(node))
+    components(graph)
+    sccs(graph)
+    is_acyclic(graph)
+    nodes = list(graph.nodes)
+    for node in nodes[::50]:
+        shortest_path(graph, node, nodes[-1])
+    return time.perf_counter() - start
+
+
+def bench_dialog_graph(args):
+    def nx_shortest_path(graph, source, target):
+        try:
+            return nx.shortest_path(graph, source, target)
+        except nx.NetworkXNoPath:
+            return None
+
+    # (number of graphs, number of dialogs in each graph).
+    cases = [(10000, 10), (1000, 100), (10, 10000)]
+    print(f'{"graphs":>8} {"dialogs":>8} {"DialogGraph (s)":>16} '
+          f'{"networkx (s)":>13}')
+    for num_graphs, num_dialogs in cases:
+        for seed in range(args.seeds):
+            elapsed = [0.0, 0.0]
+            for i in range(num_graphs):
+                edges = random_dialog_edges(num_dialogs, seed * num_graphs + i)
+                for j, (graph_type, components, sccs, is_acyclic,
+                        shortest_path) in enumerate([
+                    (DialogGraph, DialogGraph.weakly_connected_components,
+                     DialogGraph.strongly_connected_components,
+                     DialogGraph.is_acyclic, DialogGraph.shortest_path),
+                    (nx.DiGraph, nx.weakly_connected_components,
+                     nx.strongly_connected_components,
+                     nx.is_directed_acyclic_graph, nx_shortest_path),
+                ]):
+                    start = time.perf_counter()
+                    graph = graph_type()
+                    graph.add_nodes_from(range(1, num_dialogs + 1))
+                    for u, v in edges:
+                        graph.add_edge(u, v)
+                    elapsed[j] += time.perf_counter() - start
+                    elapsed[j] += dialog_graph_operations(
+                        graph, lambda g: list(components(g)),
+                        lambda g: list(sccs(g)), is_acyclic, shortest_path
+                    )
+            print(f'{num_graphs:>8} {num_dialogs:>8} {elapsed[0]:>16.4f} '
+                  f'{elapsed[1]:>13.4f}')
+
+
+BENCHMARKS = {
+    "quest_cycles": bench_quest_cycles,
+    "path_cover": bench_path_cover,
+    "dialog_graph": bench_dialog_graph,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmarks", nargs="*", default=list(BENCHMARKS),
+        help=f"The benchmarks to run, among {', '.join(BENCHMARKS)}. "
+             "Default to all.")
+    parser.add_argument(
+        "--seeds", type=int, default=3,
+        help="Number of random graphs of each size. Default to 3.")
+    args = parser.parse_args()
+    # Checked by hand, as argparse rejects an empty list against choices
+    # when nargs="*"
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+    for name in args.benchmarks:
+        print(f'== {name}')
+        BENCHMARKS[name](args)
@@ -1,5 +1,6 @@
 from typing import List, Dict, Optional, Set, Tuple
 from dataclasses import dataclass
+import dataclasses
 import os
 import sys
 import re
@@ -7,11 +8,28 @@ import argparse
 import json
 import logging
 import bisect
+import heapq
+import array
+import contextlib
+import collections
+import shutil
+import multiprocessing
+import time
+import hashlib
+import mmap
+import struct
+import pickle
 
 import tqdm
+import numpy as np
 import pandas as pd
 import networkx as nx
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 logging.basicConfig(
     level="INFO",
@@ -140,7 +158,8 @@ PLACEHOLDERS = {
         },
     },
 }
-PLACEHOLDER_PATTERN = re.compile(r'\{([^}]*)\}')
+# A placeholder never contains "{", so a stray "{" before it is kept.
+PLACEHOLDER_PATTERN = re.compile(r'\{(?P<placeholder>[^{}]*)\}')
 RUBY_PATTERN = re.compile(r'\{RUBY#\[D\]([^}]*)\}')
 QUEST_PLACEHOLDER_PATTERNS = [
     "{QuestNpcID}",
@@ -160,6 +179,10 @@ QUOTE_MAPPINGS = {
         "』": "’",
     }
 }
+# The translation tables of QUOTE_MAPPINGS for `str.translate`.
+QUOTE_TABLES = {
+    lang: str.maketrans(mapping) for lang, mapping in QUOTE_MAPPINGS.items()
+}
 
 # Special npc ids and avatar ids.
 NPC_ID_AETHER = 1025
@@ -178,6 +201,310 @@ NAMES_IN_VOICE_TEXT = {
     "CHS": ["{NICKNAME}", "派蒙", "菲谢尔", "奥兹", "白术","长生"],
 }
 
+@dataclass
+class DecodeRecord:
+    """
+    Timing of decoding a single JSON file.
+    """
+    path: str
+    size: int  # File size in bytes.
+    backend: str  # The backend actually used to decode the file.
+    read_seconds: float
+    decode_seconds: float
+
+
+# The JSON backend used by `load_json`. "orjson" decodes the raw bytes with the
+# native decoder if it is installed, otherwise we fall back to the standard
+# library.
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+# Decoding records collected in the current process.
+DECODE_RECORDS: List[DecodeRecord] = []
+
+
+def set_json_backend(backend: str):
+    """
+    Select the backend of `load_json`. `backend` is one of "auto", "orjson" and
+    "json".
+    This is also used as the initializer of the worker processes.
+    """
+    global JSON_BACKEND
+    if backend == "auto":
+        backend = "orjson" if orjson is not None else "json"
+    if backend == "orjson" and orjson is None:
+        raise ImportError("The JSON backend orjson is not installed.")
+    JSON_BACKEND = backend
+
+
+def load_json(path, records: Optional[List[DecodeRecord]] = None):
+    """
+    Read a JSON file as bytes and decode it with the selected backend. The
+    timing is appended to `records` (default to `DECODE_RECORDS`).
+    """
+    if records is None:
+        records = DECODE_RECORDS
+    time_start = time.perf_counter()
+    with open(path, "rb") as f:
+        raw = f.read()
+    time_read = time.perf_counter()
+    backend = JSON_BACKEND
+    if backend == "orjson":
+        try:
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than the standard library, e.g. on integers
+            # exceeding 64 bits. Let the standard library decide.
+            backend = "json"
+    if backend == "json":
+        data = json.loads(raw)
+    records.append(DecodeRecord(
+        path=path,
+        size=len(raw),
+        backend=backend,
+        read_seconds=time_read - time_start,
+        decode_seconds=time.perf_counter() - time_read,
+    ))
+    return data
+
+
+def report_decode_records(filepath: Optional[str]):
+    """
+    Log a summary of the decoded files. If `filepath` is given, also write the
+    per-file records into it as a csv file, slowest first.
+    """
+    if len(DECODE_RECORDS) == 0:
+        return
+    total_size = sum(record.size for record in DECODE_RECORDS)
+    total_read = sum(record.read_seconds for record in DECODE_RECORDS)
+    total_decode = sum(record.decode_seconds for record in DECODE_RECORDS)
+    backends = sorted(set(record.backend for record in DECODE_RECORDS))
+    logging.info(
+        f'Decoded {len(DECODE_RECORDS)} JSON files '
+        f'({total_size / 2 ** 20:.1f} MiB) with {", ".join(backends)}: '
+        f'{total_read:.2f}s reading, {total_decode:.2f}s decoding.'
+    )
+    if filepath is None:
+        return
+    logging.info(f'Writing JSON decoding report to {filepath}')
+    records = sorted(DECODE_RECORDS, key=lambda record: -record.decode_seconds)
+    df = pd.DataFrame.from_dict([dataclasses.asdict(record)
+                                 for record in records])
+    df.to_csv(filepath, index=False)
+
+
+# An item of the TextMap files, which are flat JSON objects mapping hashes to
+# texts. The second group is the raw (escaped) content of the text.
+TEXT_MAP_ITEM_PATTERN = re.compile(
+    r'\s*,?\s*"(\d+)"\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)"'
+)
+TEXT_MAP_END_PATTERN = re.compile(r'\s*\}\s*')
+
+
+def stream_text_map(filepath, hashes: Set[int], chunk_size: int = 1 << 22):
+    """
+    Read a TextMap file chunk by chunk and yield the (hash, text) items whose
+    hash is in `hashes`. Texts of other hashes are skipped without being
+    decoded, so the whole TextMap is never held in memory.
+    """
+    keys = set(str(text_hash) for text_hash in hashes)
+    time_start = time.perf_counter()
+    with open(filepath, "r", encoding="utf-8") as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith("{"):
+            raise ValueError(f'{filepath} is not a TextMap file.')
+        pos = 1
+        eof = False
+        while True:
+            match = TEXT_MAP_ITEM_PATTERN.match(buffer, pos)
+            if match is not None:
+                if match.group(1) in keys:
+                    text = match.group(2)
+                    if "\\" in text:
+                        text = json.decoder.scanstring(buffer, match.start(2))[0]
+                    yield int(match.group(1)), text
+                pos = match.end()
+                continue
+            # The next item is incomplete in the buffer, or the file ends.
+            if eof:
+                if TEXT_MAP_END_PATTERN.fullmatch(buffer, pos) is None:
+                    raise ValueError(f'Unexpected content in {filepath} : '
+                                     f'{buffer[pos:pos + 100]}')
+                break
+            chunk = f.read(chunk_size)
+            eof = len(chunk) == 0
+            buffer = buffer[pos:] + chunk
+            pos = 0
+    DECODE_RECORDS.append(DecodeRecord(
+        path=filepath,
+        size=os.path.getsize(filepath),
+        backend="stream",
+        read_seconds=0.0,  # Reading is interleaved with decoding.
+        decode_seconds=time.perf_counter() - time_start,
+    ))
+
+
+class CompiledTextMap:
+    """
+    A TextMap compiled into a binary file and opened with mmap, so that it is
+    not parsed again unless the source file changes. It supports the dict
+    operations used by the exporters, i.e. `in`, `[]`, `get` and `len`.
+    File layout (native byte order):
+    - Header, see `HEADER`.
+    - Sorted text hashes as uint64, `count` items.
+    - Offsets of the texts in the blob as uint64, `count + 1` items.
+    - The UTF-8 encoded texts, concatenated.
+    """
+    MAGIC = b"GTTM"
+    VERSION = 1
+    # magic, version, source size, source mtime in ns, source digest, count,
+    # blob size
+    HEADER = struct.Struct("=4sIQq16sQQ")
+
+    def __init__(self, filepath):
+        with open(filepath, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            _, _, _, _, _, self._count, _,
+        ) = self.HEADER.unpack_from(self._mm)
+        offset = self.HEADER.size
+        self._hashes = np.frombuffer(self._mm, dtype=np.uint64,
+                                     count=self._count, offset=offset)
+        # A memoryview is much faster than numpy for scalar binary searches.
+        self._hashes_view = memoryview(self._mm)[
+            offset:offset + 8 * self._count
+        ].cast("Q")
+        offset += 8 * self._count
+        self._offsets = np.frombuffer(self._mm, dtype=np.uint64,
+                                      count=self._count + 1, offset=offset)
+        self._offsets_view = memoryview(self._mm)[
+            offset:offset + 8 * (self._count + 1)
+        ].cast("Q")
+        self._blob_start = offset + 8 * (self._count + 1)
+
+    @staticmethod
+    def _digest(filepath):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 22), b""):
+                digest.update(chunk)
+        return digest.digest()
+
+    @classmethod
+    def load(cls, source_path, cache_path) -> "CompiledTextMap":
+        """
+        Open the compiled TextMap of `source_path` at `cache_path`. The cache
+        is (re)built if it is absent or outdated.
+        The cache is considered up to date if the size and mtime of the source
+        file are unchanged, or if its content digest is unchanged.
+        """
+        stat = os.stat(source_path)
+        header = None
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                raw = f.read(cls.HEADER.size)
+            if len(raw) == cls.HEADER.size:
+                header = cls.HEADER.unpack(raw)
+                if header[0] != cls.MAGIC or header[1] != cls.VERSION:
+                    header = None
+        if (
+            header is not None and
+            header[2] == stat.st_size and
+            header[3] == stat.st_mtime_ns
+        ):
+            return cls(cache_path)
+        digest = cls._digest(source_path)
+        if header is not None and header[4] == digest:
+            # Only the mtime changed. Refresh it in the header.
+            with open(cache_path, "r+b") as f:
+                f.write(cls.HEADER.pack(
+                    cls.MAGIC, cls.VERSION, stat.st_size, stat.st_mtime_ns,
+                    digest, header[5], header[6],
+                ))
+            return cls(cache_path)
+        logging.info(f'Compiling {source_path} into {cache_path}')
+        cls.build(source_path, cache_path, stat, digest)
+        return cls(cache_path)
+
+    @classmethod
+    def build(cls, source_path, cache_path, stat, digest):
+        text_map = load_json(source_path)
+        items = sorted(
+            (int(key), value.encode("utf-8"))
+            for key, value in text_map.items()
+        )
+        del text_map
+        hashes = np.array([key for key, _ in items], dtype=np.uint64)
+        offsets = np.zeros(len(items) + 1, dtype=np.uint64)
+        np.cumsum([len(value) for _, value in items], out=offsets[1:])
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        # Write to a temporary file first so that an interrupted build never
+        # leaves a broken cache.
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temp_path, "wb") as f:
+            f.write(cls.HEADER.pack(
+                cls.MAGIC, cls.VERSION, stat.st_size, stat.st_mtime_ns,
+                digest, len(items), int(offsets[-1]),
+            ))
+            f.write(hashes.tobytes())
+            f.write(offsets.tobytes())
+            for _, value in items:
+                f.write(value)
+        os.replace(temp_path, cache_path)
+
+    def _find(self, key) -> int:
+        """
+        Returns the index of `key`, or -1 if it is absent.
+        """
+        if not isinstance(key, int) or not 0 <= key < 1 << 64:
+            return -1
+        index = bisect.bisect_left(self._hashes_view, key)
+        if index < self._count and self._hashes_view[index] == key:
+            return index
+        return -1
+
+    def _text(self, index) -> str:
+        start = self._blob_start + self._offsets_view[index]
+        end = self._blob_start + self._offsets_view[index + 1]
+        return self._mm[start:end].decode("utf-8")
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key) -> str:
+        index = self._find(key)
+        if index < 0:
+            raise KeyError(key)
+        return self._text(index)
+
+    def get(self, key, default=None):
+        index = self._find(key)
+        return self._text(index) if index >= 0 else default
+
+    def get_many(self, keys, default=None) -> list:
+        """
+        Batched version of `get`.
+        """
+        keys = list(keys)
+        valid = [
+            i for i, key in enumerate(keys)
+            if isinstance(key, int) and 0 <= key < 1 << 64
+        ]
+        result = [default] * len(keys)
+        if len(valid) == 0 or self._count == 0:
+            return result
+        queries = np.array([keys[i] for i in valid], dtype=np.uint64)
+        indices = np.searchsorted(self._hashes, queries)
+        found = indices < self._count
+        found[found] = self._hashes[indices[found]] == queries[found]
+        for i, index, is_found in zip(valid, indices.tolist(), found.tolist()):
+            if is_found:
+                result[i] = self._text(index)
+        return result
+
+
 @dataclass(eq=False)
 class Talk:
     """
@@ -429,191 +756,2034 @@ class Source:
                              # them here. Instead, we design an algorithm to
                              # find a minimum number of traces that can cover
                              # all the dialogs in this source.
-    next_sources: List[str]  # Sources taking place after the current source.
-    next_sources_optional: List[str]  # Ditto, but are triggered optionally.
-    prev_sources: List[str]  # Sources taking place before the current source.
-    prev_sources_optional: List[str]  # Ditto, but are triggered optionally.
+    # The connections to other sources are kept in `Database.source_links`.
 
 
-class Database:
-    talk_dict: Dict[int, Talk] = {}
-    dialog_dict: Dict[int, Dialog] = {}
-    quest_dict: Dict[int, Quest] = {}
-    subquest_dict: Dict[int, SubQuest] = {}
-    chapter_dict: Dict[int, Chapter] = {}
-    avatar_dict: Dict[int, Avatar] = {}
-    item_dict: Dict[int, Item] = {}
-    weapon_dict: Dict[int, Weapon] = {}
-    reliquary_set_dict: Dict[int, ReliquarySet] = {}
-    source_dict: Dict[str, Source] = {}
-    npc_name_map: Dict[int, str] = {}
-    text_map: Dict[int, str] = {}
-    readable_dict: Dict[str, str] = {}
-
-    talk2quest: Dict[int, int] = {}
-    talk2subquest: Dict[int, int] = {}
-    subquest2quest: Dict[int, int] = {}
-    quest2sources: Dict[int, List[str]] = {}
-    subquest2sources: Dict[int, List[str]] = {}
-
-    def add_talk(self, item, path):
-        if "id" not in item:
-            # Deal with some special cases. These may be different for every
-            # version of game data.
-            if "JOLEJEFDNJJ" in item:
-                item["id"] = item["JOLEJEFDNJJ"]
-                item["initDialog"] = item["FBALOFKGJKN"]
-                item["trusted"] = False
-            elif "CCFPGAKINNB" in item:
-                item["id"] = item["CCFPGAKINNB"]
-                if "FMFFELFBBJN" not in item and "initDialog" not in item:
-                    # Talks without initDialog are useless.
-                    return
-                item["initDialog"] = item["FMFFELFBBJN"]
-                if "JDOFKFPHIDC" in item and "npcId" not in item:
-                    item["npcId"] = item["JDOFKFPHIDC"]
-                if "EECDLICEMBF" in item and "nextTalks" not in item:
-                    item["nextTalks"] = item["EECDLICEMBF"]
-                if "KHBAFFEPLFB" in item and "beginCondComb" not in item:
-                    item["beginCondComb"] = item["KHBAFFEPLFB"]
-                if "AFNAENENCBB" in item and "beginCond" not in item:
-                    item["beginCond"] = item["AFNAENENCBB"]
-                    for subitem in item["beginCond"]:
-                        if "_type" in subitem:
-                            subitem["type"] = subitem["_type"]
-                        if "_param" in subitem:
-                            subitem["param"] = subitem["_param"]
-                item["trusted"] = False
-            else:
-                # Cannot resolve.
-                logging.error(f'Key "id" not exists in some item of {path} . '
-                              f'Item detail:\n{str(item)}')
-                exit(1)
-        talk_id = item["id"]
-        if talk_id in TALK_ID_BLACKLIST:
-            return
-        # Add talk to the talk_dict.
-        begin_cond_comb = (
-            "beginCondComb" in item and item["beginCondComb"] == "LOGIC_AND"
+# The connections among the sources.
+SOURCE_RELATIONS = [
+    "prev_sources",  # Sources taking place before the source.
+    "prev_sources_optional",  # Ditto, but are triggered optionally.
+    "next_sources",  # Sources taking place after the source.
+    "next_sources_optional",  # Ditto, but are triggered optionally.
+]
+
+
+def build_csr(num_rows, pairs) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build the CSR adjacency of (row, column) pairs of ints, where the columns
+    of row i are `indices[indptr[i]:indptr[i + 1]]`. Duplicated pairs are
+    dropped, and the columns of each row are in the order they first appear.
+    Returns (indptr, indices).
+    """
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    # Keep the first occurrence of each pair.
+    _, first = np.unique(
+        pairs[:, 0] * num_rows + pairs[:, 1], return_index=True
+    )
+    pairs = pairs[np.sort(first)]
+    indices = pairs[np.argsort(pairs[:, 0], kind="stable"), 1]
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pairs[:, 0], minlength=num_rows), out=indptr[1:])
+    return indptr, indices
+
+
+# Text hashes are stored as unsigned 64-bit integers, where -1 (absent) is
+# stored as its two's complement.
+HASH_MASK = (1 << 64) - 1
+
+
+class ListColumn:
+    """
+    Lists of ints of all rows in a record store, stored CSR-like as slices of
+    a shared array. Each row keeps the start and the length of its slice, so a
+    list can be shrunk in place. A longer list is appended to the array.
+    """
+    def __init__(self, lists):
+        self.starts = array.array("q")
+        self.counts = array.array("q")
+        self.values = array.array("q")
+        for values in lists:
+            self.starts.append(len(self.values))
+            self.counts.append(len(values))
+            self.values.extend(values)
+
+    def get(self, row) -> Tuple[int, ...]:
+        # A tuple rather than a list, since changing it would not change the
+        # column. Use `set` instead.
+        start = self.starts[row]
+        return tuple(self.values[start:start + self.counts[row]])
+
+    def set(self, row, values: List[int]):
+        if len(values) <= self.counts[row]:
+            start = self.starts[row]
+            self.values[start:start + len(values)] = array.array("q", values)
+        else:
+            self.starts[row] = len(self.values)
+            self.values.extend(values)
+        self.counts[row] = len(values)
+
+
+class RecordStore:
+    """
+    Columnar storage of records keyed by their ids, which replaces a dict of
+    dataclass instances once the records are merged. It supports the dict
+    operations used by the database, i.e. `in`, `[]`, `len`, `pop` and the
+    iterations. `[]` returns a view whose fields read and write the columns.
+    The list fields are read as tuples, and are changed by assigning new
+    lists to them. The iteration order is the order of the records it is
+    built from.
+    """
+    VIEW = None  # Class of the views, set by subclasses.
+
+    def __init__(self, ids: List[int]):
+        self.ids = array.array("q", ids)
+        self.alive = array.array("b", [1]) * len(ids)
+        self.num_alive = len(ids)
+        self.rows: Dict[int, int] = {}  # Row of each id.
+        self._index_rows()
+        self.sources: List[str] = []  # Interned source strings.
+        self.source_index: Dict[str, int] = {}
+
+    def intern_source(self, source: str) -> int:
+        if source not in self.source_index:
+            self.source_index[source] = len(self.sources)
+            self.sources.append(source)
+        return self.source_index[source]
+
+    def _index_rows(self):
+        self.rows = {key: row for row, key in enumerate(self.ids)}
+
+    def __getstate__(self):
+        # The indices of the rows and the interned sources are rebuilt from
+        # the lists.
+        state = self.__dict__.copy()
+        del state["rows"]
+        del state["source_index"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index_rows()
+        self.source_index = {
+            source: i for i, source in enumerate(self.sources)
+        }
+
+    def _find(self, key) -> int:
+        """
+        Returns the row of `key`, or -1 if it is absent.
+        """
+        try:
+            row = self.rows.get(key, -1)
+        except TypeError:  # Not hashable.
+            return -1
+        if row >= 0 and self.alive[row]:
+            return row
+        return -1
+
+    def __len__(self):
+        return self.num_alive
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        row = self._find(key)
+        if row < 0:
+            raise KeyError(key)
+        return self.VIEW(self, row)
+
+    def pop(self, key):
+        row = self._find(key)
+        if row < 0:
+            raise KeyError(key)
+        self.alive[row] = 0
+        self.num_alive -= 1
+        return self.VIEW(self, row)
+
+    def __iter__(self):
+        for row, key in enumerate(self.ids):
+            if self.alive[row]:
+                yield key
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for row in range(len(self.ids)):
+            if self.alive[row]:
+                yield self.VIEW(self, row)
+
+    def items(self):
+        for row, key in enumerate(self.ids):
+            if self.alive[row]:
+                yield key, self.VIEW(self, row)
+
+
+class DialogView:
+    """
+    A dialog in `DialogStore`, with the same fields as `Dialog`.
+    """
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store: "DialogStore", row: int):
+        self._store = store
+        self._row = row
+
+    @property
+    def id(self) -> int:
+        return self._store.ids[self._row]
+
+    @property
+    def talk_id(self) -> int:
+        return self._store.talk_ids[self._row]
+
+    @property
+    def role(self) -> int:
+        return self._store.roles[self._row]
+
+    @role.setter
+    def role(self, value: int):
+        self._store.roles[self._row] = value
+
+    @property
+    def source(self) -> str:
+        return self._store.sources[self._store.source_rows[self._row]]
+
+    @property
+    def talk_content_text_map_hash(self) -> int:
+        value = self._store.content_hashes[self._row]
+        return -1 if value == HASH_MASK else value
+
+    @property
+    def talk_role_name_text_map_hash(self) -> int:
+        value = self._store.role_name_hashes[self._row]
+        return -1 if value == HASH_MASK else value
+
+    @property
+    def next_dialogs(self) -> Tuple[int, ...]:
+        return self._store.next_dialogs.get(self._row)
+
+    @next_dialogs.setter
+    def next_dialogs(self, value: List[int]):
+        self._store.next_dialogs.set(self._row, value)
+
+    @property
+    def trusted(self) -> bool:
+        return bool(self._store.trusted[self._row])
+
+
+class DialogStore(RecordStore):
+    """
+    Columnar storage of the merged dialogs.
+    """
+    VIEW = DialogView
+
+    def __init__(self, dialogs: List[Dialog]):
+        super().__init__([dialog.id for dialog in dialogs])
+        self.talk_ids = array.array("q", [dialog.talk_id for dialog in dialogs])
+        self.roles = array.array("q", [dialog.role for dialog in dialogs])
+        self.source_rows = array.array(
+            "l", [self.intern_source(dialog.source) for dialog in dialogs]
+        )
+        self.content_hashes = array.array("Q", [
+            dialog.talk_content_text_map_hash & HASH_MASK
+            for dialog in dialogs
+        ])
+        self.role_name_hashes = array.array("Q", [
+            dialog.talk_role_name_text_map_hash & HASH_MASK
+            for dialog in dialogs
+        ])
+        self.next_dialogs = ListColumn(
+            dialog.next_dialogs for dialog in dialogs
+        )
+        self.trusted = array.array(
+            "b", [dialog.trusted for dialog in dialogs]
+        )
+
+
+class TalkView:
+    """
+    A talk in `TalkStore`, with the same fields as `Talk`.
+    """
+    __slots__ = ("_store", "_row")
+
+    def __init__(self, store: "TalkStore", row: int):
+        self._store = store
+        self._row = row
+
+    @property
+    def id(self) -> int:
+        return self._store.ids[self._row]
+
+    @property
+    def source(self) -> str:
+        return self._store.sources[self._store.source_rows[self._row]]
+
+    @property
+    def npc_id(self) -> Tuple[int, ...]:
+        return self._store.npc_ids.get(self._row)
+
+    @property
+    def init_dialog(self) -> int:
+        return self._store.init_dialogs[self._row]
+
+    @property
+    def next_talks(self) -> Tuple[int, ...]:
+        return self._store.next_talks.get(self._row)
+
+    @next_talks.setter
+    def next_talks(self, value: List[int]):
+        self._store.next_talks.set(self._row, value)
+
+    @property
+    def prev_talks(self) -> Tuple[int, ...]:
+        return self._store.prev_talks.get(self._row)
+
+    @prev_talks.setter
+    def prev_talks(self, value: List[int]):
+        self._store.prev_talks.set(self._row, value)
+
+    @property
+    def begin_cond_comb(self) -> bool:
+        return bool(self._store.begin_cond_combs[self._row])
+
+    @property
+    def begin_cond(self) -> Tuple[Tuple[int, str], ...]:
+        # Stored as flattened (subquest_id, int(cond)) pairs.
+        values = self._store.begin_conds.get(self._row)
+        return tuple(
+            (values[i], str(values[i + 1])) for i in range(0, len(values), 2)
         )
+
+    @begin_cond.setter
+    def begin_cond(self, value: List[Tuple[int, str]]):
+        self._store.begin_conds.set(self._row, [
+            x for subquest_id, cond in value for x in (subquest_id, int(cond))
+        ])
+
+    @property
+    def trusted(self) -> bool:
+        return bool(self._store.trusted[self._row])
+
+
+class TalkStore(RecordStore):
+    """
+    Columnar storage of the merged talks.
+    """
+    VIEW = TalkView
+
+    def __init__(self, talks: List[Talk]):
+        super().__init__([talk.id for talk in talks])
+        self.source_rows = array.array(
+            "l", [self.intern_source(talk.source) for talk in talks]
+        )
+        self.npc_ids = ListColumn(talk.npc_id for talk in talks)
+        self.init_dialogs = array.array(
+            "q", [talk.init_dialog for talk in talks]
+        )
+        self.next_talks = ListColumn(talk.next_talks for talk in talks)
+        self.prev_talks = ListColumn(talk.prev_talks for talk in talks)
+        self.begin_cond_combs = array.array(
+            "b", [talk.begin_cond_comb for talk in talks]
+        )
+        self.begin_conds = ListColumn(
+            [x for subquest_id, cond in talk.begin_cond
+               for x in (subquest_id, int(cond))]
+            for talk in talks
+        )
+        self.trusted = array.array("b", [talk.trusted for talk in talks])
+
+
+class DataError(Exception):
+    """
+    Raised when an item in the input data cannot be resolved.
+    """
+
+
+@dataclass
+class ParsedFile:
+    """
+    Normalized records collected from a single input file.
+    Files are parsed independently (possibly in worker processes) and then
+    merged into the database in the original file order, so the conflict
+    resolution among files is the same no matter how the files are parsed.
+    The records are stored in the order they should be merged.
+    """
+    path: str
+    talks: List[Talk]
+    dialogs: List[Dialog]
+    sub_quests: List[SubQuest]
+    quest: Optional[Quest]  # Only presented in quest files.
+    error: Optional[str]  # Set if some item cannot be resolved. Records before
+                          # the broken item are kept so that they are merged
+                          # before reporting the error.
+    decode_records: List[DecodeRecord]  # Timing of decoding the file.
+
+
+@dataclass
+class ItemSchema:
+    """
+    Field names of the items in some version of the game data. The field
+    names are obfuscated differently in every version, so each version only
+    needs an entry in the schema tables below.
+    """
+    id_key: str  # Name of the id field. Also used to detect the schema.
+    keys: Dict[str, List[str]]  # Real field name -> keys to look up, the
+                                # former ones take precedence. Fields not
+                                # listed here use the real names. Fields of
+                                # nested items are named like "beginCond.type".
+    trusted: bool  # Ditto as `Talk.trusted`.
+
+    def getter(self, field: str, default=None):
+        """
+        Compile the lookup of `field` into a function of an item.
+        """
+        real_key = field.split(".")[-1]
+        return compile_getter(self.keys.get(field, [real_key]), default)
+
+
+def compile_getter(keys: List[str], default=None):
+    key = keys[0]
+    if len(keys) == 1:
+        return lambda item: item.get(key, default)
+    fallback = compile_getter(keys[1:], default)
+    return lambda item: item[key] if key in item else fallback(item)
+
+
+# Schemas of talk items, in the order of detection.
+TALK_SCHEMAS = [
+    ItemSchema(id_key="id", keys={}, trusted=True),
+    ItemSchema(id_key="JOLEJEFDNJJ", keys={
+        "initDialog": ["FBALOFKGJKN"],
+    }, trusted=False),
+    ItemSchema(id_key="CCFPGAKINNB", keys={
+        "initDialog": ["FMFFELFBBJN", "initDialog"],
+        "npcId": ["npcId", "JDOFKFPHIDC"],
+        "nextTalks": ["nextTalks", "EECDLICEMBF"],
+        "beginCondComb": ["beginCondComb", "KHBAFFEPLFB"],
+        "beginCond": ["beginCond", "AFNAENENCBB"],
+        "beginCond.type": ["_type", "type"],
+        "beginCond.param": ["_param", "param"],
+    }, trusted=False),
+]
+# Schemas of dialog items, in the order of detection.
+DIALOG_SCHEMAS = [
+    # In DialogExcelConfigData.json, "GFLDJMJKIKE" is the id field.
+    ItemSchema(id_key="GFLDJMJKIKE", keys={}, trusted=True),
+    ItemSchema(id_key="id", keys={}, trusted=True),
+    ItemSchema(id_key="CCFPGAKINNB", keys={
+        "nextDialogs": ["FNNPCGIAELE", "nextDialogs"],
+        "talkRole": ["HJLEMJIGNFE", "talkRole"],
+        "talkRole.type": ["_type", "type"],
+        "talkRole.id": ["_id", "id"],
+        "talkContentTextMapHash": ["BDOKCLNNDGN", "talkContentTextMapHash"],
+    }, trusted=False),
+    ItemSchema(id_key="JOLEJEFDNJJ", keys={
+        "nextDialogs": ["CLMNEDLMAJL", "nextDialogs"],
+        "talkRole": ["IFAOOKCBDGD", "talkRole"],
+        "talkRole.type": ["_type", "type"],
+        "talkRole.id": ["_id", "id"],
+        "talkContentTextMapHash": ["EMKCOIBADBJ", "talkContentTextMapHash"],
+        "talkRoleNameTextMapHash":
+            ["EIKACHBNBMJ", "talkRoleNameTextMapHash"],
+    }, trusted=False),
+]
+# Schemas of quest items, in the order of detection.
+QUEST_SCHEMAS = [
+    ItemSchema(id_key="id", keys={}, trusted=True),
+    ItemSchema(id_key="CCFPGAKINNB", keys={
+        "type": ["type", "JNMCHAGDLOL"],
+        "titleTextMapHash": ["titleTextMapHash", "HLAINHJACPJ"],
+        "descTextMapHash": ["descTextMapHash", "CJBHOPEAEPN"],
+        "chapterId": ["chapterId", "FLCLAPBOOHF"],
+        "talks": ["talks", "PCNNNPLAEAI"],
+        "subQuests": ["subQuests", "POJOCEPJPAL"],
+        "subQuests.subId": ["subId", "OHGOECEBPJM"],
+        "subQuests.order": ["order", "NKCPJODPKPO"],
+        "subQuests.descTextMapHash": ["descTextMapHash", "CJBHOPEAEPN"],
+        "subQuests.finishCond": ["finishCond", "AODHOADLAJC"],
+        "subQuests.finishCond.type": ["type", "JNMCHAGDLOL"],
+        "subQuests.finishCond.param": ["param", "OBKNOBNIEGC"],
+    }, trusted=False),
+]
+
+
+def compile_talk_extractor(schema: ItemSchema):
+    """
+    Compile the function normalizing a talk item of `schema`. The init_dialog
+    of the returned talk is None if the talk is useless, i.e. it comes from an
+    untrusted schema and has no initDialog.
+    """
+    id_key = schema.id_key
+    trusted = schema.trusted
+    get_npc_id = schema.getter("npcId")
+    get_init_dialog = schema.getter("initDialog", -1 if trusted else None)
+    get_next_talks = schema.getter("nextTalks")
+    get_begin_cond_comb = schema.getter("beginCondComb")
+    get_begin_cond = schema.getter("beginCond")
+    get_cond_type = schema.getter("beginCond.type")
+    get_cond_param = schema.getter("beginCond.param")
+
+    def extract(item, path) -> Talk:
         begin_cond = []
-        for subitem in item.get("beginCond", []):
+        for subitem in get_begin_cond(item) or []:
+            param = get_cond_param(subitem)
             if (
-                subitem.get("type", None) == "QUEST_COND_STATE_EQUAL" and
-                "param" in subitem and
-                len(subitem["param"]) >= 2 and
-                subitem["param"][0].isdigit() and
-                subitem["param"][1] in ["2", "3"]  # We only count these values.
+                get_cond_type(subitem) == "QUEST_COND_STATE_EQUAL" and
+                param is not None and
+                len(param) >= 2 and
+                param[0].isdigit() and
+                param[1] in ["2", "3"]  # We only count these values.
             ):
-                begin_cond.append((int(subitem["param"][0]),
-                                   subitem["param"][1]))
-        talk_item = Talk(
-            id=item["id"],
+                begin_cond.append((int(param[0]), param[1]))
+        return Talk(
+            id=item[id_key],
             source=path,
-            npc_id=item.get("npcId", []),
-            init_dialog=item.get("initDialog", -1),
-            next_talks=item.get("nextTalks", []),
+            npc_id=get_npc_id(item) or [],
+            init_dialog=get_init_dialog(item),
+            next_talks=get_next_talks(item) or [],
             prev_talks=[],
-            begin_cond_comb=begin_cond_comb,
+            begin_cond_comb=get_begin_cond_comb(item) == "LOGIC_AND",
             begin_cond=begin_cond,
-            trusted=item.get("trusted", True),
+            trusted=trusted,
         )
-        if talk_id not in self.talk_dict:
-            self.talk_dict[talk_id] = talk_item
-        else:
-            # There is a talk with the same id. Determine whether to replace it.
-            if not talk_item == self.talk_dict[talk_id] and talk_item.trusted:
-                if self.talk_dict[talk_id].trusted:
-                    logging.error(f'Talk {talk_id} differs between {path} and '
-                                  f'{self.talk_dict[talk_id].source}')
-                    exit(1)
-                else:
-                    self.talk_dict[talk_id] = talk_item
+    return extract
 
-    def add_dialog(self, item, talk_id, path):
-        # In DialogExcelConfigData.json, "GFLDJMJKIKE" is the id field.
-        if "id" not in item and "GFLDJMJKIKE" not in item:
-            # Deal with some special cases. These may be different for every
-            # version of game data.
-            if "CCFPGAKINNB" in item:
-                item["id"] = item["CCFPGAKINNB"]
-                if "FNNPCGIAELE" in item:
-                    item["nextDialogs"] = item["FNNPCGIAELE"]
-                if "HJLEMJIGNFE" in item:
-                    item["talkRole"] = item["HJLEMJIGNFE"]
-                    if "_type" in item["talkRole"]:
-                        item["talkRole"]["type"] = item["talkRole"]["_type"]
-                    if "_id" in item["talkRole"]:
-                        item["talkRole"]["id"] = item["talkRole"]["_id"]
-                if "BDOKCLNNDGN" in item:
-                    item["talkContentTextMapHash"] = item["BDOKCLNNDGN"]
-                item["trusted"] = False
-            elif "JOLEJEFDNJJ" in item:
-                item["id"] = item["JOLEJEFDNJJ"]
-                if "CLMNEDLMAJL" in item:
-                    item["nextDialogs"] = item["CLMNEDLMAJL"]
-                if "IFAOOKCBDGD" in item:
-                    item["talkRole"] = item["IFAOOKCBDGD"]
-                    if "_type" in item["talkRole"]:
-                        item["talkRole"]["type"] = item["talkRole"]["_type"]
-                    if "_id" in item["talkRole"]:
-                        item["talkRole"]["id"] = item["talkRole"]["_id"]
-                if "EMKCOIBADBJ" in item:
-                    item["talkContentTextMapHash"] = item["EMKCOIBADBJ"]
-                if "EIKACHBNBMJ" in item:
-                    item["talkRoleNameTextMapHash"] = item["EIKACHBNBMJ"]
-                item["trusted"] = False
-            else:
-                logging.error(f'Key "id" not exists in some item of {path} . '
-                              f'Item detail:\n{str(item)}')
-                exit(1)
-        elif "GFLDJMJKIKE" in item:
-            item["id"] = item["GFLDJMJKIKE"]
-        if "talkRole" not in item:
-            logging.error(f'Invalid dialog {item["id"]} in {path}')
-            exit(1)
-        # Add dialog to the dialog_dict.
-        dialog_id = item["id"]
-        if (
-            "talkShowType" in item and
-            item["talkShowType"] == "TALK_SHOW_FORCE_SELECT"
-        ):
+
+def compile_dialog_extractor(schema: ItemSchema):
+    """
+    Compile the function normalizing a dialog item of `schema`.
+    """
+    id_key = schema.id_key
+    trusted = schema.trusted
+    get_talk_show_type = schema.getter("talkShowType")
+    get_talk_role = schema.getter("talkRole")
+    get_role_type = schema.getter("talkRole.type")
+    get_role_id = schema.getter("talkRole.id")
+    get_content = schema.getter("talkContentTextMapHash", -1)
+    get_role_name = schema.getter("talkRoleNameTextMapHash", -1)
+    get_next_dialogs = schema.getter("nextDialogs")
+
+    def extract(item, path, talk_id) -> Dialog:
+        dialog_id = item[id_key]
+        talk_role = get_talk_role(item)
+        if talk_role is None:
+            raise DataError(f'Invalid dialog {dialog_id} in {path}')
+        role_type = get_role_type(talk_role)
+        role_id = get_role_id(talk_role)
+        if get_talk_show_type(item) == "TALK_SHOW_FORCE_SELECT":
             role = 0
         elif (
-            "talkRole" not in item or
-            "type" not in item["talkRole"] or
-            "id" not in item["talkRole"] or (
-                item["talkRole"]["type"] in ["TALK_ROLE_NPC",
-                                             "TALK_ROLE_GADGET"] and
-                not item["talkRole"]["id"].isnumeric()
+            role_type is None or
+            role_id is None or (
+                role_type in ["TALK_ROLE_NPC", "TALK_ROLE_GADGET"] and
+                not role_id.isnumeric()
             )
         ):
             role = -1
         else:
             role = (
-                0 if item["talkRole"]["type"] == "TALK_ROLE_PLAYER" else
-                -2 if item["talkRole"]["type"] in [
+                0 if role_type == "TALK_ROLE_PLAYER" else
+                -2 if role_type in [
                     "TALK_ROLE_BLACK_SCREEN",
                     "TALK_ROLE_NEED_CLICK_BLACK_SCREEN",
                     "TALK_ROLE_CONSEQUENT_BLACK_SCREEN",
                     "TALK_ROLE_CONSEQUENT_NEED_CLICK_BLACK_SCREEN",
                 ] else
-                -3 if item["talkRole"]["type"] == "TALK_ROLE_MATE_AVATAR" else
-                int(item["talkRole"]["id"])
+                -3 if role_type == "TALK_ROLE_MATE_AVATAR" else
+                int(role_id)
             )
-        dialog_item = Dialog(
-            id=item["id"],
+        next_dialogs = get_next_dialogs(item) or []
+        if dialog_id in next_dialogs:
+            # Remove the self-loop without changing the input item.
+            next_dialogs = list(next_dialogs)
+            next_dialogs.remove(dialog_id)
+        return Dialog(
+            id=dialog_id,
             talk_id=talk_id,
             role=role,
             source=path,
-            talk_content_text_map_hash=item.get("talkContentTextMapHash", -1),
-            talk_role_name_text_map_hash=
-                item.get("talkRoleNameTextMapHash", -1),
-            next_dialogs=item.get("nextDialogs", []),
-            trusted=item.get("trusted", True),
+            talk_content_text_map_hash=get_content(item),
+            talk_role_name_text_map_hash=get_role_name(item),
+            next_dialogs=next_dialogs,
+            trusted=trusted,
+        )
+    return extract
+
+
+def compile_quest_extractor(schema: ItemSchema):
+    """
+    Compile the function normalizing a quest item of `schema`, together with
+    its talks and sub quests. The records are appended to a `ParsedFile`.
+    """
+    id_key = schema.id_key
+    get_type = schema.getter("type", "AQ")  # If type not presented, it is
+                                            # an archon quest.
+    get_title = schema.getter("titleTextMapHash", -1)
+    get_desc = schema.getter("descTextMapHash", -1)
+    get_suggest = schema.getter("suggestTrackMainQuestList")
+    get_chapter_id = schema.getter("chapterId", -1)
+    get_talks = schema.getter("talks")
+    get_sub_quests = schema.getter("subQuests")
+    get_sub_id = schema.getter("subQuests.subId")
+    get_order = schema.getter("subQuests.order")
+    get_sub_desc = schema.getter("subQuests.descTextMapHash", -1)
+    get_step_desc = schema.getter("subQuests.stepDescTextMapHash", -1)
+    get_finish_cond = schema.getter("subQuests.finishCond")
+    get_cond_type = schema.getter("subQuests.finishCond.type")
+    get_cond_param = schema.getter("subQuests.finishCond.param")
+
+    def extract(data, path, parsed: ParsedFile):
+        talks = []
+        for talk_item in iter_talks(get_talks(data) or [], path):
+            if is_useful_talk(talk_item):
+                parsed.talks.append(talk_item)
+            talks.append(talk_item.id)
+        subquest_ids = []
+        for item in get_sub_quests(data) or []:
+            # Finishing any talks in this list will complete the sub quest.
+            talk_ids = []
+            for cond_item in get_finish_cond(item) or []:
+                cond_type = get_cond_type(cond_item)
+                if cond_type == "QUEST_CONTENT_COMPLETE_TALK":
+                    # The talk id.
+                    talk_ids.append(get_cond_param(cond_item)[0])
+                elif cond_type == "QUEST_CONTENT_COMPLETE_ANY_TALK":
+                    talk_ids.append(-1)
+            parsed.sub_quests.append(SubQuest(
+                id=get_sub_id(item),
+                order=get_order(item),
+                desc_text_map_hash=get_sub_desc(item),
+                step_desc_text_map_hash=get_step_desc(item),
+                talk_ids=talk_ids,
+            ))
+            subquest_ids.append(get_sub_id(item))
+        parsed.quest = Quest(
+            id=data[id_key],
+            type=get_type(data),
+            title_text_map_hash=get_title(data),
+            desc_text_map_hash=get_desc(data),
+            suggest_track_main_quest_list=get_suggest(data) or [],
+            chapter_id=get_chapter_id(data),
+            sub_quests=subquest_ids,
+            talks=talks,
+            next_quests=[],  # Fill it later.
+            prev_quests=[],  # Ditto.
+        )
+    return extract
+
+
+# Compiled extractors, keyed by the id field of their schemas. The order is
+# kept from the schema tables.
+TALK_EXTRACTORS = {
+    schema.id_key: compile_talk_extractor(schema) for schema in TALK_SCHEMAS
+}
+DIALOG_EXTRACTORS = {
+    schema.id_key: compile_dialog_extractor(schema)
+    for schema in DIALOG_SCHEMAS
+}
+QUEST_EXTRACTORS = {
+    schema.id_key: compile_quest_extractor(schema) for schema in QUEST_SCHEMAS
+}
+
+
+def detect_extractor(extractors, item, path):
+    """
+    Returns the id field and the extractor of the first schema `item` fits.
+    """
+    for id_key, extract in extractors.items():
+        if id_key in item:
+            return id_key, extract
+    # Cannot resolve.
+    raise DataError(f'Key "id" not exists in some item of {path} . '
+                    f'Item detail:\n{str(item)}')
+
+
+def iter_records(extractors, items, path, *args):
+    """
+    Normalize the items from the same file. The schema is detected from the
+    first item, and detected again only if an item does not fit it, or has
+    the id field of a schema preferred to it, so each item gets the same
+    schema as `detect_extractor` would give while most items only cost the
+    lookups of their fields.
+    """
+    id_keys = list(extractors.keys())
+    # No item has a None key. The id fields of the schemas preferred to the
+    # current one.
+    id_key, extract, preferred_keys = None, None, id_keys
+    for item in items:
+        if id_key not in item or any(key in item for key in preferred_keys):
+            id_key, extract = detect_extractor(extractors, item, path)
+            preferred_keys = id_keys[:id_keys.index(id_key)]
+        yield extract(item, path, *args)
+
+
+def iter_talks(items, path):
+    return iter_records(TALK_EXTRACTORS, items, path)
+
+
+def iter_dialogs(items, path, talk_id):
+    return iter_records(DIALOG_EXTRACTORS, items, path, talk_id)
+
+
+def is_useful_talk(talk_item: Talk) -> bool:
+    # Talks without initDialog are useless.
+    return (
+        talk_item.init_dialog is not None and
+        talk_item.id not in TALK_ID_BLACKLIST
+    )
+
+
+def parse_quest(data, path, parsed: ParsedFile):
+    """
+    Normalize a quest item together with its talks and sub quests. The
+    records are appended to `parsed`.
+    """
+    _, extract = detect_extractor(QUEST_EXTRACTORS, data, path)
+    extract(data, path, parsed)
+
+
+def parse_talk_file(path) -> ParsedFile:
+    parsed = ParsedFile(path=path, talks=[], dialogs=[], sub_quests=[],
+                        quest=None, error=None, decode_records=[])
+    data = load_json(path, parsed.decode_records)
+    if isinstance(data, dict):
+        if "talks" in data:
+            data = data["talks"]
+        # Then deal with some special cases where the field names are
+        # obfusecated.
+        elif (
+            # I'm not sure what the field "JEMDGACPOPC" is, but it seems
+            # like a kind of unique identifier.
+            "JEMDGACPOPC" in data
+        ):
+            data = data["DMIMNILOLKP"]  # "DMIMNILOLKP" is "talks".
+        elif (
+            # "JDOFKFPHIDC" is "npcId".
+            "JDOFKFPHIDC" in data
+        ):
+            data = data["PCNNNPLAEAI"]  # "PCNNNPLAEAI" is "talks"
+        else:  # a single talk item
+            data = [data]
+    try:
+        for talk_item in iter_talks(data, path):
+            if is_useful_talk(talk_item):
+                parsed.talks.append(talk_item)
+    except DataError as e:
+        parsed.error = str(e)
+    return parsed
+
+
+def parse_dialog_file(path) -> ParsedFile:
+    parsed = ParsedFile(path=path, talks=[], dialogs=[], sub_quests=[],
+                        quest=None, error=None, decode_records=[])
+    data = load_json(path, parsed.decode_records)
+    # Special blacklist cases.
+    if isinstance(data, dict) and \
+            len(data) == 2 and \
+            set(data.keys()) == set(["talkId", "type"]):
+        return parsed
+    if isinstance(data, dict):
+        if "talkId" in data:
+            talkId = data["talkId"]
+        # Then deal with some special cases where the field names are
+        # obfusecated.
+        elif "FEOACBMDCKJ" in data:
+            talkId = data["FEOACBMDCKJ"]
+            if "AAOAAFLLOJI" not in data and "dialogList" not in data:
+                # Files without dialogList are useless.
+                return parsed
+            data = data["AAOAAFLLOJI"]
+        elif "PBAEPDPNKEJ" in data:
+            talkId = data["PBAEPDPNKEJ"]
+            if "KJNKFMPAGAA" not in data and "dialogList" not in data:
+                # Files without dialogList are useless.
+                return parsed
+            data = data["KJNKFMPAGAA"]
+        else:
+            logging.info(f'Ignoring {path} since it seems not a dialog '
+                         'file.')
+            return parsed
+    else:
+        assert isinstance(data, list)
+        if (
+            len(data) > 0 and
+            "id" not in data[0] and
+            "GFLDJMJKIKE" not in data[0]
+        ):
+            logging.info(f'Ignoring {path} since it seems not a dialog '
+                         'file.')
+            return parsed
+        talkId = -1
+    if isinstance(data, dict):
+        if "dialogList" in data:
+            data = data["dialogList"]
+        else: # a single dialog item
+            data = [data]
+    try:
+        for dialog_item in iter_dialogs(data, path, talkId):
+            parsed.dialogs.append(dialog_item)
+    except DataError as e:
+        parsed.error = str(e)
+    return parsed
+
+
+def parse_quest_talk_file(path) -> ParsedFile:
+    """
+    Quest talk files possibly contain talks and/or dialogs.
+    """
+    parsed = ParsedFile(path=path, talks=[], dialogs=[], sub_quests=[],
+                        quest=None, error=None, decode_records=[])
+    data = load_json(path, parsed.decode_records)
+    try:
+        for talk_item in iter_talks(data.get("talks", []), path):
+            if is_useful_talk(talk_item):
+                parsed.talks.append(talk_item)
+        for dialog_item in iter_dialogs(data.get("dialogList", []), path, -1):
+            parsed.dialogs.append(dialog_item)
+    except DataError as e:
+        parsed.error = str(e)
+    return parsed
+
+
+def parse_quest_file(path) -> ParsedFile:
+    parsed = ParsedFile(path=path, talks=[], dialogs=[], sub_quests=[],
+                        quest=None, error=None, decode_records=[])
+    data = load_json(path, parsed.decode_records)
+    try:
+        parse_quest(data, path, parsed)
+    except DataError as e:
+        parsed.error = str(e)
+    return parsed
+
+
+def map_files(func, entries: List["ManifestEntry"], pool):
+    """
+    Apply `func` to each file. If a `multiprocessing.Pool` is given, the files
+    are processed by the workers. In both cases the results are yielded in the
+    order of `entries`.
+    """
+    paths = [entry.path for entry in entries]
+    if pool is None:
+        return map(func, paths)
+    # The results are yielded in order, so at most the chunks being parsed
+    # ahead are kept in memory.
+    return pool.imap(func, paths, chunksize=8)
+
+
+# Directories containing all the talks and dialogs, relative to data_dir.
+TALK_DIR_LIST = [
+    os.path.join("BinOutput", "Talk", "ActivityGroup"),
+    os.path.join("BinOutput", "Talk", "BlossomGroup"),
+    os.path.join("BinOutput", "Talk", "GadgetGroup"),
+    os.path.join("BinOutput", "Talk", "NpcGroup"),
+]
+DIALOG_DIR_LIST = [
+    os.path.join("BinOutput", "Talk", "Activity"),
+    os.path.join("BinOutput", "Talk", "Blossom"),
+    os.path.join("BinOutput", "Talk", "Coop"),
+    os.path.join("BinOutput", "Talk", "FreeGroup"),
+    os.path.join("BinOutput", "Talk", "Gadget"),
+    os.path.join("BinOutput", "Talk", "Npc"),
+    os.path.join("BinOutput", "Talk", "NpcOther"),
+    os.path.join("BinOutput", "Talk"),
+]
+QUEST_TALK_DIR = os.path.join("BinOutput", "Talk", "Quest")
+QUEST_DIR = os.path.join("BinOutput", "Quest")
+EXCEL_DIR = "ExcelBinOutput"
+# Talk and dialog files in ExcelBinOutput, parsed before the directories above.
+TALK_EXCEL_FILES = ["TalkExcelConfigData.json", "RqTalkExcelConfigData.json"]
+DIALOG_EXCEL_FILES = ["DialogExcelConfigData.json"]
+# Files ignored, relative to data_dir.
+FILE_BLACKLIST = {
+    os.path.join("BinOutput", "Talk", "NpcGroup", "22.json"),
+    os.path.join("BinOutput", "Talk", "NpcGroup", "23.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "1702.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "1712.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "1713.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "2231.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "2232.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "3208.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "4000.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "4001.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "4002.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "4003.json"),
+    os.path.join("BinOutput", "Talk", "NpcOther", "4004.json"),
+    os.path.join("BinOutput", "Talk", "4c370aaa.json"),
+    os.path.join("BinOutput", "Talk", "66c42405.json"),
+}
+
+
+@dataclass
+class ManifestEntry:
+    path: str
+    size: int
+    mtime_ns: int
+
+
+def scan_dir(data_dir, rel_dir, json_only=True) -> List[ManifestEntry]:
+    """
+    List the files in `rel_dir`, in the order of the file system.
+    """
+    entries = []
+    with os.scandir(os.path.join(data_dir, rel_dir)) as it:
+        for entry in it:
+            if json_only and not entry.name.endswith(".json"):
+                continue
+            if os.path.join(rel_dir, entry.name) in FILE_BLACKLIST:
+                continue
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            entries.append(
+                ManifestEntry(entry.path, stat.st_size, stat.st_mtime_ns)
+            )
+    return entries
+
+
+@dataclass
+class Manifest:
+    """
+    The input files grouped by how they are parsed, together with their sizes
+    and mtimes. Every directory is scanned only once. The groups keep the
+    order the files are merged into the database.
+    """
+    talk_files: List[ManifestEntry]
+    dialog_files: List[ManifestEntry]
+    quest_talk_files: List[ManifestEntry]  # Contain talks and/or dialogs.
+    quest_files: List[ManifestEntry]
+    excel_files: List[ManifestEntry]  # All JSON files in ExcelBinOutput,
+                                      # sorted by name.
+
+    GROUPS = ["talk_files", "dialog_files", "quest_talk_files", "quest_files",
+              "excel_files"]
+
+    @classmethod
+    def scan(cls, data_dir) -> "Manifest":
+        excel_files = sorted(
+            scan_dir(data_dir, EXCEL_DIR), key=lambda entry: entry.path
+        )
+        excel_dict = {
+            os.path.basename(entry.path): entry for entry in excel_files
+        }
+        for name in TALK_EXCEL_FILES + DIALOG_EXCEL_FILES:
+            if name not in excel_dict:
+                logging.error(f'{os.path.join(data_dir, EXCEL_DIR, name)} '
+                              'not found.')
+                exit(1)
+        talk_files = [excel_dict[name] for name in TALK_EXCEL_FILES]
+        for d in TALK_DIR_LIST:
+            talk_files.extend(scan_dir(data_dir, d))
+        dialog_files = [excel_dict[name] for name in DIALOG_EXCEL_FILES]
+        for d in DIALOG_DIR_LIST:
+            dialog_files.extend(scan_dir(data_dir, d))
+        return cls(
+            talk_files=talk_files,
+            dialog_files=dialog_files,
+            quest_talk_files=scan_dir(data_dir, QUEST_TALK_DIR,
+                                      json_only=False),
+            quest_files=scan_dir(data_dir, QUEST_DIR, json_only=False),
+            excel_files=excel_files,
         )
-        if dialog_item.id in dialog_item.next_dialogs:
-            dialog_item.next_dialogs.remove(dialog_item.id)  # remove self-loop
+
+    def entries(self) -> List[ManifestEntry]:
+        return [
+            entry for group in self.GROUPS for entry in getattr(self, group)
+        ]
+
+    def save(self, filepath):
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        with open(filepath, "w", encoding="utf-8") as f:
+            json.dump({
+                group: [dataclasses.astuple(entry)
+                        for entry in getattr(self, group)]
+                for group in self.GROUPS
+            }, f)
+
+    @classmethod
+    def load(cls, filepath) -> Optional["Manifest"]:
+        """
+        Load the manifest saved by `save`. Returns None if it is absent or
+        broken.
+        """
+        try:
+            with open(filepath, encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(**{
+                group: [ManifestEntry(*entry) for entry in data[group]]
+                for group in cls.GROUPS
+            })
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def changed_files(self, previous: "Manifest") -> List[str]:
+        """
+        Paths of the files added, removed or modified since `previous`.
+        """
+        current = {
+            entry.path: (entry.size, entry.mtime_ns)
+            for entry in self.entries()
+        }
+        before = {
+            entry.path: (entry.size, entry.mtime_ns)
+            for entry in previous.entries()
+        }
+        return sorted(
+            path for path in current.keys() | before.keys()
+            if current.get(path) != before.get(path)
+        )
+
+
+# Bump this when the structure of the snapshot changes.
+SNAPSHOT_VERSION = 3
+
+
+def fingerprint_inputs(entries: List[ManifestEntry], options: list) -> str:
+    """
+    Fingerprint of the input files (by their paths, sizes and mtimes), the
+    options affecting the database structure, and this script itself.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((SNAPSHOT_VERSION, options)).encode("utf-8"))
+    with open(__file__, "rb") as f:
+        digest.update(f.read())
+    for entry in entries:
+        digest.update(
+            f'{entry.path}\0{entry.size}\0{entry.mtime_ns}\0'.encode("utf-8")
+        )
+    return digest.hexdigest()
+
+
+class DialogGraph:
+    """
+    A lightweight directed graph of dialogs (or talks), with the operations
+    needed to build the sources and find their traces.
+    The nodes are indexed by consecutive integers in the order of insertion,
+    and the adjacency is kept as lists of indices. The nodes, successors and
+    predecessors are iterated in the same orders as in a networkx.DiGraph,
+    i.e. the order of insertion, since the traces depend on them.
+    Nodes are never removed.
+    """
+    def __init__(self, nodes=()):
+        self.index: Dict[int, int] = {}  # Node -> Index.
+        self.labels: List[int] = []  # Index -> Node.
+        self.succ: List[List[int]] = []  # Index -> Indices of successors.
+        self.pred: List[List[int]] = []  # Index -> Indices of predecessors.
+        self.add_nodes_from(nodes)
+
+    def __getstate__(self):
+        # Pickle the adjacency as flat arrays, which is much smaller.
+        return (
+            array.array("q", self.labels),
+            array.array("q", [len(succ) for succ in self.succ]),
+            array.array("q", [v for succ in self.succ for v in succ]),
+            array.array("q", [len(pred) for pred in self.pred]),
+            array.array("q", [v for pred in self.pred for v in pred]),
+        )
+
+    def __setstate__(self, state):
+        labels, succ_counts, succ_flat, pred_counts, pred_flat = state
+        self.labels = labels.tolist()
+        self.index = {node: i for i, node in enumerate(self.labels)}
+        for name, counts, flat in [
+            ("succ", succ_counts, succ_flat),
+            ("pred", pred_counts, pred_flat),
+        ]:
+            lists = []
+            offset = 0
+            for count in counts:
+                lists.append(flat[offset:offset + count].tolist())
+                offset += count
+            setattr(self, name, lists)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, node):
+        return node in self.index
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    @property
+    def nodes(self) -> List[int]:
+        return self.labels
+
+    @property
+    def edges(self):
+        for u, succ in enumerate(self.succ):
+            for v in succ:
+                yield self.labels[u], self.labels[v]
+
+    def number_of_edges(self) -> int:
+        return sum(len(succ) for succ in self.succ)
+
+    def add_node(self, node) -> int:
+        """
+        Add the node if absent. Returns its index.
+        """
+        i = self.index.get(node)
+        if i is None:
+            i = len(self.labels)
+            self.index[node] = i
+            self.labels.append(node)
+            self.succ.append([])
+            self.pred.append([])
+        return i
+
+    def add_nodes_from(self, nodes):
+        for node in nodes:
+            self.add_node(node)
+
+    def add_edge(self, u, v):
+        i = self.add_node(u)
+        j = self.add_node(v)
+        if j not in self.succ[i]:
+            self.succ[i].append(j)
+            self.pred[j].append(i)
+
+    def add_edges_from(self, edges):
+        for u, v in edges:
+            self.add_edge(u, v)
+
+    def has_edge(self, u, v) -> bool:
+        i = self.index.get(u)
+        j = self.index.get(v)
+        return i is not None and j is not None and j in self.succ[i]
+
+    def remove_edge(self, u, v):
+        # The orders of the other neighbors are kept.
+        i = self.index[u]
+        j = self.index[v]
+        self.succ[i].remove(j)
+        self.pred[j].remove(i)
+
+    def successors(self, node) -> List[int]:
+        return [self.labels[j] for j in self.succ[self.index[node]]]
+
+    def predecessors(self, node) -> List[int]:
+        return [self.labels[j] for j in self.pred[self.index[node]]]
+
+    def out_degree(self, node) -> int:
+        return len(self.succ[self.index[node]])
+
+    def in_degree(self, node) -> int:
+        return len(self.pred[self.index[node]])
+
+    def degree(self, node) -> int:
+        # A self-loop counts twice, like in networkx.
+        i = self.index[node]
+        return len(self.succ[i]) + len(self.pred[i])
+
+    def weakly_connected_components(self) -> List[Set[int]]:
+        """
+        Returns the sets of nodes of the weakly connected components. The
+        components, and the nodes in each set, are found in the same order
+        as `networkx.weakly_connected_components`.
+        """
+        components = []
+        seen_all = [False] * len(self.labels)
+        for root in range(len(self.labels)):
+            if seen_all[root]:
+                continue
+            seen_all[root] = True
+            component = {self.labels[root]}
+            queue = [root]
+            for i in queue:
+                for j in self.succ[i] + self.pred[i]:
+                    if not seen_all[j]:
+                        seen_all[j] = True
+                        component.add(self.labels[j])
+                        queue.append(j)
+            components.append(component)
+        return components
+
+    def strongly_connected_components(self) -> List[List[int]]:
+        """
+        Returns the lists of nodes of the strongly connected components, by
+        the Tarjan's algorithm written iteratively.
+        """
+        num_nodes = len(self.labels)
+        order = [-1] * num_nodes  # Index -> Visiting order.
+        low = [0] * num_nodes
+        on_stack = [False] * num_nodes
+        stack = []
+        components = []
+        counter = 0
+        for root in range(num_nodes):
+            if order[root] != -1:
+                continue
+            order[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            # (Index, position in its successors) of the DFS path.
+            path = [(root, 0)]
+            while path:
+                i, pos = path[-1]
+                if pos < len(self.succ[i]):
+                    path[-1] = (i, pos + 1)
+                    j = self.succ[i][pos]
+                    if order[j] == -1:
+                        order[j] = low[j] = counter
+                        counter += 1
+                        stack.append(j)
+                        on_stack[j] = True
+                        path.append((j, 0))
+                    elif on_stack[j]:
+                        low[i] = min(low[i], order[j])
+                    continue
+                path.pop()
+                if path:
+                    parent = path[-1][0]
+                    low[parent] = min(low[parent], low[i])
+                if low[i] == order[i]:
+                    component = []
+                    while True:
+                        j = stack.pop()
+                        on_stack[j] = False
+                        component.append(self.labels[j])
+                        if j == i:
+                            break
+                    components.append(component)
+        return components
+
+    def is_acyclic(self) -> bool:
+        in_degree = [len(pred) for pred in self.pred]
+        queue = [i for i in range(len(self.labels)) if in_degree[i] == 0]
+        for i in queue:
+            for j in self.succ[i]:
+                in_degree[j] -= 1
+                if in_degree[j] == 0:
+                    queue.append(j)
+        return len(queue) == len(self.labels)
+
+    def shortest_path(self, source, target) -> List[int]:
+        """
+        Find a shortest path from `source` to `target` by the bidirectional
+        BFS of `networkx.shortest_path`, which finds the same path.
+        If `source` is a list of nodes, the search starts from a super node
+        with edges to them, as if the super node were added to the graph
+        after all the other edges. The super node is not included in the
+        path. Ditto for `target`.
+        """
+        super_source, super_target = -1, -2
+        if isinstance(source, list):
+            source_list = [self.index[node] for node in source]
+            source_set = set(source_list)
+            source = super_source
+        else:
+            source_set = set()
+            source = self.index[source]
+        if isinstance(target, list):
+            target_list = [self.index[node] for node in target]
+            target_set = set(target_list)
+            target = super_target
+        else:
+            target_set = set()
+            target = self.index[target]
+
+        def successors(i):
+            if i == super_source:
+                return source_list
+            if i in target_set:
+                return self.succ[i] + [super_target]
+            return self.succ[i]
+
+        def predecessors(i):
+            if i == super_target:
+                return target_list
+            if i in source_set:
+                return self.pred[i] + [super_source]
+            return self.pred[i]
+
+        def search():
+            if source == target:
+                return {source: None}, {target: None}, source
+            pred = {source: None}
+            succ = {target: None}
+            forward_fringe = [source]
+            reverse_fringe = [target]
+            while forward_fringe and reverse_fringe:
+                if len(forward_fringe) <= len(reverse_fringe):
+                    this_level = forward_fringe
+                    forward_fringe = []
+                    for v in this_level:
+                        for w in successors(v):
+                            if w not in pred:
+                                forward_fringe.append(w)
+                                pred[w] = v
+                            if w in succ:
+                                return pred, succ, w
+                else:
+                    this_level = reverse_fringe
+                    reverse_fringe = []
+                    for v in this_level:
+                        for w in predecessors(v):
+                            if w not in succ:
+                                succ[w] = v
+                                reverse_fringe.append(w)
+                            if w in pred:
+                                return pred, succ, w
+            return None
+
+        found = search()
+        if found is None:
+            return None
+        pred, succ, w = found
+        path = []
+        while w is not None:
+            path.append(w)
+            w = pred[w]
+        path.reverse()
+        w = succ[path[-1]]
+        while w is not None:
+            path.append(w)
+            w = succ[w]
+        return [
+            self.labels[i] for i in path
+            if i != super_source and i != super_target
+        ]
+
+
+def break_cycles(graph: nx.DiGraph) -> List[Tuple[int, int]]:
+    """
+    Iteratively remove an edge from a cycle of `graph` until it is acyclic.
+    Returns the removed edges in order.
+    There seems to be no smart strategies to break the cycles. To keep the
+    algorithm deterministic, we always remove an in-edge of the node with the
+    minimum id in the first cycle sorted in alphabetical order, i.e. the
+    minimum node on any cycle. The in-edge is from the predecessor (on any
+    cycle) with the minimum id.
+    A node is on a cycle if and only if its strongly connected component (SCC)
+    has multiple nodes or it has a self-loop, so no cycles are enumerated.
+    Removing an edge (u, v) only changes the SCCs if the edge is inside an
+    SCC, and only if u cannot reach v any more. Only then that SCC is split.
+    """
+    scc_of = {}  # Node on a cycle -> its SCC.
+    def add_scc(scc):
+        node = next(iter(scc))
+        if len(scc) > 1 or graph.has_edge(node, node):
+            for node in scc:
+                scc_of[node] = scc
+        else:
+            scc_of.pop(node, None)
+
+    def reachable(source, nodes, neighbors) -> Set[int]:
+        """
+        Nodes reachable from `source` along `neighbors`, within `nodes`.
+        """
+        visited = {source}
+        queue = [source]
+        for node in queue:
+            for next_node in neighbors(node):
+                if next_node not in visited and next_node in nodes:
+                    visited.add(next_node)
+                    queue.append(next_node)
+        return visited
+
+    def reaches(source, target, nodes) -> bool:
+        visited = {source}
+        queue = [source]
+        for node in queue:
+            for next_node in graph.successors(node):
+                if next_node == target:
+                    return True
+                if next_node not in visited and next_node in nodes:
+                    visited.add(next_node)
+                    queue.append(next_node)
+        return False
+
+    def split_scc(scc, u, v):
+        """
+        Split `scc` after removing the edge (u, v), given that u cannot reach
+        v any more.
+        """
+        # v still reaches every node of the SCC, since a shortest path from v
+        # never enters v again. So the nodes reaching v form an SCC.
+        reaching_v = reachable(v, scc, graph.predecessors)
+        add_scc(reaching_v)
+        # The rest of the nodes reached v only through u, so they all reach u.
+        # The nodes reached from u among them form another SCC.
+        rest = scc - reaching_v
+        if len(rest) == 0:
+            return
+        reached_from_u = reachable(u, rest, graph.successors)
+        add_scc(reached_from_u)
+        rest -= reached_from_u
+        if len(rest) > 0:
+            for sub_scc in nx.strongly_connected_components(
+                graph.subgraph(rest)
+            ):
+                add_scc(sub_scc)
+
+    for scc in nx.strongly_connected_components(graph):
+        add_scc(scc)
+
+    # Nodes on cycles. Nodes no longer on cycles are dropped lazily.
+    heap = sorted(scc_of.keys())
+    removed_edges = []
+    while len(heap) > 0:
+        victim = heap[0]
+        if victim not in scc_of:
+            heapq.heappop(heap)
+            continue
+        # The victim has a predecessor in its SCC, so there is always one.
+        prev_victim = min(
+            node for node in graph.predecessors(victim) if node in scc_of
+        )
+        graph.remove_edge(prev_victim, victim)
+        removed_edges.append((prev_victim, victim))
+        scc = scc_of[victim]
+        if (
+            scc_of.get(prev_victim) is scc and
+            not reaches(prev_victim, victim, scc)
+        ):
+            split_scc(scc, prev_victim, victim)
+    return removed_edges
+
+
+def decompose_flow(flow_dict) -> Tuple[List[List[int]], List[List[int]]]:
+    """
+    Decompose the flow on the auxiliary graph of
+    `Database._find_covering_traces` into the traces from "start" to "end"
+    and the loops left in the original graph.
+    At each node, the flow leaves along the out-edge with the highest
+    remaining flow, then the highest id ("end" as 0) to make the result
+    deterministic. The nonzero out-edges of each node are kept in a heap
+    by this preference. Only the top of a heap changes when a unit of flow
+    is taken, so the decomposition takes O(log(degree)) per unit of flow,
+    instead of scanning all the out-edges.
+    The split edges v -> -v are skipped, as we always jump from v to -v.
+    Returns the traces and the loops. Each is a list of lists of dialog ids.
+    """
+    heaps = {}  # Node -> Heap of (-flow, -id, successor).
+
+    def take(node):
+        """
+        Take a unit of flow out of `node`. Returns the successor, or None if
+        there is no flow left.
+        """
+        heap = heaps.get(node)
+        if heap is None:
+            heap = [
+                (-flow, -(suc if suc != "end" else 0), suc)
+                for suc, flow in flow_dict[node].items() if flow > 0
+            ]
+            heapq.heapify(heap)
+            heaps[node] = heap
+        if len(heap) == 0:
+            return None
+        neg_flow, neg_id, suc = heap[0]
+        if neg_flow == -1:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (neg_flow + 1, neg_id, suc))
+        return suc
+
+    # Extract the traces.
+    traces = []
+    for i in range(flow_dict["end"]["start"]):
+        trace = []
+        node_next = take("start")
+        while node_next != "end":
+            assert node_next is not None and node_next > 0
+            trace.append(node_next)
+            node_next = take(-node_next)  # Skip the edge in the splitted node.
+        traces.append(trace)
+
+    # Collect the loops.
+    loops = []
+    for node_start in flow_dict:
+        if node_start in ["start", "end"]:
+            continue
+        if node_start > 0:  # Skip the edge in the splitted node.
+            continue
+        while True:
+            node_next = take(node_start)
+            if node_next is None:
+                # There is no more loops containing this node.
+                break
+            # Collect a loop.
+            loop = [-node_start]
+            while node_next != -node_start:
+                assert node_next is not None and node_next != "end"
+                loop.append(node_next)
+                node_next = take(-node_next)
+            loops.append(loop)
+    return traces, loops
+
+
+class LinkedTraces:
+    """
+    Traces kept as doubly linked lists of cells, so that splicing a loop into
+    a trace takes time linear in the length of the loop.
+    Each cell has an integer label increasing along its trace, which tells
+    the first cell among the occurrences of some nodes. When there is no room
+    between two neighboring labels, the labels of the trace are spread out
+    again.
+    """
+    GAP = 1 << 32
+
+    def __init__(self, traces: List[List[int]] = ()):
+        self.nodes = []  # Cell -> Node.
+        self.prev = []  # Cell -> Previous cell.
+        self.next = []  # Cell -> Next cell, or -1.
+        self.labels = []  # Cell -> Label.
+        self.heads = []  # Trace index -> Its sentinel cell.
+        self.first_cells = []  # Trace index -> {Node: Its first cell}.
+        for trace in traces:
+            self.append(trace)
+
+    def __len__(self):
+        return len(self.heads)
+
+    def _new_cell(self, node, label) -> int:
+        self.nodes.append(node)
+        self.prev.append(-1)
+        self.next.append(-1)
+        self.labels.append(label)
+        return len(self.nodes) - 1
+
+    def append(self, trace: List[int]):
+        head = self._new_cell(None, 0)
+        self.heads.append(head)
+        self.first_cells.append({})
+        self._insert_before(len(self.heads) - 1, -1, trace, head)
+
+    def _insert_before(self, trace_i, cell, nodes, prev_cell=None):
+        """
+        Insert the `nodes` before `cell`, or at the end of the trace (after
+        `prev_cell`) if `cell` is -1.
+        """
+        if cell != -1:
+            prev_cell = self.prev[cell]
+            if self.labels[cell] - self.labels[prev_cell] <= len(nodes):
+                self._relabel(trace_i, max(self.GAP, len(nodes) + 1))
+            low, high = self.labels[prev_cell], self.labels[cell]
+        else:
+            low = self.labels[prev_cell]
+            high = low + self.GAP * (len(nodes) + 1)
+        step = (high - low) // (len(nodes) + 1)
+        first_cells = self.first_cells[trace_i]
+        seen = set()
+        for k, node in enumerate(nodes):
+            new_cell = self._new_cell(node, low + step * (k + 1))
+            self.prev[new_cell] = prev_cell
+            self.next[prev_cell] = new_cell
+            prev_cell = new_cell
+            # The nodes are inserted before their other occurrences, if any.
+            if node not in seen:
+                seen.add(node)
+                if cell != -1 or node not in first_cells:
+                    first_cells[node] = new_cell
+        self.next[prev_cell] = cell
+        if cell != -1:
+            self.prev[cell] = prev_cell
+
+    def _relabel(self, trace_i, gap):
+        cell = self.heads[trace_i]
+        label = 0
+        while cell != -1:
+            self.labels[cell] = label
+            label += gap
+            cell = self.next[cell]
+
+    def splice(self, trace_i, loop: List[int]):
+        """
+        Splice the loop into the trace at the first occurrence of any node of
+        the loop, which must exist.
+        """
+        first_cells = self.first_cells[trace_i]
+        entrance = min(
+            (first_cells[node] for node in loop if node in first_cells),
+            key=self.labels.__getitem__
+        )
+        entrance_loc = loop.index(self.nodes[entrance])
+        self._insert_before(
+            trace_i, entrance, loop[entrance_loc:] + loop[:entrance_loc]
+        )
+
+    def to_lists(self) -> List[List[int]]:
+        traces = []
+        for head in self.heads:
+            trace = []
+            cell = self.next[head]
+            while cell != -1:
+                trace.append(self.nodes[cell])
+                cell = self.next[cell]
+            traces.append(trace)
+        return traces
+
+
+def shortest_path_to(
+    neighbors: List[List[int]], source: int, targets
+) -> List[int]:
+    """
+    BFS along `neighbors` from `source` to the nearest node in `targets`.
+    Returns the path, including both ends, or None if no target is reachable.
+    """
+    if source in targets:
+        return [source]
+    parent = {source: None}
+    queue = [source]
+    for node in queue:
+        for next_node in neighbors[node]:
+            if next_node in parent:
+                continue
+            parent[next_node] = node
+            if next_node in targets:
+                path = []
+                while next_node is not None:
+                    path.append(next_node)
+                    next_node = parent[next_node]
+                return path[::-1]
+            queue.append(next_node)
+    return None
+
+
+def hopcroft_karp(
+    neighbors, match_left: List[int], num_right: int
+) -> List[int]:
+    """
+    Maximum matching of the bipartite graph where `neighbors(u)` lists the
+    right vertices adjacent to the left vertex u, starting from the matching
+    `match_left`, the matched right vertex of each left vertex or -1.
+    `neighbors` is only called for the vertices on alternating paths, so the
+    adjacency can be built lazily.
+    Returns `match_left`, updated in place.
+    """
+    num_left = len(match_left)
+    match_right = [-1] * num_right
+    for u, v in enumerate(match_left):
+        if v != -1:
+            match_right[v] = u
+    adj = [None] * num_left
+    for u in range(num_left):
+        if match_left[u] == -1:
+            adj[u] = neighbors(u)
+    infinity = num_left + 1
+    while True:
+        # BFS from the free left vertices, layering the left vertices by the
+        # length of the shortest alternating path.
+        dist = [infinity] * num_left
+        queue = [u for u in range(num_left) if match_left[u] == -1]
+        for u in queue:
+            dist[u] = 0
+        found = False
+        for u in queue:
+            for v in adj[u]:
+                w = match_right[v]
+                if w == -1:
+                    found = True
+                elif dist[w] == infinity:
+                    dist[w] = dist[u] + 1
+                    queue.append(w)
+                    if adj[w] is None:
+                        adj[w] = neighbors(w)
+        if not found:
+            return match_left
+        # DFS along the layers for vertex-disjoint augmenting paths. Written
+        # iteratively since the paths can be long.
+        pos = [0] * num_left
+        for root in range(num_left):
+            if match_left[root] != -1:
+                continue
+            stack = [root]
+            while stack:
+                u = stack[-1]
+                if pos[u] == len(adj[u]):
+                    dist[u] = infinity  # Dead end.
+                    stack.pop()
+                    continue
+                v = adj[u][pos[u]]
+                pos[u] += 1
+                w = match_right[v]
+                if w == -1:
+                    # Augment along the stack.
+                    for u in reversed(stack):
+                        v_prev = match_left[u]
+                        match_left[u] = v
+                        match_right[v] = u
+                        v = v_prev
+                    break
+                if dist[w] == dist[u] + 1:
+                    stack.append(w)
+
+
+def dag_path_cover(
+    graph: DialogGraph, start_set, end_set
+) -> Optional[List[List[int]]]:
+    """
+    Find the minimal set of traces covering all the nodes of the acyclic
+    `graph`, if there is one where no node is visited twice.
+    Since traces can pass through covered nodes, a set of traces is a set of
+    chains in the transitive closure of the graph, and the minimum number of
+    chains is the number of nodes minus the size of the maximum matching
+    between the nodes and their descendants. Each chain is then expanded
+    into a trace by the shortest paths between its nodes, and extended
+    backward to a starting node and forward to an ending node.
+    The minimum-cost flow in `Database._find_covering_traces` minimizes the
+    number of traces first and then the number of visits. If the traces
+    found here visit each node once, they are optimal for it as well, i.e.
+    there are as many traces and lines as from the flow, and they are
+    ordered by the same rules. When there are several such optimal covers,
+    the one found here may differ from the one of the flow. Otherwise the
+    matching does not minimize the revisits, and None is returned so that
+    the flow is used instead.
+    """
+    nodes = sorted(graph.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    successors = [
+        sorted(index[suc] for suc in graph.successors(node)) for node in nodes
+    ]
+    predecessors = [[] for _ in nodes]
+    for u in range(len(nodes)):
+        for v in successors[u]:
+            predecessors[v].append(u)
+    order = [i for i in range(len(nodes)) if len(predecessors[i]) == 0]
+    in_degree = [len(preds) for preds in predecessors]
+    for u in order:
+        for v in successors[u]:
+            in_degree[v] -= 1
+            if in_degree[v] == 0:
+                order.append(v)
+    assert len(order) == len(nodes), "The graph is not acyclic."
+
+    # Descendants as bitsets, in the reversed topological order.
+    descendants = [0] * len(nodes)
+    for u in reversed(order):
+        bits = 0
+        for v in successors[u]:
+            bits |= descendants[v] | (1 << v)
+        descendants[u] = bits
+
+    def neighbors(u):
+        # The direct successors come first, so that the matching prefers the
+        # chains without revisits.
+        bits = descendants[u]
+        for v in successors[u]:
+            bits ^= 1 << v
+        # Read the bits from the binary string, which is much faster than
+        # bit operations on large integers.
+        return successors[u] + [
+            v for v, bit in enumerate(bin(bits)[:1:-1]) if bit == "1"
+        ]
+
+    # Start from a greedy matching along the edges, which is maximum for most
+    # dialog graphs.
+    match = [-1] * len(nodes)
+    matched = [False] * len(nodes)
+    for u in range(len(nodes)):
+        for v in successors[u]:
+            if not matched[v]:
+                match[u] = v
+                matched[v] = True
+                break
+    hopcroft_karp(neighbors, match, len(nodes))
+
+    starts = {index[node] for node in start_set}
+    ends = {index[node] for node in end_set}
+    heads = set(range(len(nodes))) - set(v for v in match if v != -1)
+    traces = []
+    for head in heads:
+        trace = shortest_path_to(predecessors, head, starts)[::-1]
+        u = head
+        while match[u] != -1:
+            trace += shortest_path_to(successors, u, {match[u]})[1:]
+            u = match[u]
+        trace += shortest_path_to(successors, u, ends)[1:]
+        traces.append([nodes[i] for i in trace])
+    if sum(len(trace) for trace in traces) > len(nodes):
+        return None  # Some nodes are revisited.
+    # The flow along the traces, in the form of the auxiliary graph of
+    # `Database._find_covering_traces`. The traces are extracted from it in the
+    # same order as from the minimum-cost flow.
+    flow_dict = {"start": {}, "end": {"start": len(heads)}}
+    for node in nodes:
+        flow_dict[node] = {-node: -1}  # The first visit is free.
+        flow_dict[-node] = {}
+    for trace in traces:
+        flow_dict["start"][trace[0]] = flow_dict["start"].get(trace[0], 0) + 1
+        for u, v in zip(trace, trace[1:]):
+            flow_dict[-u][v] = flow_dict[-u].get(v, 0) + 1
+        flow_dict[-trace[-1]]["end"] = flow_dict[-trace[-1]].get("end", 0) + 1
+        for node in trace:
+            flow_dict[node][-node] += 1
+    return decompose_flow(flow_dict)[0]
+
+
+def find_source_traces(task):
+    """
+    Find the starting and ending nodes and the covering traces of a dialog
+    graph in a worker process.
+    Returns the index of the task, the traces and the elapsed seconds.
+    """
+    index, graph, preferred_starts = task
+    start = time.perf_counter()
+    start_set, end_set = Database._find_start_end(graph, preferred_starts)
+    traces = Database._find_covering_traces(graph, start_set, end_set)
+    return index, traces, time.perf_counter() - start
+
+
+@dataclass(frozen=True)
+class TextOptions:
+    """
+    The options of normalizing the exported texts, see
+    `Database.normalize_text`.
+    """
+    lang: str
+    replace_quotes: bool
+    replace_newline: bool
+    # (traveller_sex, traveller_name, wanderer_name) for replacing the
+    # placeholders. None means the placeholders are kept.
+    placeholders: Optional[Tuple[str, str, str]] = None
+    remove_skip_tags: bool = False  # Only for the subquest descriptions.
+    # Strip the text and squeeze the consecutive empty lines.
+    trim: bool = False
+    # Check the text as the content of a dialog, where None is returned for
+    # the unreleased dialogs and the challenge quest dialogs.
+    dialog: bool = False
+
+
+class TextNormalizer:
+    """
+    The normalization of the texts compiled for a TextOptions. The tags, the
+    ruby annotations and the placeholders are replaced in a single pass of one
+    combined regex, and the quotes by a translation table. Use
+    `text_normalizer` to get the shared instance of the options.
+    """
+    def __init__(self, options: TextOptions):
+        self.options = options
+        lang = options.lang
+        # The patterns of the texts to be removed, i.e. the skipping tags, the
+        # XML tags, and the ruby annotations if the placeholders are replaced.
+        removals = []
+        if options.remove_skip_tags:
+            removals += [re.escape(tag) for tag in SKIP_TAGS.get(lang, [])]
+        removals += [pattern.pattern for pattern, _ in XML_PATTERNS]
+        if options.placeholders is not None:
+            removals.append(RUBY_PATTERN.pattern)
+        removal = "|".join(removals)
+        self.removal_pattern = re.compile(removal)
+        self.placeholder_pattern = None
+        self.leading_hash_pattern = None
+        if options.placeholders is not None:
+            # The placeholders are only replaced in the texts starting with
+            # '#' once the removals are done.
+            self.placeholder_pattern = re.compile(
+                removal + "|" + PLACEHOLDER_PATTERN.pattern
+            )
+            self.leading_hash_pattern = re.compile(f'(?:{removal})*#')
+            traveller_sex = options.placeholders[0]
+            self.sex = {
+                "PLAYERAVATAR": int(traveller_sex == "female"),
+                "MATEAVATAR": int(traveller_sex == "male"),
+            }
+        self.unreleased_tags = UNRELEASED_TAGS.get(lang, [])
+        self.quote_table = (
+            QUOTE_TABLES.get(lang) if options.replace_quotes else None
+        )
+        if self.quote_table is not None:
+            # Most texts have no quotes, and finding them is much cheaper than
+            # translating the texts.
+            self.quote_pattern = re.compile(
+                "[" + "".join(QUOTE_MAPPINGS[lang].keys()) + "]"
+            )
+        self.empty_lines_pattern = re.compile(r'\n{2,}')
+
+    def __call__(self, text: str) -> Optional[str]:
+        options = self.options
+        if options.dialog:
+            # Filter out unreleased dialogs and challenge quest dialogs.
+            lower_text = text.lower()
+            if any(tag in lower_text for tag in self.unreleased_tags):
+                return None
+            if any(pattern in text for pattern in QUEST_PLACEHOLDER_PATTERNS):
+                return None
+        if (
+            self.leading_hash_pattern is not None and
+            self.leading_hash_pattern.match(text)
+        ):
+            text = self.placeholder_pattern.sub(self._replace, text)
+            text = text[1:]  # Remove the leading '#'.
+        else:
+            text = self.removal_pattern.sub("", text)
+        # Replace quotes to a more usual version.
+        if (
+            self.quote_table is not None and
+            self.quote_pattern.search(text) is not None
+        ):
+            text = text.translate(self.quote_table)
+        # Replace escaped newline characters.
+        if options.replace_newline:
+            text = text.replace('\\n', "\n")
+        if options.trim:
+            # Remove leading and trailing newline characters and trim
+            # consecutive empty lines.
+            text = self.empty_lines_pattern.sub('\n\n', text.strip())
+        return text
+
+    def _replace(self, match) -> str:
+        placeholder = match.group("placeholder")
+        if placeholder is None:
+            return ""  # One of the removals.
+        # The tags inside the placeholder are removed as well.
+        placeholder = self.removal_pattern.sub("", placeholder)
+        traveller_sex, traveller_name, wanderer_name = \
+            self.options.placeholders
+        if "#" in placeholder:
+            first, second = placeholder.split("#")
+            if first in ["PLAYERAVATAR", "MATEAVATAR"]:
+                assert second.endswith("]"), second
+                category, choices_str = second[:-1].split("[")
+                return [
+                    PLACEHOLDERS[self.options.lang][category][choice]
+                    for choice in choices_str.split("|")
+                ][self.sex[first]]
+            elif (
+                (first == "M" and traveller_sex == "male") or
+                (first == "F" and traveller_sex == "female")
+            ):
+                return second
+            else:
+                assert first in ["M", "F"], first
+                return ""
+        elif placeholder in ["REALNAME[ID(1)|HOSTONLY(true)]",
+                             "REALNAME[ID(1)]"]:  # Wanderer
+            return wanderer_name
+        else:
+            assert placeholder == "NICKNAME", placeholder
+            return traveller_name
+
+
+# The compiled TextNormalizer of each TextOptions.
+_TEXT_NORMALIZERS: Dict[TextOptions, TextNormalizer] = {}
+
+
+def text_normalizer(options: TextOptions) -> TextNormalizer:
+    if options not in _TEXT_NORMALIZERS:
+        _TEXT_NORMALIZERS[options] = TextNormalizer(options)
+    return _TEXT_NORMALIZERS[options]
+
+
+# Default maximum number of normalized texts in the cache.
+TEXT_CACHE_SIZE = 1 << 17
+# Marks the absent keys in TextCache, since None is a valid text.
+_ABSENT = object()
+
+
+class TextCache:
+    """
+    A bounded memo of the normalized texts, keyed by the text hashes and the
+    TextOptions. The least recently used texts are dropped when it is full.
+    """
+    def __init__(self, max_size: int = TEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self.texts: "collections.OrderedDict" = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """
+        Returns the cached value of `key`, or computes and caches it by
+        calling `compute()`.
+        """
+        value = self.texts.get(key, _ABSENT)
+        if value is not _ABSENT:
+            self.hits += 1
+            self.texts.move_to_end(key)
+            return value
+        self.misses += 1
+        value = compute()
+        self.texts[key] = value
+        if len(self.texts) > self.max_size:
+            self.texts.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.texts.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class Database:
+    # Containers saved in the snapshot, i.e. the structure of the database.
+    SNAPSHOT_FIELDS = [
+        "talk_dict", "dialog_dict", "quest_dict", "subquest_dict",
+        "chapter_dict", "avatar_dict", "item_dict", "weapon_dict",
+        "reliquary_set_dict", "source_dict", "source_names", "source_links",
+        "talk2quest", "talk2subquest", "subquest2quest", "quest2sources",
+        "subquest2sources",
+    ]
+
+    def __init__(self):
+        # A TalkStore and a DialogStore after compact_records.
+        self.talk_dict: Dict[int, Talk] = {}
+        self.dialog_dict: Dict[int, Dialog] = {}
+        self.quest_dict: Dict[int, Quest] = {}
+        self.subquest_dict: Dict[int, SubQuest] = {}
+        self.chapter_dict: Dict[int, Chapter] = {}
+        self.avatar_dict: Dict[int, Avatar] = {}
+        self.item_dict: Dict[int, Item] = {}
+        self.weapon_dict: Dict[int, Weapon] = {}
+        self.reliquary_set_dict: Dict[int, ReliquarySet] = {}
+        self.source_dict: Dict[str, Source] = {}
+        # The sources are interned as dense ids, i.e. their indices in this
+        # list, which is in the order of source_dict.
+        self.source_names: List[str] = []
+        # The CSR adjacency (indptr, indices) among the source ids of each of
+        # the SOURCE_RELATIONS.
+        self.source_links: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self.npc_name_hash_map: Dict[int, int] = {}
+        self.npc_name_map: Dict[int, str] = {}
+        self.text_map: Dict[int, str] = {}  # Or a CompiledTextMap.
+        self.readable_dict: Dict[str, str] = {}
+        # The normalized texts of the text map, shared by all the exporters.
+        self.text_cache = TextCache()
+
+        self.talk2quest: Dict[int, int] = {}
+        self.talk2subquest: Dict[int, int] = {}
+        self.subquest2quest: Dict[int, int] = {}
+        self.quest2sources: Dict[int, List[str]] = {}
+        self.subquest2sources: Dict[int, List[str]] = {}
+        # The dialogs without next dialogs reachable from each initial dialog
+        # of the talks, memoized while building the sources.
+        self.end_dialogs_of_init: Dict[int, frozenset] = {}
+
+    def fork(self) -> "Database":
+        """
+        Returns a new database sharing the structure, i.e. the SNAPSHOT_FIELDS,
+        with this one, but with its own texts, so that the texts of another
+        language or version can be loaded and exported without parsing and
+        building the structure again.
+        The structure is shared rather than copied. It is not changed after
+        being built, and neither database should change it.
+        """
+        database = Database()
+        for name in self.SNAPSHOT_FIELDS:
+            setattr(database, name, getattr(self, name))
+        # The hashes of the NPC names do not depend on the texts either.
+        database.npc_name_hash_map = self.npc_name_hash_map
+        return database
+
+    def add_talk(self, talk_item: Talk):
+        talk_id = talk_item.id
+        if talk_id not in self.talk_dict:
+            self.talk_dict[talk_id] = talk_item
+        else:
+            # There is a talk with the same id. Determine whether to replace it.
+            if not talk_item == self.talk_dict[talk_id] and talk_item.trusted:
+                if self.talk_dict[talk_id].trusted:
+                    logging.error(f'Talk {talk_id} differs between '
+                                  f'{talk_item.source} and '
+                                  f'{self.talk_dict[talk_id].source}')
+                    exit(1)
+                else:
+                    self.talk_dict[talk_id] = talk_item
+
+    def add_dialog(self, dialog_item: Dialog):
+        dialog_id = dialog_item.id
         if dialog_id not in self.dialog_dict:
             self.dialog_dict[dialog_id] = dialog_item
         else:
@@ -627,7 +2797,8 @@ class Database:
                     # Try to merge them.
                     if not self.dialog_dict[dialog_id].update(dialog_item):
                         logging.error(
-                            f'Dialog {dialog_id} differs between {path} and '
+                            f'Dialog {dialog_id} differs between '
+                            f'{dialog_item.source} and '
                             f'{self.dialog_dict[dialog_id].source} :\n'
                             f'{self.dialog_dict[dialog_id]}\n{dialog_item}'
                         )
@@ -635,75 +2806,21 @@ class Database:
                 else:
                     self.dialog_dict[dialog_id] = dialog_item
 
-    def add_quest(self, data, path):
-        if "id" not in data:
-            # Deal with some special cases. These may be different for every
-            # version of game data.
-            def update(item, real_key, obfused_key, default=None):
-                if real_key not in item:
-                    if obfused_key not in item:
-                        if default is None:
-                            return False
-                        item[real_key] = default
-                    else:
-                        item[real_key] = item[obfused_key]
-                return True
-            if "CCFPGAKINNB" in data:
-                data["id"] = data["CCFPGAKINNB"]
-                update(data, "type", "JNMCHAGDLOL")
-                update(data, "titleTextMapHash", "HLAINHJACPJ")
-                update(data, "descTextMapHash", "CJBHOPEAEPN")
-                update(data, "chapterId", "FLCLAPBOOHF")
-                update(data, "subQuests", "POJOCEPJPAL")
-                for item in data["subQuests"]:
-                    update(item, "subId", "OHGOECEBPJM")
-                    update(item, "order", "NKCPJODPKPO")
-                    update(item, "descTextMapHash", "CJBHOPEAEPN")
-                    update(item, "finishCond", "AODHOADLAJC")
-                    for cond_item in item["finishCond"]:
-                        update(cond_item, "type", "JNMCHAGDLOL")
-                        update(cond_item, "param", "OBKNOBNIEGC")
-                update(data, "talks", "PCNNNPLAEAI")
-        if "suggestTrackMainQuestList" not in data:
-            data["suggestTrackMainQuestList"] = []
-        talks = []
-        if "talks" in data:
-            for item in data["talks"]:
-                self.add_talk(item, path)
-                talks.append(item["id"])
-        subquest_ids = []
-        if "subQuests" in data:
-            for item in data["subQuests"]:
-                # Finishing any talks in this list will complete the sub quest.
-                talk_ids = []
-                for cond_item in item.get("finishCond", []):
-                    if cond_item["type"] == "QUEST_CONTENT_COMPLETE_TALK":
-                        talk_ids.append(cond_item["param"][0])  # The talk id.
-                    elif cond_item["type"] == "QUEST_CONTENT_COMPLETE_ANY_TALK":
-                        talk_ids.append(-1)
-                subquest_item = SubQuest(
-                    id=item["subId"],
-                    order=item["order"],
-                    desc_text_map_hash=item.get("descTextMapHash", -1),
-                    step_desc_text_map_hash=item.get("stepDescTextMapHash", -1),
-                    talk_ids=talk_ids,
-                )
-                self.subquest_dict[item["subId"]] = subquest_item
-                subquest_ids.append(item["subId"])
-        quest_item = Quest(
-            id=data["id"],
-            # If type not presented, it is an archon quest.
-            type=data.get("type", "AQ"),
-            title_text_map_hash=data.get("titleTextMapHash", -1),
-            desc_text_map_hash=data.get("descTextMapHash", -1),
-            suggest_track_main_quest_list=data["suggestTrackMainQuestList"],
-            chapter_id=data.get("chapterId", -1),
-            sub_quests=subquest_ids,
-            talks=talks,
-            next_quests=[],  # Fill it later.
-            prev_quests=[],  # Ditto.
-        )
-        self.quest_dict[data["id"]] = quest_item
+    def add_parsed_file(self, parsed: ParsedFile):
+        """
+        Merge the records of a parsed file into the database.
+        """
+        for talk_item in parsed.talks:
+            self.add_talk(talk_item)
+        for dialog_item in parsed.dialogs:
+            self.add_dialog(dialog_item)
+        for subquest_item in parsed.sub_quests:
+            self.subquest_dict[subquest_item.id] = subquest_item
+        if parsed.quest is not None:
+            self.quest_dict[parsed.quest.id] = parsed.quest
+        if parsed.error is not None:
+            logging.error(parsed.error)
+            exit(1)
 
     def add_chapter(self, item):
         assert len(self.quest_dict) > 0, \
@@ -885,13 +3002,25 @@ class Database:
                 desc_text_map_hashs=desc_hashs,  # type: ignore
             )
 
+    def compact_records(self):
+        """
+        Convert the merged talks and dialogs into columnar stores, which take
+        much less memory than the dataclass instances. No more talks or
+        dialogs can be added after this.
+        """
+        self.talk_dict = TalkStore(list(self.talk_dict.values()))
+        self.dialog_dict = DialogStore(list(self.dialog_dict.values()))
+
     def collect_prev_talks(self):
         """
         Collect the previous talk ids for each talk.
         """
+        prev_talks_dict = {talk_id: [] for talk_id in self.talk_dict}
         for talk_id, talk in self.talk_dict.items():
             for next_talk_id in talk.next_talks:
-                self.talk_dict[next_talk_id].prev_talks.append(talk_id)
+                prev_talks_dict[next_talk_id].append(talk_id)
+        for talk_id, talk in self.talk_dict.items():
+            talk.prev_talks = list(talk.prev_talks) + prev_talks_dict[talk_id]
 
     def clean_data(self):
         """
@@ -905,27 +3034,16 @@ class Database:
             ]
 
         # Clean talks containing non-existing dialogs.
-        dialog_set_dict = {}  # talk_id: set([dialog_id1, dialog_id2, ...])
-        def dfs(dialog_id, dialog_set, talk_id):
-            dialog_set.add(dialog_id)
-            if dialog_id not in self.dialog_dict:
-                return False
-            result = True
-            for next_id in self.dialog_dict[dialog_id].next_dialogs:
-                if next_id not in dialog_set:
-                    if not dfs(next_id, dialog_set, talk_id):
-                        result = False
-            return result
-        broken_talk_set = set()
-        for talk_id, talk in self.talk_dict.items():
-            dialog_set_dict[talk_id] = set()
-            if not dfs(talk.init_dialog, dialog_set_dict[talk_id], talk_id):
-                broken_talk_set.add(talk_id)
+        # Since next_dialogs only refer to existing dialogs now, a talk reaches
+        # a non-existing dialog if and only if its init_dialog does not exist.
+        # Such a talk contains no existing dialogs, so no dialogs are removed
+        # together with it.
+        broken_talk_set = set(
+            talk_id for talk_id, talk in self.talk_dict.items()
+            if talk.init_dialog not in self.dialog_dict
+        )
         for talk_id in broken_talk_set:
             self.talk_dict.pop(talk_id)
-            for dialog_id in dialog_set_dict[talk_id]:
-                if dialog_id in self.dialog_dict:
-                    self.dialog_dict.pop(dialog_id)
         for talk in self.talk_dict.values():
             talk.next_talks = [
                 talk_id for talk_id in talk.next_talks
@@ -999,40 +3117,18 @@ class Database:
             for next_quest_id in quest.suggest_track_main_quest_list:
                 graph.add_edge(quest_id, next_quest_id)
 
-        # Deal with it per component. This greatly reduces computations.
-        components = list(nx.weakly_connected_components(graph))
-
-        for component in tqdm.tqdm(components):
-            # Iteratively remove an edge from a cycle to break it.
-            # There seems to be no smart strategies to break the cycles. To keep
-            # the algorithm deterministic, we always remove an in-edge of the
-            # node with the minimum id in the first cycle sorted in alphabetical
-            # order. The in-edge is from the predecessors (in the cycle) with
-            # the maximum id.
-            while True:
-                cycles = []
-                for cycle in nx.simple_cycles(graph.subgraph(component)):
-                    index_min = min(range(len(cycle)), key=lambda x: cycle[x])
-                    cycles.append(cycle[index_min:] + cycle[:index_min])
-                if len(cycles) == 0:
-                    break
-                nodes_in_cycle = set(sum(cycles, []))
-                victim = sorted(cycles)[0][0]
-                prev_victim = min(
-                    graph.predecessors(victim),
-                    key=lambda node: (node not in nodes_in_cycle, node)
-                )
-                graph.remove_edge(prev_victim, victim)
+        break_cycles(graph)
 
         # Now connect them.
         for quest_id, next_quest_id in graph.edges():
             self.quest_dict[next_quest_id].prev_quests.append(quest_id)
             self.quest_dict[quest_id].next_quests.append(next_quest_id)
 
-    def build_sources(self):
+    def build_sources(self, jobs: int = 1):
         """
         Build the source infos and find a minimum number of traces that covers
-        all the sentences in each source.
+        all the sentences in each source. If `jobs` > 1, the traces are found
+        by a pool of worker processes.
         """
         logging.info("Building sources and covering traces.")
 
@@ -1068,20 +3164,59 @@ class Database:
             self._reorder_player_lines_(graph)
 
         # Find the traces.
-        for source_name in tqdm.tqdm(self.source_dict):
-            preferred_starts = [
+        source_names = list(self.source_dict.keys())
+        preferred_starts_list = [
+            [
                 self.talk_dict[talk_id].init_dialog
                 for talk_id in
                     self.source_dict[source_name].talk_ids  # type: ignore
             ] if self.source_dict[source_name].talk_ids is not None else []
-            start_set, end_set = self._find_start_end(
-                graphs_dict[source_name], preferred_starts
-            )
-            self.source_dict[source_name].traces = self._find_covering_traces(
-                graphs_dict[source_name], start_set, end_set
+            for source_name in source_names
+        ]
+        if jobs > 1:
+            # Ship the graphs, which are pickled as compact arrays, the
+            # largest ones first so that no worker is left alone with a large
+            # graph at the end.
+            order = sorted(
+                range(len(source_names)),
+                key=lambda i: -graphs_dict[source_names[i]].number_of_edges()
             )
-            if len(self.source_dict[source_name].traces) == 0:
-                print(source_name)
+            tasks = [
+                (i, graphs_dict[source_names[i]], preferred_starts_list[i])
+                for i in order
+            ]
+            with multiprocessing.Pool(jobs) as pool:
+                results = sorted(tqdm.tqdm(
+                    pool.imap_unordered(find_source_traces, tasks),
+                    total=len(tasks)
+                ))
+        else:
+            results = []
+            for i in tqdm.tqdm(range(len(source_names))):
+                start = time.perf_counter()
+                graph = graphs_dict[source_names[i]]
+                start_set, end_set = self._find_start_end(
+                    graph, preferred_starts_list[i]
+                )
+                traces = self._find_covering_traces(graph, start_set, end_set)
+                results.append((i, traces, time.perf_counter() - start))
+        for i, traces, _ in results:
+            self.source_dict[source_names[i]].traces = traces
+            if len(traces) == 0:
+                print(source_names[i])
+        # Log the time spent on each source, the slowest ones first.
+        elapsed = sorted(
+            [(seconds, source_names[i]) for i, _, seconds in results],
+            reverse=True
+        )
+        logging.info(f'Found the traces of {len(results)} sources in '
+                     f'{sum(seconds for seconds, _ in elapsed):.2f}s. The '
+                     'slowest: ' + ", ".join(
+                         f'{source_name} ({seconds:.3f}s)'
+                         for seconds, source_name in elapsed[:5]
+                     ))
+        for seconds, source_name in elapsed:
+            logging.debug(f'Traces of {source_name}: {seconds:.4f}s.')
 
     def _collect_sources_from_talks(self):
         """
@@ -1089,13 +3224,12 @@ class Database:
         talks.
         """
         # Find connected talk graphs (components).
-        graph = nx.DiGraph()
-        graph.add_nodes_from(self.talk_dict.keys())
+        graph = DialogGraph(self.talk_dict.keys())
         for talk_id in self.talk_dict:
             talk = self.talk_dict[talk_id]
             graph.add_edges_from([(talk_id, next_talk_id)
                                   for next_talk_id in talk.next_talks])
-        components = list(nx.weakly_connected_components(graph))
+        components = graph.weakly_connected_components()
 
         # Determine the belonging subquest/quest of each talk (if any).
         talk_ids_rest = set()  # Talks belonging to multiple quests.
@@ -1186,10 +3320,6 @@ class Database:
                     talk_ids=component,
                     dialog_ids=set(),
                     traces=[],
-                    next_sources=[],
-                    next_sources_optional=[],
-                    prev_sources=[],
-                    prev_sources_optional=[],
                 )
                 subquest_sizes[subquest_id] += 1
             elif len(quests_belonging_to) == 1:
@@ -1213,10 +3343,6 @@ class Database:
                     talk_ids=component,
                     dialog_ids=set(),
                     traces=[],
-                    next_sources=[],
-                    next_sources_optional=[],
-                    prev_sources=[],
-                    prev_sources_optional=[],
                 )
                 quest_sizes[quest_id] += 1
             else:
@@ -1236,10 +3362,6 @@ class Database:
                     talk_ids=component,
                     dialog_ids=set(),
                     traces=[],
-                    next_sources=[],
-                    next_sources_optional=[],
-                    prev_sources=[],
-                    prev_sources_optional=[],
                 )
 
     def _collect_sources_from_dialogs(self, dialog_ids_in_talks):
@@ -1249,14 +3371,13 @@ class Database:
         Here we omit dialogs that already exist in talks.
         """
         # Find connected dialog graphs (components).
-        graph = nx.DiGraph()
         dialog_ids = set(self.dialog_dict.keys()) - set(dialog_ids_in_talks)
-        graph.add_nodes_from(dialog_ids)
+        graph = DialogGraph(dialog_ids)
         for dialog_id in dialog_ids:
             dialog = self.dialog_dict[dialog_id]
             graph.add_edges_from([(dialog_id, next_dialog_id)
                                   for next_dialog_id in dialog.next_dialogs])
-        components = list(nx.weakly_connected_components(graph))
+        components = graph.weakly_connected_components()
 
         # Collect them into source_dict.
         for component in components:
@@ -1269,58 +3390,93 @@ class Database:
                 talk_ids=None,
                 dialog_ids=component,
                 traces=[],
-                next_sources=[],
-                next_sources_optional=[],
-                prev_sources=[],
-                prev_sources_optional=[],
             )
 
+    def _iter_dialog_edges(self, dialog_id, visited):
+        """
+        Traverse the dialogs reachable from `dialog_id` in depth-first order,
+        skipping the dialogs in `visited` and adding the visited ones into it.
+        Yields each edge as (dialog_id, next_id, is_new) just before visiting
+        next_id, where is_new tells whether next_id is visited for the first
+        time.
+        Written iteratively, so long dialog chains do not hit the recursion
+        limit.
+        """
+        visited.add(dialog_id)
+        stack = [(dialog_id, iter(self.dialog_dict[dialog_id].next_dialogs))]
+        while stack:
+            node, next_ids = stack[-1]
+            next_id = next(next_ids, None)
+            if next_id is None:
+                stack.pop()
+                continue
+            is_new = next_id not in visited
+            yield node, next_id, is_new
+            if is_new:
+                visited.add(next_id)
+                stack.append(
+                    (next_id, iter(self.dialog_dict[next_id].next_dialogs))
+                )
+
+    def _find_end_dialogs(self, init_dialog) -> frozenset:
+        """
+        Returns the dialogs without next dialogs reachable from
+        `init_dialog`, memoized in `end_dialogs_of_init`. The set is filled in
+        the depth-first order, which decides its iteration order and hence the
+        order of the edges to the next talks.
+        """
+        end_dialogs = self.end_dialogs_of_init.get(init_dialog)
+        if end_dialogs is None:
+            dialog_ids = [init_dialog] + [
+                next_id for _, next_id, is_new in
+                self._iter_dialog_edges(init_dialog, set()) if is_new
+            ]
+            end_dialogs = frozenset(
+                dialog_id for dialog_id in dialog_ids
+                if len(self.dialog_dict[dialog_id].next_dialogs) == 0
+            )
+            self.end_dialogs_of_init[init_dialog] = end_dialogs
+        return end_dialogs
+
     def _build_dialog_graph_from_talks(self, talk_ids):
         """
-        Returns a networkx.DiGraph.
+        Returns a DialogGraph.
         """
-        graph = nx.DiGraph()
-        graph.add_nodes_from([self.talk_dict[talk_id].init_dialog
-                              for talk_id in talk_ids])
-        graph_talk = nx.DiGraph()
-        for talk_id in talk_ids:
-            for next_talk_id in self.talk_dict[talk_id].next_talks:
-                graph_talk.add_edge(talk_id, next_talk_id)
-        def dfs(dialog_id, visited, end_set_dialog):
-            visited.add(dialog_id)
-            if len(self.dialog_dict[dialog_id].next_dialogs) == 0:
-                end_set_dialog.add(dialog_id)
-            for next_id in self.dialog_dict[dialog_id].next_dialogs:
-                graph.add_edge(dialog_id, next_id)
-                if next_id not in visited:
-                    dfs(next_id, visited, end_set_dialog)
+        graph = DialogGraph([self.talk_dict[talk_id].init_dialog
+                             for talk_id in talk_ids])
+        # The dialogs are traversed once for all the talks. The dialogs
+        # reachable from a visited dialog are all visited, with all their
+        # edges added, so the edges are added in the same order as traversing
+        # from each talk separately.
+        visited = set()
         for talk_id in talk_ids:
-            visited = set()
-            end_set_dialog = set()
-            dfs(self.talk_dict[talk_id].init_dialog, visited, end_set_dialog)
-            for dialog_id in end_set_dialog:
-                for next_talk_id in self.talk_dict[talk_id].next_talks:
+            talk = self.talk_dict[talk_id]
+            if talk.init_dialog not in visited:
+                for prev_id, next_id, _ in self._iter_dialog_edges(
+                    talk.init_dialog, visited
+                ):
+                    graph.add_edge(prev_id, next_id)
+            if len(talk.next_talks) == 0:
+                continue
+            for dialog_id in self._find_end_dialogs(talk.init_dialog):
+                for next_talk_id in talk.next_talks:
                     graph.add_edge(dialog_id,
                                    self.talk_dict[next_talk_id].init_dialog)
         return graph
 
     def _build_dialog_graph_from_dialogs(self, dialog_ids):
         """
-        Returns a networkx.DiGraph.
+        Returns a DialogGraph.
         """
-        graph = nx.DiGraph()
-        graph.add_nodes_from(dialog_ids)
-        def dfs(dialog_id, visited):
-            visited.add(dialog_id)
-            for next_id in self.dialog_dict[dialog_id].next_dialogs:
-                graph.add_edge(dialog_id, next_id)
-                if next_id not in visited:
-                    dfs(next_id, visited)
+        graph = DialogGraph(dialog_ids)
         visited = set()
         for dialog_id in dialog_ids:
             if dialog_id in visited:
                 continue
-            dfs(dialog_id, visited)
+            for prev_id, next_id, _ in self._iter_dialog_edges(
+                dialog_id, visited
+            ):
+                graph.add_edge(prev_id, next_id)
         return graph
 
     def _reorder_player_lines_(self, graph):
@@ -1338,7 +3494,7 @@ class Database:
         3. player option 2
         4. npc line 2
 
-        This method accepts a dialog graph (as networkx.DiGraph) as input and
+        This method accepts a dialog graph (as DialogGraph) as input and
         reorder the nodes inplace.
         """
         for node in graph.nodes:
@@ -1372,12 +3528,19 @@ class Database:
                     graph.remove_edge(node, neighbors[i])
                 graph.add_edge(neighbors[i - 1], neighbors[i])
 
-    def _find_start_end(self, graph, preferred_starts):
+    @staticmethod
+    def _find_start_end(graph, preferred_starts):
         """
         Find starting and ending nodes in the graph.
         The result is guaranteed that there exists a path from one of the
         starting nodes to any node in the graph. Also, there exists a path from
         any node to one of the ending nodes.
+        The reachability is maintained over the condensation of the graph,
+        i.e. the DAG of its strongly connected components (SCCs). The nodes
+        reached from the starting nodes are closed under successors, so
+        marking the descendants of a new starting node stops at the SCCs
+        already reached, and each SCC is visited once in total. Ditto for
+        the ending nodes.
         Returns a set of starting nodes and a set of ending nodes.
         """
         start_set = set()
@@ -1388,78 +3551,116 @@ class Database:
             if graph.out_degree(node) == 0:
                 end_set.add(node)
 
+        # Build the condensation.
+        scc_of = {}  # Node -> Index of its SCC.
+        scc_sizes = []
+        for scc in graph.strongly_connected_components():
+            for node in scc:
+                scc_of[node] = len(scc_sizes)
+            scc_sizes.append(len(scc))
+        scc_successors = [set() for _ in scc_sizes]
+        scc_predecessors = [set() for _ in scc_sizes]
+        for u, v in graph.edges:
+            if scc_of[u] != scc_of[v]:
+                scc_successors[scc_of[u]].add(scc_of[v])
+                scc_predecessors[scc_of[v]].add(scc_of[u])
+
+        def mark(node, marked, scc_neighbors) -> int:
+            """
+            Mark the SCCs reachable from the SCC of `node` along
+            `scc_neighbors`. Returns the number of newly marked nodes.
+            """
+            root = scc_of[node]
+            if marked[root]:
+                return 0
+            marked[root] = True
+            num_marked = 0
+            queue = [root]
+            for scc in queue:
+                num_marked += scc_sizes[scc]
+                for next_scc in scc_neighbors[scc]:
+                    if not marked[next_scc]:
+                        marked[next_scc] = True
+                        queue.append(next_scc)
+            return num_marked
+
         # In some graphs with loops, maybe the start_set is empty or there are
         # some nodes that cannot be reached from the starting nodes. Ditto for
         # ending nodes.
         # We iteratively add starting and ending nodes until all nodes are
         # reachable from the starting nodes and can reach one of the ending
         # nodes.
-        ancestors = set.union(
-            set(),  # For cases where end_set is empty.
-            *[nx.ancestors(graph, node) for node in end_set]
-        ) | end_set
-        descendants = set.union(
-            set(),  # For cases where start_set is empty.
-            *[nx.descendants(graph, node) for node in start_set]
-        ) | start_set
-        preferred_starts = [
-            node for node in preferred_starts if node not in descendants
-        ]
-        while (
-            len(ancestors) < len(graph.nodes) or
-            len(descendants) < len(graph.nodes)
-        ):
+        num_nodes = len(graph.nodes)
+        is_descendant = [False] * len(scc_sizes)
+        is_ancestor = [False] * len(scc_sizes)
+        num_descendants = sum(
+            mark(node, is_descendant, scc_successors) for node in start_set
+        )
+        num_ancestors = sum(
+            mark(node, is_ancestor, scc_predecessors) for node in end_set
+        )
+        # Candidates of the new starting and ending nodes, where the marked
+        # ones are skipped lazily.
+        # When out_degrees equal, choose the one with minimum dialog id.
+        start_heap = [(-graph.out_degree(node), node) for node in graph.nodes]
+        heapq.heapify(start_heap)
+        end_heap = [(-graph.degree(node), -node) for node in graph.nodes]
+        heapq.heapify(end_heap)
+        preferred_i = 0
+        while num_ancestors < num_nodes or num_descendants < num_nodes:
             new_start_node = None
-            if len(descendants) < len(graph.nodes):
-                if len(preferred_starts) > 0:
+            if num_descendants < num_nodes:
+                while (
+                    preferred_i < len(preferred_starts) and
+                    is_descendant[scc_of[preferred_starts[preferred_i]]]
+                ):
+                    preferred_i += 1
+                if preferred_i < len(preferred_starts):
                     # Try the preferred starting nodes first.
-                    new_start_node = preferred_starts[0]
+                    new_start_node = preferred_starts[preferred_i]
                 else:
                     # Add a starting node by finding the node with the largest
                     # out degree. This is inspired by the fact that most loop
                     # dialogs start with a sentence with many options.
-                    subgraph = graph.subgraph(set(graph.nodes) - descendants)
-                    new_start_node = max(
-                        subgraph.nodes,
-                        # When out_degrees equal, choose the one with minimum
-                        # dialog id.
-                        key=lambda node: (graph.out_degree(node), -node)
-                    )
+                    while is_descendant[scc_of[start_heap[0][1]]]:
+                        heapq.heappop(start_heap)
+                    new_start_node = start_heap[0][1]
                 start_set.add(new_start_node)
-                descendants.add(new_start_node)
-                descendants.update(nx.descendants(graph, new_start_node))
-                preferred_starts = [
-                    node for node in preferred_starts if node not in descendants
-                ]
-            if len(ancestors) < len(graph.nodes):
-                subgraph = graph.subgraph(set(graph.nodes) - ancestors)
+                num_descendants += mark(
+                    new_start_node, is_descendant, scc_successors
+                )
+            if num_ancestors < num_nodes:
                 if (
                     new_start_node is not None and
-                    new_start_node in subgraph.nodes
+                    not is_ancestor[scc_of[new_start_node]]
                 ):
                     # If it is impossible for the new starting node to reach any
                     # ending nodes, the new starting node must be in a loop.
                     # Thus we add its predecessors as new ending nodes.
-                    predecessors = subgraph.predecessors(new_start_node)
-                    end_set.update(predecessors)
-                    for new_end_node in predecessors:
-                        ancestors.add(new_end_node)
-                        ancestors.update(nx.ancestors(graph, new_end_node))
+                    # Their ancestors are not marked here, so some of them may
+                    # still be chosen as ending nodes below, which matters for
+                    # the choices of the later ending nodes. This is kept for
+                    # the stability of the results.
+                    end_set.update(
+                        node for node in graph.predecessors(new_start_node)
+                        if not is_ancestor[scc_of[node]]
+                    )
                 else:
                     # In this case, we claim that the node with the maximum
                     # degree is possibly an ending node. This is because a node
                     # with a large degree is possibly the joint node of multiple
                     # loops.
-                    new_end_node = max(
-                        subgraph.nodes,
-                        key=lambda node: (graph.degree(node), node)
-                    )
+                    while is_ancestor[scc_of[-end_heap[0][1]]]:
+                        heapq.heappop(end_heap)
+                    new_end_node = -end_heap[0][1]
                     end_set.add(new_end_node)
-                    ancestors.add(new_end_node)
-                    ancestors.update(nx.ancestors(graph, new_end_node))
+                    num_ancestors += mark(
+                        new_end_node, is_ancestor, scc_predecessors
+                    )
         return start_set, end_set
 
-    def _find_covering_traces(self, graph, start_set, end_set):
+    @staticmethod
+    def _find_covering_traces(graph, start_set, end_set):
         """
         Find the minimal set of traces covering all the dialogs by reducing the
         problem to a minimum-cost flow problem.
@@ -1467,9 +3668,19 @@ class Database:
         Reference: https://cs.stackexchange.com/questions/107397/fewest-traversals-to-visit-all-vertices-of-dag
         A detailed explanation could be found in README.md .
 
+        Most of the graphs are acyclic, and most of them are covered without
+        revisits, for which a much faster matching based solver
+        `dag_path_cover` finds as many traces and lines, although possibly
+        not the same traces.
+
         Returns a list of lists. Each sub-list contains a trace, that is, a
         sequence of dialog ids.
         """
+        if graph.is_acyclic():
+            traces = dag_path_cover(graph, start_set, end_set)
+            if traces is not None:
+                return traces
+
         # 1. Build the auxiliary graph.
         # Since we need to split each node v into v1 and v2, we use the original
         # node label (a positive integer) to represent v1, while use the
@@ -1494,78 +3705,17 @@ class Database:
         # 2. Calculate the minimum cost flow.
         flow_dict = nx.min_cost_flow(g)
 
-        # 3. Extract the covering traces.
-        traces = []
-        for i in range(flow_dict["end"]["start"]):
-            trace = []
-            node = "start"
-            while node != "end":
-                node_next = max(
-                    flow_dict[node].keys(),
-                    key=lambda suc: (flow_dict[node][suc],
-                                     # Add a second item to the tuple to make
-                                     # the result deterministic.
-                                     suc if suc != "end" else 0)
-                )
-                assert node_next == "end" or node_next > 0  # We'll skip the
-                                                            # negative node.
-                # We do not delete the zeroed items in order to invoke max()
-                # without considering corner cases.
-                flow_dict[node][node_next] -= 1
-                if node_next == "end":
-                    break
-                else:
-                    trace.append(node_next)
-                    flow_dict[node_next][-node_next] -= 1
-                    node = -node_next  # Skip the edge in the splitted node.
-            traces.append(trace)
-        flow_dict["end"]["start"] = 0
+        # 3. Extract the covering traces and the loops.
+        traces, loops = decompose_flow(flow_dict)
 
         # 4. Deal with the loops.
-        # 4.1. Collect the loops.
-        loops = []
-        for node_start in flow_dict:
-            if node_start in ["start", "end"]:
-                continue
-            if node_start > 0:  # Skip the edge in the splitted node.
-                continue
-            while True:
-                node_next = max(
-                    flow_dict[node_start].keys(),
-                    key=lambda suc: (flow_dict[node_start][suc],
-                                     suc if suc != "end" else 0)
-                )
-                if flow_dict[node_start][node_next] == 0:
-                    # There is no more loops containing this node.
-                    break
-                # Collect a loop.
-                loop = [-node_start]
-                flow_dict[-node_start][node_start] -= 1
-                node = node_start
-                assert (
-                    node < 0 and
-                    node_next not in ["start", "end"] and
-                    node_next > 0
-                )
-                while node_next != -node_start:
-                    assert flow_dict[node][node_next] > 0
-                    flow_dict[node][node_next] -= 1
-                    loop.append(node_next)
-                    flow_dict[node_next][-node_next] -= 1
-                    node = -node_next  # Skip the edge in the splitted node.
-                    node_next = max(
-                        flow_dict[node].keys(),
-                        key=lambda suc: (flow_dict[node][suc],
-                                         suc if suc != "end" else 0)
-                    )
-                flow_dict[node][node_next] -= 1
-                loops.append(loop)
-        # 4.2. Merge the loops into existing traces, or create new traces to
-        # cover the loops.
+        # Merge the loops into existing traces, or create new traces to cover
+        # the loops.
         node2trace = {}
         for i, trace in enumerate(traces):
             for node in trace:
                 node2trace[node] = i  # We do not care about the sharing nodes.
+        linked_traces = LinkedTraces(traces)
         for loop in loops:
             trace_i = None
             for node in loop:
@@ -1574,76 +3724,59 @@ class Database:
                     break
             if trace_i is not None:
                 # Merge into an existing trace.
-                trace = traces[trace_i]
-                entrance_i = None
-                loop_node_set = set(loop)
-                for node_i, node in enumerate(trace):
-                    if node in loop_node_set:
-                        entrance_i = node_i
-                        break
-                assert entrance_i is not None
-                entrance_loc = loop.index(trace[entrance_i])
-                traces[trace_i] = (
-                    trace[:entrance_i] + loop[entrance_loc:] +
-                    loop[:entrance_loc] + trace[entrance_i:]
-                )
+                linked_traces.splice(trace_i, loop)
             else:
                 # Create a new trace.
-                # Directly exploit the input graph to do our business. Recover
-                # it later.
-                # 1. Find the first half path.
-                assert "start" not in graph.nodes and "end" not in graph.nodes
-                for node in start_set:
-                    graph.add_edge("start", node)
-                for node in loop:
-                    graph.add_edge(node, "end")
-                path1 = nx.shortest_path(graph, "start", "end")[1:-1]
+                # 1. Find the first half path, from a starting node to the
+                # loop.
+                path1 = graph.shortest_path(
+                    list(start_set), list(dict.fromkeys(loop))
+                )
                 assert len(path1) == 1 or path1[-2] not in loop
                 entrance_loc = loop.index(path1[-1])
-                graph.remove_node("start")
-                graph.remove_node("end")
                 # 2. Find the second half path.
                 exit_loc = (entrance_loc - 1 + len(loop)) % len(loop)
-                for node in end_set:
-                    graph.add_edge(node, "end")
-                path2 = nx.shortest_path(graph, loop[exit_loc], "end")[1:-1]
-                graph.remove_node("end")
+                path2 = graph.shortest_path(loop[exit_loc], list(end_set))[1:]
                 # 3. Concatenate them.
-                traces.append(
+                new_trace = (
                     path1 + loop[entrance_loc + 1:] + loop[:entrance_loc] +
                     path2
                 )
+                linked_traces.append(new_trace)
                 # 4. Update node2trace.
-                for node in traces[-1]:
-                    node2trace[node] = len(traces) - 1
-        return traces
+                for node in new_trace:
+                    node2trace[node] = len(linked_traces) - 1
+        return linked_traces.to_lists()
 
     def connect_sources(self):
         """
-        Fill the `prev_sources`, `prev_sources_optional`, `next_sources` and
-        `next_sources_optional` fields of the sources.
+        Intern the sources as dense ids and build `source_links`, i.e. the
+        connections of SOURCE_RELATIONS among them.
         """
         logging.info("Building connections among the sources.")
+        self.source_names = list(self.source_dict.keys())
+        # The connections as (source id, connected source id) pairs.
+        pairs = {relation: [] for relation in SOURCE_RELATIONS}
         # We arrange the sources by the order numbers.
         sources = {
-            # The inner dict has key as order and value as list of source names.
+            # The inner dict has key as order and value as list of source ids.
             quest_id: {} for quest_id in self.quest_dict
         }
         sources_before = {quest_id: {} for quest_id in self.quest_dict}  # ditto
         sources_after = {quest_id: {} for quest_id in self.quest_dict}  # ditto
 
         # Collect the sources with a pre-assigned order.
-        for source_name, source in self.source_dict.items():
+        for source_id, source in enumerate(self.source_dict.values()):
             if source.order < 0 or source.quest_id < 0:
                 continue
             sources[source.quest_id].setdefault(source.order, []).append(
-                source_name
+                source_id
             )
 
         # As for other sources belonging to some quest but not having an order,
         # arrange them by the beginning conditions of the talks belonging to
         # them.
-        for source_name, source in self.source_dict.items():
+        for source_id, source in enumerate(self.source_dict.values()):
             if source.order >= 0 or source.quest_id < 0:
                 continue
             begin_conds = [
@@ -1656,7 +3789,7 @@ class Database:
                 # No beginning conditions means this source could be triggered
                 # at the very first of the quest.
                 sources_before[source.quest_id].setdefault(0, []).append(
-                    source_name
+                    source_id
                 )
                 continue
 
@@ -1716,18 +3849,17 @@ class Database:
                 if range_start[1] == -1:
                     sources_before[source.quest_id].setdefault(
                         range_start[0], []
-                    ).append(source_name)
+                    ).append(source_id)
                 else:
                     sources_after[source.quest_id].setdefault(
                         range_start[0], []
-                    ).append(source_name)
+                    ).append(source_id)
             else:
                 sources_after[source.quest_id].setdefault(
                     sys.maxsize, []
-                ).append(source_name)
+                ).append(source_id)
 
-        # Fill the `prev_sources`, `prev_sources_optional`, `next_sources` and
-        # `next_sources_optional` fields.
+        # Collect the connections of SOURCE_RELATIONS.
         for quest_id in self.quest_dict:
             srcs = sources[quest_id]
             if len(srcs) == 0:
@@ -1736,30 +3868,34 @@ class Database:
             for o1, o2 in zip(orders[:-1], orders[1:]):
                 for s1 in srcs[o1]:
                     for s2 in srcs[o2]:
-                        self.source_dict[s1].next_sources.append(s2)
-                        self.source_dict[s2].prev_sources.append(s1)
+                        pairs["next_sources"].append((s1, s2))
+                        pairs["prev_sources"].append((s2, s1))
             srcs_b = sources_before[quest_id]
             srcs_a = sources_after[quest_id]
             for order, src_list in srcs_b.items():
                 loc = bisect.bisect_left(orders, order)
                 if loc < len(orders):
-                    for source_name in srcs[orders[loc]]:
-                        self.source_dict[source_name].prev_sources_optional\
-                            .extend(src_list)
+                    for s1 in srcs[orders[loc]]:
+                        pairs["prev_sources_optional"].extend(
+                            (s1, s2) for s2 in src_list
+                        )
                 else:
-                    for source_name in srcs[orders[-1]]:
-                        self.source_dict[source_name].next_sources_optional\
-                            .extend(src_list)
+                    for s1 in srcs[orders[-1]]:
+                        pairs["next_sources_optional"].extend(
+                            (s1, s2) for s2 in src_list
+                        )
             for order, src_list in srcs_a.items():
                 loc = bisect.bisect_right(orders, order) - 1
                 if loc >= 0:
-                    for source_name in srcs[orders[loc]]:
-                        self.source_dict[source_name].next_sources_optional\
-                            .extend(src_list)
+                    for s1 in srcs[orders[loc]]:
+                        pairs["next_sources_optional"].extend(
+                            (s1, s2) for s2 in src_list
+                        )
                 else:
-                    for source_name in srcs[orders[0]]:
-                        self.source_dict[source_name].prev_sources_optional\
-                            .extend(src_list)
+                    for s1 in srcs[orders[0]]:
+                        pairs["prev_sources_optional"].extend(
+                            (s1, s2) for s2 in src_list
+                        )
 
         # Finally, connect the sources across quests.
         for quest_id, quest in self.quest_dict.items():
@@ -1776,31 +3912,180 @@ class Database:
                 srcs_next = sources[next_quest_id]
                 for s1 in last_source_ids:
                     for s2 in srcs_next[min(srcs_next.keys())]:
-                        self.source_dict[s1].next_sources.append(s2)
-                        self.source_dict[s2].prev_sources.append(s1)
+                        pairs["next_sources"].append((s1, s2))
+                        pairs["prev_sources"].append((s2, s1))
+
+        # The same connection may be collected several times, e.g. when a
+        # quest is listed twice in the next quests. They are dropped here.
+        self.source_links = {
+            relation: build_csr(len(self.source_names), pairs[relation])
+            for relation in SOURCE_RELATIONS
+        }
 
-    def load_text_map(self, filepath):
-        with open(filepath, "r", encoding="utf-8") as f:
-            text_map = json.load(f)
-        self.text_map = {int(key): value for key, value in text_map.items()}
+    def save_snapshot(self, filepath, fingerprint: str):
+        """
+        Save the structure of the database, i.e. everything built before
+        loading the texts.
+        The file contains two pickles: a small header and the containers. This
+        enables checking the header without loading the containers.
+        """
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        temp_path = f'{filepath}.{os.getpid()}.tmp'
+        with open(temp_path, "wb") as f:
+            pickle.dump({
+                "version": SNAPSHOT_VERSION,
+                "fingerprint": fingerprint,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump({
+                name: getattr(self, name) for name in self.SNAPSHOT_FIELDS
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, filepath)
+
+    def load_snapshot(self, filepath, fingerprint: str) -> bool:
+        """
+        Load the snapshot saved by `save_snapshot`. Returns False without
+        changing anything if the snapshot is absent or does not match the
+        fingerprint.
+        """
+        if not os.path.exists(filepath):
+            return False
+        with open(filepath, "rb") as f:
+            try:
+                header = pickle.load(f)
+            except Exception:
+                return False
+            if (
+                not isinstance(header, dict) or
+                header.get("version") != SNAPSHOT_VERSION or
+                header.get("fingerprint") != fingerprint
+            ):
+                return False
+            state = pickle.load(f)
+        for name in self.SNAPSHOT_FIELDS:
+            setattr(self, name, state[name])
+        return True
 
-    def load_npc_name(self, filepath):
-        assert len(self.text_map) > 0, \
-            "TextMap must be loaded before exporting the dialogs."
-        with open(filepath, "r", encoding="utf-8") as f:
-            data = json.load(f)
+    def collect_text_map_hashes(self) -> Set[int]:
+        """
+        Collect the hashes of all texts that may be exported, so that only
+        these texts are loaded from the TextMap.
+        """
+        hashes = set()
+        for dialog in self.dialog_dict.values():
+            hashes.add(dialog.talk_content_text_map_hash)
+            hashes.add(dialog.talk_role_name_text_map_hash)
+        for quest in self.quest_dict.values():
+            hashes.add(quest.title_text_map_hash)
+            hashes.add(quest.desc_text_map_hash)
+        for subquest in self.subquest_dict.values():
+            hashes.add(subquest.desc_text_map_hash)
+            hashes.add(subquest.step_desc_text_map_hash)
+        for chapter in self.chapter_dict.values():
+            hashes.add(chapter.chapter_num_text_map_hash)
+            hashes.add(chapter.chapter_title_text_map_hash)
+            hashes.add(chapter.chapter_image_title_text_map_hash)
+        for avatar in self.avatar_dict.values():
+            hashes.update([
+                avatar.name_text_map_hash,
+                avatar.desc_text_map_hash,
+                avatar.native_text_map_hash,
+                avatar.vision_befor_text_map_hash,
+                avatar.vision_after_text_map_hash,
+                avatar.vision_name_befor_text_map_hash,
+                avatar.vision_name_after_text_map_hash,
+                avatar.constellation_befor_text_map_hash,
+                avatar.constellation_after_text_map_hash,
+                avatar.title_text_map_hash,
+                avatar.detail_text_map_hash,
+            ])
+            for _, topic_hash, content_hash in avatar.voice_texts:
+                hashes.add(topic_hash)
+                hashes.add(content_hash)
+            for title_hash, content_hash in avatar.stories:
+                hashes.add(title_hash)
+                hashes.add(content_hash)
+        for item in self.item_dict.values():
+            hashes.add(item.name_text_map_hash)
+            hashes.add(item.desc1_text_map_hash)
+            hashes.add(item.desc2_text_map_hash)
+        for weapon in self.weapon_dict.values():
+            hashes.add(weapon.name_text_map_hash)
+            hashes.add(weapon.desc_text_map_hash)
+        for reliquary_set in self.reliquary_set_dict.values():
+            hashes.add(reliquary_set.set_name_text_map_hash)
+            hashes.update(reliquary_set.name_text_map_hashs)
+            hashes.update(reliquary_set.desc_text_map_hashs)
+        hashes.update(self.npc_name_hash_map.values())
+        hashes.discard(None)  # Absent reliquary parts.
+        return hashes
+
+    def load_text_map(
+        self,
+        filepath,
+        filter_hashes: bool = True,
+        cache_dir: Optional[str] = None,
+    ):
+        """
+        Load the TextMap and resolve the NPC names.
+        If cache_dir is given, the TextMap is compiled into a binary file there
+        and looked up with mmap, so it is parsed only when it changes.
+        Otherwise, if filter_hashes is True, only the texts referenced by the
+        database are kept.
+        """
+        if cache_dir is not None:
+            # Different data directories get different caches.
+            path_digest = hashlib.blake2b(
+                os.path.abspath(filepath).encode("utf-8"), digest_size=4
+            ).hexdigest()
+            cache_path = os.path.join(
+                cache_dir,
+                os.path.splitext(os.path.basename(filepath))[0] +
+                f'.{path_digest}.bin'
+            )
+            self.text_map = CompiledTextMap.load(filepath, cache_path)
+            logging.info(f'Opened {len(self.text_map)} texts from '
+                         f'{cache_path}')
+        elif filter_hashes:
+            hashes = self.collect_text_map_hashes()
+            self.text_map = dict(stream_text_map(filepath, hashes))
+            logging.info(f'Loaded {len(self.text_map)} texts referenced by '
+                         f'{len(hashes)} hashes from {filepath}')
+        else:
+            text_map = load_json(filepath)
+            self.text_map = {
+                int(key): value for key, value in text_map.items()
+            }
+        self.text_cache.clear()
+        npc_ids = list(self.npc_name_hash_map.keys())
+        if isinstance(self.text_map, CompiledTextMap):
+            names = self.text_map.get_many(self.npc_name_hash_map.values())
+        else:
+            names = [self.text_map.get(name_hash)
+                     for name_hash in self.npc_name_hash_map.values()]
+        self.npc_name_map = {
+            npc_id: name for npc_id, name in zip(npc_ids, names)
+            if name is not None and len(name) > 0
+        }
+
+    def load_npc_name(self, filepath):
+        """
+        Collect the name hashes of the NPCs. The names are resolved when the
+        TextMap is loaded.
+        """
+        data = load_json(filepath)
         for item in data:
-            if (
-                "nameTextMapHash" in item and
-                item["nameTextMapHash"] in self.text_map and
-                len(self.text_map[item["nameTextMapHash"]]) > 0
-            ):
-                self.npc_name_map[item["id"]] = \
-                    self.text_map[item["nameTextMapHash"]]
+            if "nameTextMapHash" in item:
+                self.npc_name_hash_map[item["id"]] = item["nameTextMapHash"]
 
-    def load_readable(self, source_dir):
+    def load_readable(self, source_dir, prefixes: Tuple[str, ...] = ("",)):
+        """
+        Load the readables whose names start with any of `prefixes`.
+        """
         for filename in os.listdir(source_dir):
-            if not filename.endswith(".txt"):
+            if (
+                not filename.endswith(".txt") or
+                not filename.startswith(prefixes)
+            ):
                 continue
             readable_name = filename[:-4]
             with open(
@@ -1810,7 +4095,7 @@ class Database:
 
     def export_dialogs(
         self,
-        filepath: str,
+        filepath: Optional[str],
         lang: str,
         traveller_sex: str,
         traveller_name: str,
@@ -1823,27 +4108,51 @@ class Database:
         replace_newline: bool,
         remove_broken_trace: bool,
         remove_absent_text: bool,
-    ):
+        compact: bool = False,
+        compact_edges: bool = False,
+    ) -> Optional[dict]:
+        """
+        Export the dialogs into `filepath`, or return them if it is None.
+        """
         assert len(self.text_map) > 0, \
             "TextMap must be loaded before exporting the dialogs."
 
         result = {}
 
         # Export dialogs.
-        logging.info(f'Exporting dialogs to {filepath}')
-        valid_source_names = set()
-        for source_name, source in tqdm.tqdm(self.source_dict.items()):
+        logging.info('Exporting dialogs.')
+        content_options = TextOptions(
+            lang=lang,
+            replace_quotes=replace_quotes,
+            replace_newline=replace_newline,
+            placeholders=(traveller_sex, traveller_name, wanderer_name),
+            dialog=True,
+        )
+        unknown_content = self.normalize_text(unknown_text, content_options)
+        quote_table = QUOTE_TABLES.get(lang) if replace_quotes else None
+        # The exported sources, by their ids.
+        valid = np.zeros(len(self.source_names), dtype=bool)
+        exported_items = []
+        for source_id, source_name in enumerate(tqdm.tqdm(self.source_names)):
+            source = self.source_dict[source_name]
             source_item = {}
             source_item["quest_id"] = source.quest_id
             source_item["subquest_id"] = source.subquest_id
-            source_item["prev_sources"] = source.prev_sources
-            source_item["prev_sources_optional"] = source.prev_sources_optional
-            source_item["next_sources"] = source.next_sources
-            source_item["next_sources_optional"] = source.next_sources_optional
+            # Filled after all the sources are exported.
+            for relation in SOURCE_RELATIONS:
+                source_item[relation] = []
             traces_item = []
+            # The resolved line of each dialog in the traces of this source.
+            # The line of a dialog never depends on the trace it is in, so
+            # the dialogs shared by several traces are only resolved once.
+            line_of_dialog = {}
             for trace in source.traces:
                 trace_item = []
                 for dialog_id in trace:
+                    if dialog_id in line_of_dialog:
+                        line = line_of_dialog[dialog_id]
+                        trace_item.append((dialog_id, line))
+                        continue
                     dialog = self.dialog_dict[dialog_id]
                     role_name_hash = dialog.talk_role_name_text_map_hash
                     content_hash = dialog.talk_content_text_map_hash
@@ -1870,86 +4179,68 @@ class Database:
                         content_hash in self.text_map and
                         len(self.text_map[content_hash]) > 0
                     ):
-                        content = self.text_map[content_hash]
+                        content = self.get_text(content_hash, content_options)
                     elif not remove_absent_text:
-                        content = unknown_text
+                        content = unknown_content
                     else:
-                        content = None
-                    # Filter out absent sentences.
-                    if content is None:
+                        # Filter out absent sentences.
                         if remove_broken_trace:
                             break
                         continue
-                    # Filter out unreleased dialogs.
-                    if (
+                    # Filter out unreleased dialogs and challenge quest
+                    # dialogs.
+                    if content is None or (
                         lang in UNRELEASED_TAGS and
-                        (
-                            any([tag in content.lower()
-                                 for tag in UNRELEASED_TAGS[lang]]) or
-                            any([tag in role.lower()
-                                 for tag in UNRELEASED_TAGS[lang]])
-                        )
-                    ):
-                        break
-                    # Remove XML tags.
-                    for pattern, target in XML_PATTERNS:
-                        content = pattern.sub(target, content)
-                    # Filter out challenge quest dialogs.
-                    if any(
-                        pattern in content
-                        for pattern in QUEST_PLACEHOLDER_PATTERNS
+                        any([tag in role.lower()
+                             for tag in UNRELEASED_TAGS[lang]])
                     ):
                         break
-                    # Replace placeholders.
-                    content = self._replace_placeholders(
-                        content, lang, traveller_sex, traveller_name,
-                        wanderer_name
-                    )
                     # Replace quotes to a more usual version.
-                    if replace_quotes and lang in QUOTE_MAPPINGS:
-                        for quote, target in QUOTE_MAPPINGS[lang].items():
-                            role = role.replace(quote, target)
-                            content = content.replace(quote, target)
-                    # Replace escaped newline characters.
-                    if replace_newline:
-                        content = content.replace('\\n', "\n")
+                    if quote_table is not None:
+                        role = role.translate(quote_table)
                     # Drop empty sentences.
                     if len(content) == 0:
                         continue
-                    trace_item.append({
+                    line_of_dialog[dialog_id] = {
                         "role": role,
                         "content": content,
-                    })
+                    }
+                    trace_item.append((dialog_id, line_of_dialog[dialog_id]))
                 else:
                     if len(trace_item) > 0:
                         traces_item.append(trace_item)
-            source_item["traces"] = traces_item
+            if compact:
+                source_item.update(compact_traces(traces_item, compact_edges))
+            else:
+                source_item["traces"] = [
+                    [line for _, line in trace_item]
+                    for trace_item in traces_item
+                ]
             if len(traces_item) > 0:
                 result[source_name] = source_item
-                valid_source_names.add(source_name)
+                valid[source_id] = True
+                exported_items.append((source_id, source_item))
 
-        # Remove invalid sources from prev_sources and next_sources.
+        # Fill the connections to the other sources, where the sources not
+        # exported are removed. The names are only materialized here.
         logging.info(f'Removing invalid sources.')
-        for source_item in tqdm.tqdm(result.values()):
-            source_item["prev_sources"] = [
-                s for s in source_item["prev_sources"]
-                if s in valid_source_names
-            ]
-            source_item["prev_sources_optional"] = [
-                s for s in source_item["prev_sources_optional"]
-                if s in valid_source_names
-            ]
-            source_item["next_sources"] = [
-                s for s in source_item["next_sources"]
-                if s in valid_source_names
-            ]
-            source_item["next_sources_optional"] = [
-                s for s in source_item["next_sources_optional"]
-                if s in valid_source_names
-            ]
+        for relation in SOURCE_RELATIONS:
+            indptr, indices = self.source_links[relation]
+            keep = valid[indices]
+            indptr = np.concatenate([[0], np.cumsum(keep)])[indptr].tolist()
+            names = [self.source_names[i] for i in indices[keep].tolist()]
+            for source_id, source_item in exported_items:
+                source_item[relation] = \
+                    names[indptr[source_id]:indptr[source_id + 1]]
 
         # Export avatar voice texts.
-        logging.info(f'Exporting avatar voice texts to {filepath}')
+        logging.info('Exporting avatar voice texts.')
+        voice_options = TextOptions(
+            lang=lang,
+            replace_quotes=False,
+            replace_newline=False,
+            placeholders=(traveller_sex, "{NICKNAME}", wanderer_name),
+        )
         traveller_id_ignore = (
             AVATAR_ID_LUMINE if traveller_sex == "male" else
             AVATAR_ID_AETHER
@@ -1997,15 +4288,10 @@ class Database:
                     )
                 ):
                     continue
-                # Remove XML tags.
-                for pattern, target in XML_PATTERNS:
-                    content = pattern.sub(target, content)
-                # Replace placeholders. Do not replace the traveller's name here
-                # because we need it when dealing with dialogs in the voice
-                # text.
-                content = self._replace_placeholders(
-                    content, lang, traveller_sex, "{NICKNAME}", wanderer_name
-                )
+                # Remove XML tags and replace placeholders. Do not replace the
+                # traveller's name here because we need it when dealing with
+                # dialogs in the voice text.
+                content = self.normalize_text(content, voice_options)
                 # Drop empty sentences.
                 if len(content) == 0:
                     continue
@@ -2062,14 +4348,11 @@ class Database:
                         "{NICKNAME}", traveller_name
                     )
                     # Replace quotes to a more usual version.
-                    if replace_quotes and lang in QUOTE_MAPPINGS:
-                        for quote, target in QUOTE_MAPPINGS[lang].items():
-                            dialog["role"] = dialog["role"].replace(
-                                quote, target
-                            )
-                            dialog["content"] = dialog["content"].replace(
-                                quote, target
-                            )
+                    if quote_table is not None:
+                        dialog["role"] = dialog["role"].translate(quote_table)
+                        dialog["content"] = dialog["content"].translate(
+                            quote_table
+                        )
                     # Replace escaped newline characters. We do this in
                     # post-processing because the newline character should be
                     # consistent when splitting the content for special cases.
@@ -2077,55 +4360,49 @@ class Database:
                         dialog["content"] = dialog["content"].replace(
                             '\\n', "\n"
                         )
-                source_item["traces"] = [trace]
+                if compact:
+                    # The lines of avatar voice texts are not dialogs.
+                    source_item.update(compact_traces(
+                        [[(-1, line) for line in trace]], compact_edges
+                    ))
+                else:
+                    source_item["traces"] = [trace]
                 result[f'avatar_{avatar_id}_voice_{i}'] = source_item
 
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        if filepath is None:
+            return result
+        write_json(result, filepath, compact)
 
-    def _replace_placeholders(
-        self,
-        content: str,
-        lang: str,
-        traveller_sex: str,
-        traveller_name: str,
-        wanderer_name: str,
-    ):
-        for match in RUBY_PATTERN.findall(content):
-            content = content.replace("{RUBY#[D]" + match + "}", "")
-        if not content.startswith("#"):
-            return content
-        sex = {
-            "PLAYERAVATAR": int(traveller_sex == "female"),
-            "MATEAVATAR": int(traveller_sex == "male"),
-        }
-        for placeholder in PLACEHOLDER_PATTERN.findall(content):
-            if "#" in placeholder:
-                first, second = placeholder.split("#")
-                if first in ["PLAYERAVATAR", "MATEAVATAR"]:
-                    assert second.endswith("]"), second
-                    category, choices_str = second[:-1].split("[")
-                    target = [
-                        PLACEHOLDERS[lang][category][choice]
-                        for choice in choices_str.split("|")
-                    ][sex[first]]
-                elif (
-                    (first == "M" and traveller_sex == "male") or
-                    (first == "F" and traveller_sex == "female")
-                ):
-                    target = second
-                else:
-                    assert first in ["M", "F"], first
-                    target = ""
-            elif placeholder in ["REALNAME[ID(1)|HOSTONLY(true)]",
-                                 "REALNAME[ID(1)]"]:  # Wanderer
-                target = wanderer_name
-            else:
-                assert placeholder == "NICKNAME", content
-                target = traveller_name
-            content = content.replace("{" + placeholder + "}", target)
-        content = content[1:]  # Remove the leading '#'.
-        return content
+    def normalize_text(self, text: str, options: TextOptions) -> Optional[str]:
+        """
+        Post-process a text for the output, i.e. remove the XML tags, and
+        replace the placeholders, the quotes and the escaped newline characters
+        as the options tell. See TextNormalizer.
+        """
+        return text_normalizer(options)(text)
+
+    def get_text(self, text_hash: int, options: TextOptions) -> Optional[str]:
+        """
+        The normalized text of `text_hash`, which must be in the text map.
+        The texts are memoized in `text_cache`.
+        """
+        return self.text_cache.get(
+            (text_hash, options),
+            lambda: self.normalize_text(self.text_map[text_hash], options),
+        )
+
+    def lookup_text(
+        self, text_hash: Optional[int], options: TextOptions, default: str
+    ) -> Optional[str]:
+        """
+        The normalized text of `text_hash`, or `default` if it is not in the
+        text map. A None hash means there is no text, and None is returned.
+        """
+        if text_hash is None:
+            return None
+        if text_hash not in self.text_map:
+            return default
+        return self.get_text(text_hash, options)
 
     def _split_voice_text(self, text, traveller_name, names_in_voice_text=None):
         """
@@ -2168,7 +4445,7 @@ class Database:
 
     def export_quests(
         self,
-        filepath: str,
+        filepath: Optional[str],
         lang: str,
         traveller_sex: str,
         traveller_name: str,
@@ -2176,8 +4453,19 @@ class Database:
         unknown_text: str,
         replace_quotes: bool,
         replace_newline: bool,
-    ):
-        logging.info(f'Exporting quests to {filepath}')
+    ) -> Optional[dict]:
+        """
+        Export the quests into `filepath`, or return them if it is None.
+        """
+        logging.info('Exporting quests.')
+        options = TextOptions(
+            lang=lang,
+            replace_quotes=replace_quotes,
+            replace_newline=replace_newline,
+            placeholders=(traveller_sex, traveller_name, wanderer_name),
+        )
+        subquest_options = dataclasses.replace(options, remove_skip_tags=True)
+        unknown = self.normalize_text(unknown_text, options)
 
         chapters = {}
         chapter_ids = sorted(self.chapter_dict.keys())
@@ -2198,31 +4486,19 @@ class Database:
                 )
             ):
                 continue
-            # Hide texts containing hidden tags.
-            if any(tag in number for tag in HIDDEN_TAGS):
-                number = unknown_text
-            if any(tag in title for tag in HIDDEN_TAGS):
-                title = unknown_text
-            # Remove XML tags.
-            for pattern, target in XML_PATTERNS:
-                number = pattern.sub(target, number)
-                title = pattern.sub(target, title)
-            # Replace placeholders.
-            number = self._replace_placeholders(
-                number, lang, traveller_sex, traveller_name, wanderer_name
+            # Hide absent texts and texts containing hidden tags.
+            number = (
+                self.get_text(chapter.chapter_num_text_map_hash, options)
+                if chapter.chapter_num_text_map_hash in self.text_map and
+                not any(tag in number for tag in HIDDEN_TAGS) else
+                unknown
             )
-            title = self._replace_placeholders(
-                title, lang, traveller_sex, traveller_name, wanderer_name
+            title = (
+                self.get_text(chapter.chapter_title_text_map_hash, options)
+                if chapter.chapter_title_text_map_hash in self.text_map and
+                not any(tag in title for tag in HIDDEN_TAGS) else
+                unknown
             )
-            # Replace quotes to a more usual version.
-            if replace_quotes and lang in QUOTE_MAPPINGS:
-                for quote, target in QUOTE_MAPPINGS[lang].items():
-                    number = number.replace(quote, target)
-                    title = title.replace(quote, target)
-            # Replace escaped newline characters.
-            if replace_newline:
-                number = number.replace('\\n', "\n")
-                title = title.replace('\\n', "\n")
             # Collect related info.
             chapters[str(chapter_id)] = {
                 "group_id": chapter.group_id,
@@ -2252,31 +4528,19 @@ class Database:
                 )
             ):
                 continue
-            # Hide texts containing hidden tags.
-            if any(tag in title for tag in HIDDEN_TAGS):
-                title = unknown_text
-            if any(tag in description for tag in HIDDEN_TAGS):
-                description = unknown_text
-            # Remove XML tags.
-            for pattern, target in XML_PATTERNS:
-                title = pattern.sub(target, title)
-                description = pattern.sub(target, description)
-            # Replace placeholders.
-            title = self._replace_placeholders(
-                title, lang, traveller_sex, traveller_name, wanderer_name
+            # Hide absent texts and texts containing hidden tags.
+            title = (
+                self.get_text(quest.title_text_map_hash, options)
+                if quest.title_text_map_hash in self.text_map and
+                not any(tag in title for tag in HIDDEN_TAGS) else
+                unknown
             )
-            description = self._replace_placeholders(
-                description, lang, traveller_sex, traveller_name, wanderer_name
+            description = (
+                self.get_text(quest.desc_text_map_hash, options)
+                if quest.desc_text_map_hash in self.text_map and
+                not any(tag in description for tag in HIDDEN_TAGS) else
+                unknown
             )
-            # Replace quotes to a more usual version.
-            if replace_quotes and lang in QUOTE_MAPPINGS:
-                for quote, target in QUOTE_MAPPINGS[lang].items():
-                    title = title.replace(quote, target)
-                    description = description.replace(quote, target)
-            # Replace escaped newline characters.
-            if replace_newline:
-                title = title.replace('\\n', "\n")
-                description = description.replace('\\n', "\n")
             # Collect related info.
             quests[str(quest_id)] = {
                 "type": quest.type,
@@ -2315,43 +4579,24 @@ class Database:
                 )
             ):
                 continue
-            # Remove the skipping tags.
-            if lang in SKIP_TAGS:
-                for tag in SKIP_TAGS[lang]:
-                    description = description.replace(tag, "")
-            # Hide texts containing hidden tags.
-            if any(tag in description for tag in HIDDEN_TAGS):
-                description = unknown_text
-            if step_description is not None:
-                if any(tag in step_description for tag in HIDDEN_TAGS):
-                    step_description = None
-            # Remove XML tags.
-            for pattern, target in XML_PATTERNS:
-                description = pattern.sub(target, description)
-                if step_description is not None:
-                    step_description = pattern.sub(target, step_description)
-            # Replace placeholders.
-            description = self._replace_placeholders(
-                description, lang, traveller_sex, traveller_name, wanderer_name
-            )
+            # Hide absent texts and texts containing hidden tags. The
+            # skipping tags are removed from the description.
+            if subquest.desc_text_map_hash not in self.text_map:
+                description = self.normalize_text(
+                    unknown_text, subquest_options
+                )
+            elif any(tag in description for tag in HIDDEN_TAGS):
+                description = unknown
+            else:
+                description = self.get_text(
+                    subquest.desc_text_map_hash, subquest_options
+                )
             if step_description is not None:
-                step_description = self._replace_placeholders(
-                    step_description, lang, traveller_sex, traveller_name,
-                    wanderer_name
+                step_description = (
+                    self.get_text(subquest.step_desc_text_map_hash, options)
+                    if not any(tag in step_description for tag in HIDDEN_TAGS)
+                    else None
                 )
-            # Replace quotes to a more usual version.
-            if replace_quotes and lang in QUOTE_MAPPINGS:
-                for quote, target in QUOTE_MAPPINGS[lang].items():
-                    description = description.replace(quote, target)
-                    if step_description is not None:
-                        step_description = step_description.replace(
-                            quote, target
-                        )
-            # Replace escaped newline characters.
-            if replace_newline:
-                description = description.replace('\\n', "\n")
-                if step_description is not None:
-                    step_description = step_description.replace('\\n', "\n")
             # Collect related info.
             subquests[str(subquest_id)] = {
                 "description": description,
@@ -2376,12 +4621,13 @@ class Database:
             "quests": quests,
             "subquests": subquests,
         }
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(result, f, indent=2, ensure_ascii=False)
+        if filepath is None:
+            return result
+        write_json(result, filepath)
 
     def export_avatars(
         self,
-        filepath,
+        filepath: Optional[str],
         lang: str,
         traveller_sex: str,
         traveller_name: str,
@@ -2390,28 +4636,20 @@ class Database:
         unknown_text: str,
         replace_quotes: bool,
         replace_newline: bool,
-    ):
-        logging.info(f'Exporting avatars\' info to {filepath}')
-
-        def get(text_hash, default_text=unknown_text):
-            if text_hash not in self.text_map:
-                return default_text
-            text = self.text_map[text_hash]
-            # Remove XML tags.
-            for pattern, target in XML_PATTERNS:
-                text = pattern.sub(target, text)
-            # Replace placeholders.
-            text = self._replace_placeholders(
-                text, lang, traveller_sex, traveller_name, wanderer_name
-            )
-            # Replace quotes to a more usual version.
-            if replace_quotes and lang in QUOTE_MAPPINGS:
-                for quote, target in QUOTE_MAPPINGS[lang].items():
-                    text = text.replace(quote, target)
-            # Replace escaped newline characters.
-            if replace_newline:
-                text = text.replace('\\n', "\n")
-            return text
+    ) -> Optional[List[dict]]:
+        """
+        Export the avatars' info into `filepath`, or return it if it is None.
+        """
+        logging.info('Exporting avatars\' info.')
+        options = TextOptions(
+            lang=lang,
+            replace_quotes=replace_quotes,
+            replace_newline=replace_newline,
+            placeholders=(traveller_sex, traveller_name, wanderer_name),
+        )
+
+        def get(text_hash, default=unknown_text):
+            return self.lookup_text(text_hash, options, default)
 
         def list_get(l, index, default):
             return l[index] if len(l) > index else default
@@ -2459,8 +4697,9 @@ class Database:
         } for avatar in tqdm.tqdm(self.avatar_dict.values())
           if avatar.id != traveller_id_ignore and
              avatar.id not in AVATAR_ID_BLACKLIST]
-        df = pd.DataFrame.from_dict(result)
-        df.to_csv(filepath, index=False)
+        if filepath is None:
+            return result
+        write_csv(result, filepath)
 
     def export_items(
         self,
@@ -2473,31 +4712,24 @@ class Database:
         remove_absent_text: bool,
     ):
         logging.info(f'Exporting items\' info to {filepath}')
-
-        def get(text_hash, alternative_hash=None, default_text=unknown_text):
-            if text_hash not in self.text_map and alternative_hash is not None:
-                text_hash = alternative_hash
-            if text_hash not in self.text_map:
-                return default_text
-            text = self.text_map[text_hash]
-            # Remove XML tags.
-            for pattern, target in XML_PATTERNS:
-                text = pattern.sub(target, text)
-            # Replace quotes to a more usual version.
-            if replace_quotes and lang in QUOTE_MAPPINGS:
-                for quote, target in QUOTE_MAPPINGS[lang].items():
-                    text = text.replace(quote, target)
-            # Replace escaped newline characters.
-            if replace_newline:
-                text = text.replace('\\n', "\n")
-            return text
+        options = TextOptions(
+            lang=lang,
+            replace_quotes=replace_quotes,
+            replace_newline=replace_newline,
+        )
 
         result = [
             {
                 "id": item_id,
-                "name": get(item.name_text_map_hash, default_text=unknown_name),
-                "description": get(item.desc1_text_map_hash,
-                                   item.desc2_text_map_hash),
+                "name": self.lookup_text(
+                    item.name_text_map_hash, options, unknown_name
+                ),
+                "description": self.lookup_text(
+                    item.desc1_text_map_hash
+                    if item.desc1_text_map_hash in self.text_map
+                    else item.desc2_text_map_hash,
+                    options, unknown_text
+                ),
             }
             for item_id, item in self.item_dict.items()
             # Remove items with absent texts.
@@ -2536,22 +4768,12 @@ class Database:
         remove_absent_text: bool,
     ):
         logging.info(f'Exporting weapons\' info to {filepath}')
-
-        def post_process(text):
-            # Remove XML tags.
-            for pattern, target in XML_PATTERNS:
-                text = pattern.sub(target, text)
-            # Replace quotes to a more usual version.
-            if replace_quotes and lang in QUOTE_MAPPINGS:
-                for quote, target in QUOTE_MAPPINGS[lang].items():
-                    text = text.replace(quote, target)
-            # Replace escaped newline characters.
-            if replace_newline:
-                text = text.replace('\\n', "\n")
-            # Remove leading and trailing newline characters and trim
-            # consecutive empty lines.
-            text = re.sub(r'\n{2,}', '\n\n', text.strip())
-            return text
+        options = TextOptions(
+            lang=lang,
+            replace_quotes=replace_quotes,
+            replace_newline=replace_newline,
+            trim=True,
+        )
 
         result = [
             {
@@ -2559,17 +4781,19 @@ class Database:
                 "name":
                     unknown_name
                     if weapon.name_text_map_hash not in self.text_map
-                    else post_process(self.text_map[weapon.name_text_map_hash]),
+                    else self.get_text(weapon.name_text_map_hash, options),
                 "type": weapon.type,
                 "rank_level": weapon.rank_level,
                 "description":
                     unknown_text
                     if weapon.desc_text_map_hash not in self.text_map
-                    else post_process(self.text_map[weapon.name_text_map_hash]),
+                    else self.get_text(weapon.name_text_map_hash, options),
                 "story":
                     unknown_text
                     if f'Weapon{weapon.id}' not in self.readable_dict
-                    else post_process(self.readable_dict[f'Weapon{weapon.id}']),
+                    else self.normalize_text(
+                        self.readable_dict[f'Weapon{weapon.id}'], options
+                    ),
             }
             for weapon in self.weapon_dict.values()
             # Remove weapons with absent texts.
@@ -2606,29 +4830,15 @@ class Database:
         replace_newline: bool,
     ):
         logging.info(f'Exporting reliquaries\' info to {filepath}')
-
-        def post_process(text):
-            # Remove XML tags.
-            for pattern, target in XML_PATTERNS:
-                text = pattern.sub(target, text)
-            # Replace quotes to a more usual version.
-            if replace_quotes and lang in QUOTE_MAPPINGS:
-                for quote, target in QUOTE_MAPPINGS[lang].items():
-                    text = text.replace(quote, target)
-            # Replace escaped newline characters.
-            if replace_newline:
-                text = text.replace('\\n', "\n")
-            # Remove leading and trailing newline characters and trim
-            # consecutive empty lines.
-            text = re.sub(r'\n{2,}', '\n\n', text.strip())
-            return text
+        options = TextOptions(
+            lang=lang,
+            replace_quotes=replace_quotes,
+            replace_newline=replace_newline,
+            trim=True,
+        )
 
         def get(text_hash, default=unknown_text):
-            if text_hash is None:
-                return None
-            elif text_hash in self.text_map:
-                return post_process(self.text_map[text_hash])
-            return default
+            return self.lookup_text(text_hash, options, default)
 
         result = [{
             "id": reliquary_set.id,
@@ -2640,8 +4850,8 @@ class Database:
                 "" if reliquary_set.name_text_map_hashs[0] is None else
                 unknown_text
                 if f'Relic{reliquary_set.id}_1' not in self.readable_dict
-                else post_process(
-                    self.readable_dict[f'Relic{reliquary_set.id}_1']
+                else self.normalize_text(
+                    self.readable_dict[f'Relic{reliquary_set.id}_1'], options
                 ),
             "name_2": get(reliquary_set.name_text_map_hashs[1], unknown_name),
             "description_2": get(reliquary_set.desc_text_map_hashs[1],
@@ -2650,8 +4860,8 @@ class Database:
                 "" if reliquary_set.name_text_map_hashs[1] is None else
                 unknown_text
                 if f'Relic{reliquary_set.id}_2' not in self.readable_dict
-                else post_process(
-                    self.readable_dict[f'Relic{reliquary_set.id}_2']
+                else self.normalize_text(
+                    self.readable_dict[f'Relic{reliquary_set.id}_2'], options
                 ),
             "name_3": get(reliquary_set.name_text_map_hashs[2], unknown_name),
             "description_3": get(reliquary_set.desc_text_map_hashs[2],
@@ -2660,8 +4870,8 @@ class Database:
                 "" if reliquary_set.name_text_map_hashs[2] is None else
                 unknown_text
                 if f'Relic{reliquary_set.id}_3' not in self.readable_dict
-                else post_process(
-                    self.readable_dict[f'Relic{reliquary_set.id}_3']
+                else self.normalize_text(
+                    self.readable_dict[f'Relic{reliquary_set.id}_3'], options
                 ),
             "name_4": get(reliquary_set.name_text_map_hashs[3], unknown_name),
             "description_4": get(reliquary_set.desc_text_map_hashs[3],
@@ -2670,8 +4880,8 @@ class Database:
                 "" if reliquary_set.name_text_map_hashs[3] is None else
                 unknown_text
                 if f'Relic{reliquary_set.id}_4' not in self.readable_dict
-                else post_process(
-                    self.readable_dict[f'Relic{reliquary_set.id}_4']
+                else self.normalize_text(
+                    self.readable_dict[f'Relic{reliquary_set.id}_4'], options
                 ),
             "name_5": get(reliquary_set.name_text_map_hashs[4], unknown_name),
             "description_5": get(reliquary_set.desc_text_map_hashs[4],
@@ -2680,8 +4890,8 @@ class Database:
                 "" if reliquary_set.name_text_map_hashs[4] is None else
                 unknown_text
                 if f'Relic{reliquary_set.id}_5' not in self.readable_dict
-                else post_process(
-                    self.readable_dict[f'Relic{reliquary_set.id}_5']
+                else self.normalize_text(
+                    self.readable_dict[f'Relic{reliquary_set.id}_5'], options
                 ),
         } for reliquary_set in self.reliquary_set_dict.values()]
         # Filter out unreleased reliquaries.
@@ -2708,256 +4918,362 @@ class Database:
         df.to_csv(filepath, index=False)
 
 
-def main(args):
-    global database
+def write_json(result, filepath, compact: bool = False):
+    """
+    Write an exported result as a JSON file, without indentation if `compact`.
+    """
+    logging.info(f'Writing {filepath}')
+    with open(filepath, "w", encoding="utf-8") as f:
+        if compact:
+            json.dump(result, f, ensure_ascii=False, separators=(",", ":"))
+        else:
+            json.dump(result, f, indent=2, ensure_ascii=False)
 
-    # Directories containing all the talks and dialogs.
-    talk_dir_list = [
-        os.path.join("BinOutput", "Talk", "ActivityGroup"),
-        os.path.join("BinOutput", "Talk", "BlossomGroup"),
-        os.path.join("BinOutput", "Talk", "GadgetGroup"),
-        os.path.join("BinOutput", "Talk", "NpcGroup"),
-    ]
-    dialog_dir_list = [
-        os.path.join("BinOutput", "Talk", "Activity"),
-        os.path.join("BinOutput", "Talk", "Blossom"),
-        os.path.join("BinOutput", "Talk", "Coop"),
-        os.path.join("BinOutput", "Talk", "FreeGroup"),
-        os.path.join("BinOutput", "Talk", "Gadget"),
-        os.path.join("BinOutput", "Talk", "Npc"),
-        os.path.join("BinOutput", "Talk", "NpcOther"),
-        os.path.join("BinOutput", "Talk"),
-    ]
-    blacklist = [
-        os.path.join("BinOutput", "Talk", "NpcGroup", "22.json"),
-        os.path.join("BinOutput", "Talk", "NpcGroup", "23.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "1702.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "1712.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "1713.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "2231.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "2232.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "3208.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "4000.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "4001.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "4002.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "4003.json"),
-        os.path.join("BinOutput", "Talk", "NpcOther", "4004.json"),
-        os.path.join("BinOutput", "Talk", "4c370aaa.json"),
-        os.path.join("BinOutput", "Talk", "66c42405.json"),
-    ]
-    quest_talk_dir = os.path.join(args.data_dir, "BinOutput", "Talk", "Quest")
-    quest_dir = os.path.join(args.data_dir, "BinOutput", "Quest")
-
-    # Collect talk files.
-    talk_file_list = [
-        os.path.join(args.data_dir, "ExcelBinOutput",
-                     "TalkExcelConfigData.json"),
-        os.path.join(args.data_dir, "ExcelBinOutput",
-                     "RqTalkExcelConfigData.json"),
-    ]
-    for d in talk_dir_list:
-        for f in os.listdir(os.path.join(args.data_dir, d)):
-            if not f.endswith(".json"):
-                continue
-            if os.path.join(d, f) in blacklist:
-                continue
-            talk_file_list.append(os.path.join(args.data_dir, d, f))
 
-    # Collect dialog files.
-    dialog_file_list = [
-        os.path.join(args.data_dir, "ExcelBinOutput",
-                     "DialogExcelConfigData.json")
+def write_csv(result: List[dict], filepath):
+    """
+    Write an exported result, i.e. a list of rows, as a csv file.
+    """
+    logging.info(f'Writing {filepath}')
+    df = pd.DataFrame.from_dict(result)
+    df.to_csv(filepath, index=False)
+
+
+def compact_traces(
+    traces: List[List[Tuple[int, dict]]], with_edges: bool
+) -> dict:
+    """
+    Convert the traces of a source into the compact form of dialog.json.
+    Each trace is a list of (dialog id, line) pairs. The lines are stored once
+    in a table and each trace becomes a list of indices into the table. The
+    lines of the same dialog are shared among the traces, except the dialog id
+    -1, which is used by the lines not coming from dialogs.
+    If `with_edges`, the pairs of consecutive lines in the traces are also
+    given, without duplicates, in the order of their first appearance.
+    """
+    lines = []
+    index_of_dialog = {}
+    compacted = []
+    edges = {}  # Used as an ordered set.
+    for trace in traces:
+        indices = []
+        for dialog_id, line in trace:
+            index = index_of_dialog.get(dialog_id)
+            if index is None:
+                index = len(lines)
+                lines.append({"dialog_id": dialog_id, **line})
+                if dialog_id != -1:
+                    index_of_dialog[dialog_id] = index
+            indices.append(index)
+        compacted.append(indices)
+        if with_edges:
+            edges.update(dict.fromkeys(zip(indices, indices[1:])))
+    result = {"lines": lines, "traces": compacted}
+    if with_edges:
+        result["edges"] = [list(edge) for edge in edges]
+    return result
+
+
+def expand_source(source_item: dict) -> dict:
+    """
+    Expand a source of dialog.json in the compact form back to the full form,
+    where each trace is a list of {"role", "content"} objects. Sources already
+    in the full form are returned as is.
+    """
+    if "lines" not in source_item:
+        return source_item
+    expanded = {
+        key: value for key, value in source_item.items()
+        if key not in ("lines", "edges")
+    }
+    lines = source_item["lines"]
+    expanded["traces"] = [
+        [
+            {"role": lines[i]["role"], "content": lines[i]["content"]}
+            for i in trace
+        ]
+        for trace in source_item["traces"]
     ]
-    for d in dialog_dir_list:
-        for f in os.listdir(os.path.join(args.data_dir, d)):
-            if not f.endswith(".json"):
-                continue
-            if os.path.join(d, f) in blacklist:
-                continue
-            dialog_file_list.append(os.path.join(args.data_dir, d, f))
+    return expanded
 
-    # Collect files containing talks in quests.
-    quest_talk_file_list = []
-    for f in os.listdir(quest_talk_dir):
-        if os.path.join("BinOutput", "Talk", "Quest", f) in blacklist:
-            continue
-        quest_talk_file_list.append(os.path.join(quest_talk_dir, f))
 
-    # Collect quest files.
-    quest_file_list = []
-    for f in os.listdir(quest_dir):
-        if os.path.join("BinOutput", "Quest", f) in blacklist:
-            continue
-        quest_file_list.append(os.path.join(quest_dir, f))
+def load_dialogs(filepath) -> Dict[str, dict]:
+    """
+    Load a dialog.json exported in either form, with all the sources in the
+    full form.
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        result = json.load(f)
+    return {
+        source_name: expand_source(source_item)
+        for source_name, source_item in result.items()
+    }
 
-    database = Database()
 
-    # Parse talk files.
-    logging.info("Parsing talk files.")
-    for path in tqdm.tqdm(talk_file_list):
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if isinstance(data, dict):
-            if "talks" in data:
-                data = data["talks"]
-            # Then deal with some special cases where the field names are
-            # obfusecated.
-            elif (
-                # I'm not sure what the field "JEMDGACPOPC" is, but it seems
-                # like a kind of unique identifier.
-                "JEMDGACPOPC" in data
-            ):
-                data = data["DMIMNILOLKP"]  # "DMIMNILOLKP" is "talks".
-            elif (
-                # "JDOFKFPHIDC" is "npcId".
-                "JDOFKFPHIDC" in data
-            ):
-                data = data["PCNNNPLAEAI"]  # "PCNNNPLAEAI" is "talks"
-            else:  # a single talk item
-                data = [data]
-        for item in data:
-            database.add_talk(item, path)
-
-    # Parse dialog files.
-    logging.info("Parsing dialog files.")
-    for path in tqdm.tqdm(dialog_file_list):
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        # Special blacklist cases.
-        if isinstance(data, dict) and \
-                len(data) == 2 and \
-                set(data.keys()) == set(["talkId", "type"]):
+# The exported entities, and the entities each of them needs to be loaded.
+ENTITY_DEPENDENCIES = {
+    # The voice texts of the avatars are exported into dialog.json.
+    "dialogs": ["dialogs", "avatars"],
+    "quests": ["quests"],
+    "avatars": ["avatars"],
+    "items": ["items"],
+    "weapons": ["weapons"],
+    "reliquaries": ["reliquaries"],
+}
+
+
+# The output file of each entity.
+ENTITY_FILES = {
+    "dialogs": "dialog.json",
+    "quests": "quest.json",
+    "avatars": "avatar.csv",
+    "items": "item.csv",
+    "weapons": "weapon.csv",
+    "reliquaries": "reliquary.csv",
+}
+
+
+def resolve_entities(only: Optional[str]) -> Tuple[Set[str], Set[str]]:
+    """
+    Returns the entities to be exported and the entities to be loaded, given
+    the comma separated list of the --only argument.
+    """
+    if only is None:
+        exported = set(ENTITY_DEPENDENCIES.keys())
+    else:
+        exported = set(name.strip() for name in only.split(",")) - {""}
+        unknown = exported - ENTITY_DEPENDENCIES.keys()
+        if len(unknown) > 0:
+            logging.error(f'Unknown entities {sorted(unknown)} in --only. '
+                          f'Valid ones are {list(ENTITY_DEPENDENCIES.keys())}.')
+            exit(1)
+    loaded = set()
+    for name in exported:
+        loaded.update(ENTITY_DEPENDENCIES[name])
+    return exported, loaded
+
+
+# The options that can be given per variant, see `load_variants`.
+VARIANT_OPTIONS = [
+    "traveller_sex", "traveller_name", "mate_name", "wanderer_name",
+]
+# The entities depending on the variants.
+VARIANT_ENTITIES = {"dialogs", "quests", "avatars"}
+# Stand-ins of the names when exporting the variants together, which are
+# replaced by the names of each variant afterwards. Texts never contain "\0".
+NAME_MARKERS = {
+    "traveller_name": "\0traveller_name\0",
+    "mate_name": "\0mate_name\0",
+    "wanderer_name": "\0wanderer_name\0",
+}
+NAME_MARKER_PATTERN = re.compile(
+    "\0(" + "|".join(NAME_MARKERS.keys()) + ")\0"
+)
+
+
+def load_variants(filepath, args) -> List[dict]:
+    """
+    Load the variants file, which is a JSON list of objects. Each object has a
+    unique "name", i.e. the subdirectory of the outputs, and optionally any
+    of the VARIANT_OPTIONS. The absent options take the values of the command
+    line arguments.
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        items = json.load(f)
+    if not isinstance(items, list) or len(items) == 0:
+        logging.error(f'{filepath} must contain a non-empty list of variants.')
+        exit(1)
+    variants = []
+    for item in items:
+        if (
+            not isinstance(item, dict) or
+            not isinstance(item.get("name"), str) or
+            item["name"] in ["", ".", ".."] or
+            "/" in item["name"] or "\\" in item["name"]
+        ):
+            logging.error(f'Each variant in {filepath} must be an object with '
+                          f'a name of a valid directory, got {item}.')
+            exit(1)
+        unknown = item.keys() - set(VARIANT_OPTIONS) - {"name"}
+        if len(unknown) > 0:
+            logging.error(f'Unknown options {sorted(unknown)} in variant '
+                          f'{item["name"]}. Valid ones are {VARIANT_OPTIONS}.')
+            exit(1)
+        if item.get("traveller_sex", "male") not in ["male", "female"]:
+            logging.error(f'Invalid traveller_sex {item["traveller_sex"]} in '
+                          f'variant {item["name"]}.')
+            exit(1)
+        for option in VARIANT_OPTIONS:
+            if option in item and not isinstance(item[option], str):
+                logging.error(f'{option} in variant {item["name"]} must be a '
+                              f'string, got {item[option]!r}.')
+                exit(1)
+        if any(variant["name"] == item["name"] for variant in variants):
+            logging.error(f'Duplicated variant {item["name"]} in {filepath}.')
+            exit(1)
+        variant = {"name": item["name"]}
+        for option in VARIANT_OPTIONS:
+            variant[option] = item.get(option, getattr(args, option))
+        variants.append(variant)
+    return variants
+
+
+def can_patch_name(name: str, lang: str) -> bool:
+    """
+    Whether the texts exported with `name` are the same as the texts exported
+    with its marker and then patched with `name`. It is not the case if the
+    post-processing after inserting the names treats the name differently
+    from the marker, e.g. when the name contains quotes, colons, escaped
+    newlines, placeholders or unreleased tags.
+    """
+    if len(name) == 0 or name != name.strip():
+        return False
+    if any(
+        char in name
+        for char in ["\0", "\\", ":", "：", "{", "}"] +
+        list(QUOTE_MAPPINGS.get(lang, {}).keys())
+    ):
+        return False
+    return not any(tag in name.lower() for tag in UNRELEASED_TAGS.get(lang, []))
+
+
+def find_marked_spans(result) -> List[Tuple[object, object, List[str]]]:
+    """
+    Find the texts containing NAME_MARKERS in the nested dicts and lists of
+    exported results. Returns (container, key, parts) of each of them, where
+    `parts` alternates between the literal parts and the names of the markers,
+    i.e. the text split by NAME_MARKER_PATTERN.
+    """
+    spans = []
+    # The lines of the dialogs may be shared by several traces.
+    visited = set()
+    stack = [result]
+    while len(stack) > 0:
+        container = stack.pop()
+        if id(container) in visited:
             continue
-        if isinstance(data, dict):
-            if "talkId" in data:
-                talkId = data["talkId"]
-            # Then deal with some special cases where the field names are
-            # obfusecated.
-            elif "FEOACBMDCKJ" in data:
-                talkId = data["FEOACBMDCKJ"]
-                if "AAOAAFLLOJI" not in data and "dialogList" not in data:
-                    # Files without dialogList are useless.
-                    continue
-                data = data["AAOAAFLLOJI"]
-            elif "PBAEPDPNKEJ" in data:
-                talkId = data["PBAEPDPNKEJ"]
-                if "KJNKFMPAGAA" not in data and "dialogList" not in data:
-                    # Files without dialogList are useless.
-                    continue
-                data = data["KJNKFMPAGAA"]
-            else:
-                logging.info(f'Ignoring {path} since it seems not a dialog '
-                             'file.')
-                continue
-        else:
-            assert isinstance(data, list)
-            if (
-                len(data) > 0 and
-                "id" not in data[0] and
-                "GFLDJMJKIKE" not in data[0]
-            ):
-                logging.info(f'Ignoring {path} since it seems not a dialog '
-                             'file.')
-                continue
-            talkId = -1
-        if isinstance(data, dict):
-            if "dialogList" in data:
-                data = data["dialogList"]
-            else: # a single dialog item
-                data = [data]
-        for item in data:
-            database.add_dialog(item, talkId, path)
+        visited.add(id(container))
+        for key, value in (
+            container.items() if isinstance(container, dict) else
+            enumerate(container)
+        ):
+            if isinstance(value, str):
+                if "\0" in value:
+                    spans.append(
+                        (container, key, NAME_MARKER_PATTERN.split(value))
+                    )
+            elif isinstance(value, (dict, list)):
+                stack.append(value)
+    return spans
 
-    # Parse quest talk files (possibly containing talks and/or dialogs).
-    logging.info("Parsing quest talk files.")
-    for path in tqdm.tqdm(quest_talk_file_list):
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if "talks" in data:
-            for item in data["talks"]:
-                database.add_talk(item, path)
-        if "dialogList" in data:
-            for item in data["dialogList"]:
-                database.add_dialog(item, -1, path)
-
-    # Parse quest files.
-    logging.info("Parsing quest files.")
-    for path in tqdm.tqdm(quest_file_list):
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        database.add_quest(data, path)
-
-    # Parse chapter files.
-    logging.info("Parsing chapter files.")
-    with open(
-        os.path.join(
-            args.data_dir, "ExcelBinOutput", "ChapterExcelConfigData.json"
-        ), "r", encoding="utf-8"
-    ) as f:
-        data = json.load(f)
+
+def build_database(
+    database: "Database",
+    args,
+    manifest: Manifest,
+    entities: Set[str],
+):
+    """
+    Parse the input files and build the structure of the database, i.e. all
+    the stages before loading the texts. Only the `entities` are loaded.
+    """
+    # Talks, dialogs and quests are parsed and connected together.
+    need_sources = "dialogs" in entities or "quests" in entities
+    # Parse the files, in worker processes if required. The parsed records are
+    # always merged in the original file order.
+    with (
+        multiprocessing.Pool(
+            args.jobs,
+            initializer=set_json_backend,
+            initargs=(args.json_backend,),
+        ) if args.jobs > 1 and need_sources else
+        contextlib.nullcontext()
+    ) as pool:
+        for description, parse_file, file_list in [
+            ("talk files", parse_talk_file, manifest.talk_files),
+            ("dialog files", parse_dialog_file, manifest.dialog_files),
+            # Quest talk files possibly contain talks and/or dialogs.
+            ("quest talk files", parse_quest_talk_file,
+             manifest.quest_talk_files),
+            ("quest files", parse_quest_file, manifest.quest_files),
+        ] if need_sources else []:
+            logging.info(f'Parsing {description}.')
+            for parsed in tqdm.tqdm(
+                map_files(parse_file, file_list, pool), total=len(file_list)
+            ):
+                DECODE_RECORDS.extend(parsed.decode_records)
+                database.add_parsed_file(parsed)
+    if need_sources:
+        database.compact_records()
+
+    excel_dir = os.path.join(args.data_dir, "ExcelBinOutput")
+
+    if "quests" in entities:
+        # Parse chapter files.
+        logging.info("Parsing chapter files.")
+        data = load_json(
+            os.path.join(excel_dir, "ChapterExcelConfigData.json")
+        )
         for item in data:
             database.add_chapter(item)
 
-    # Parse avatar info.
-    logging.info("Parsing avatar files.")
-    with open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "AvatarExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_avatar_info, \
-    open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "FetterInfoExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_fetter_info, \
-    open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "FettersExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_fetters, \
-    open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "FetterStoryExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_fetter_story:
-        avatar_info = json.load(file_avatar_info)
-        fetter_info = json.load(file_fetter_info)
-        fetters = json.load(file_fetters)
-        fetter_story = json.load(file_fetter_story)
+    if "avatars" in entities:
+        # Parse avatar info.
+        logging.info("Parsing avatar files.")
+        avatar_info = load_json(
+            os.path.join(excel_dir, "AvatarExcelConfigData.json")
+        )
+        fetter_info = load_json(
+            os.path.join(excel_dir, "FetterInfoExcelConfigData.json")
+        )
+        fetters = load_json(
+            os.path.join(excel_dir, "FettersExcelConfigData.json")
+        )
+        fetter_story = load_json(
+            os.path.join(excel_dir, "FetterStoryExcelConfigData.json")
+        )
         database.collect_avatar_info(
             avatar_info, fetter_info, fetters, fetter_story
         )
 
-    # Parse item info.
-    logging.info("Parsing item info.")
-    with open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "MaterialExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_material_info, \
-    open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "MaterialCodexExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_material_codex_info:
-        material_info = json.load(file_material_info)
-        material_codex_info = json.load(file_material_codex_info)
+    if "items" in entities:
+        # Parse item info.
+        logging.info("Parsing item info.")
+        material_info = load_json(
+            os.path.join(excel_dir, "MaterialExcelConfigData.json")
+        )
+        material_codex_info = load_json(
+            os.path.join(excel_dir, "MaterialCodexExcelConfigData.json")
+        )
         database.collect_item_info(material_info, material_codex_info)
 
-    # Parse weapon info.
-    logging.info("Parsing weapon info.")
-    with open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "WeaponExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_weapon_info:
-        weapon_info = json.load(file_weapon_info)
+    if "weapons" in entities:
+        # Parse weapon info.
+        logging.info("Parsing weapon info.")
+        weapon_info = load_json(
+            os.path.join(excel_dir, "WeaponExcelConfigData.json")
+        )
         database.collect_weapon_info(weapon_info)
 
-    # Parse reliquary info.
-    logging.info("Parsing reliquary info.")
-    with open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "ReliquaryExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_reliquary_info, \
-    open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "ReliquarySetExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_reliquary_set_info, \
-    open(os.path.join(
-        args.data_dir, "ExcelBinOutput", "EquipAffixExcelConfigData.json"
-    ), "r", encoding="utf-8") as file_equip_affix_info:
-        reliquary_info = json.load(file_reliquary_info)
-        reliquary_set_info = json.load(file_reliquary_set_info)
-        equip_affix_info = json.load(file_equip_affix_info)
+    if "reliquaries" in entities:
+        # Parse reliquary info.
+        logging.info("Parsing reliquary info.")
+        reliquary_info = load_json(
+            os.path.join(excel_dir, "ReliquaryExcelConfigData.json")
+        )
+        reliquary_set_info = load_json(
+            os.path.join(excel_dir, "ReliquarySetExcelConfigData.json")
+        )
+        equip_affix_info = load_json(
+            os.path.join(excel_dir, "EquipAffixExcelConfigData.json")
+        )
         database.collect_reliquary_info(
             reliquary_info, reliquary_set_info, equip_affix_info
         )
 
+    if not need_sources:
+        return
+
     # Collect prev_talks for each talk.
     database.collect_prev_talks()
 
@@ -2972,98 +5288,350 @@ def main(args):
 
     # Build the sources, while find a minimum number of traces for each source
     # that cover all the dialogs.
-    database.build_sources()
+    database.build_sources(args.jobs)
 
     # Build the connections among the sources.
     database.connect_sources()
 
+
+def export_texts(
+    database: "Database",
+    args,
+    lang: str,
+    output_dir: str,
+    exported: Set[str],
+    variants: Optional[List[dict]] = None,
+):
+    """
+    Load the texts of `lang` into the database, which is built already, and
+    export the `exported` entities into `output_dir`, or each of the
+    `variants` into its subdirectory if given.
+    """
     # Load texts.
     database.load_text_map(
-        os.path.join(args.data_dir, "TextMap", f'TextMap{args.lang}.json')
+        os.path.join(args.data_dir, "TextMap", f'TextMap{lang}.json'),
+        filter_hashes=args.filter_text_map == "true",
+        cache_dir=args.cache_dir if args.text_map_cache == "true" else None,
     )
-    database.load_npc_name(
-        os.path.join(args.data_dir, "ExcelBinOutput", "NpcExcelConfigData.json")
+    # Only the weapon and reliquary stories are used among the readables.
+    readable_prefixes = tuple(
+        prefix for name, prefix in [("weapons", "Weapon"),
+                                    ("reliquaries", "Relic")]
+        if name in exported
     )
-    database.load_readable(os.path.join(args.data_dir, "Readable", args.lang))
-
-    mate_name = args.mate_name
-    if mate_name is None:
-        mate_name = (
-            database.npc_name_map[NPC_ID_AETHER]
-            if args.traveller_sex == "female" else
-            database.npc_name_map[NPC_ID_LUMINE]
+    if len(readable_prefixes) > 0:
+        database.load_readable(
+            os.path.join(args.data_dir, "Readable", lang),
+            readable_prefixes,
         )
 
-    # Export all the output files.
-    os.makedirs(args.output_dir, exist_ok=True)
-            
-    database.export_dialogs(
-        filepath=os.path.join(args.output_dir, "dialog.json"),
-        lang=args.lang,
-        traveller_sex=args.traveller_sex,
-        traveller_name=args.traveller_name,
-        mate_name=mate_name,
-        wanderer_name=args.wanderer_name,
-        narrator_name=args.narrator_name,
-        unknown_name=args.unknown_name,
-        unknown_text=args.unknown_text,
-        replace_quotes=args.replace_quotes == "true",
-        replace_newline=args.replace_newline == "true",
-        remove_broken_trace=args.remove_broken_trace == "true",
-        remove_absent_text=args.remove_absent_text == "true",
-    )
+    if variants is None:
+        export_variant(
+            database, args, lang, output_dir, exported, {
+                option: getattr(args, option) for option in VARIANT_OPTIONS
+            }
+        )
+    else:
+        export_variants(database, args, lang, output_dir, exported, variants)
+    logging.info(f'Normalized texts of {lang}: '
+                 f'{database.text_cache.hits} cache hits, '
+                 f'{database.text_cache.misses} misses.')
 
-    database.export_quests(
-        filepath=os.path.join(args.output_dir, "quest.json"),
-        lang=args.lang,
-        traveller_sex=args.traveller_sex,
-        traveller_name=args.traveller_name,
-        wanderer_name=args.wanderer_name,
-        unknown_text=args.unknown_text,
-        replace_quotes=args.replace_quotes == "true",
-        replace_newline=args.replace_newline == "true",
-    )
 
-    database.export_avatars(
-        filepath=os.path.join(args.output_dir, "avatar.csv"),
-        lang=args.lang,
-        traveller_sex=args.traveller_sex,
-        traveller_name=args.traveller_name,
-        wanderer_name=args.wanderer_name,
-        unknown_name=args.unknown_name,
-        unknown_text=args.unknown_text,
-        replace_quotes=args.replace_quotes == "true",
-        replace_newline=args.replace_newline == "true",
+def variant_mate_name(database: "Database", variant: dict) -> str:
+    """
+    The mate's name of a variant, which defaults to the name of the
+    traveller's sibling in the loaded language.
+    """
+    if variant["mate_name"] is not None:
+        return variant["mate_name"]
+    return (
+        database.npc_name_map[NPC_ID_AETHER]
+        if variant["traveller_sex"] == "female" else
+        database.npc_name_map[NPC_ID_LUMINE]
     )
 
-    database.export_items(
-        filepath=os.path.join(args.output_dir, "item.csv"),
-        lang=args.lang,
-        unknown_name=args.unknown_name,
-        unknown_text=args.unknown_text,
-        replace_quotes=args.replace_quotes == "true",
-        replace_newline=args.replace_newline == "true",
-        remove_absent_text=args.remove_absent_text == "true",
-    )
 
-    database.export_weapons(
-        filepath=os.path.join(args.output_dir, "weapon.csv"),
-        lang=args.lang,
-        unknown_name=args.unknown_name,
-        unknown_text=args.unknown_text,
-        replace_quotes=args.replace_quotes == "true",
-        replace_newline=args.replace_newline == "true",
-        remove_absent_text=args.remove_absent_text == "true",
+def export_variant(
+    database: "Database",
+    args,
+    lang: str,
+    output_dir: Optional[str],
+    exported: Set[str],
+    variant: dict,
+) -> dict:
+    """
+    Export the `exported` entities into `output_dir`, with the options of
+    `variant`, i.e. the VARIANT_OPTIONS. If `output_dir` is None, the dialogs,
+    quests and avatars are returned instead of being written.
+    """
+    def path(entity):
+        if output_dir is None:
+            return None
+        return os.path.join(output_dir, ENTITY_FILES[entity])
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    if "dialogs" in exported:
+        results["dialogs"] = database.export_dialogs(
+            filepath=path("dialogs"),
+            lang=lang,
+            traveller_sex=variant["traveller_sex"],
+            traveller_name=variant["traveller_name"],
+            mate_name=variant_mate_name(database, variant),
+            wanderer_name=variant["wanderer_name"],
+            narrator_name=args.narrator_name,
+            unknown_name=args.unknown_name,
+            unknown_text=args.unknown_text,
+            replace_quotes=args.replace_quotes == "true",
+            replace_newline=args.replace_newline == "true",
+            remove_broken_trace=args.remove_broken_trace == "true",
+            remove_absent_text=args.remove_absent_text == "true",
+            compact=args.dialog_format == "compact",
+            compact_edges=args.dialog_edges == "true",
+        )
+
+    if "quests" in exported:
+        results["quests"] = database.export_quests(
+            filepath=path("quests"),
+            lang=lang,
+            traveller_sex=variant["traveller_sex"],
+            traveller_name=variant["traveller_name"],
+            wanderer_name=variant["wanderer_name"],
+            unknown_text=args.unknown_text,
+            replace_quotes=args.replace_quotes == "true",
+            replace_newline=args.replace_newline == "true",
+        )
+
+    if "avatars" in exported:
+        results["avatars"] = database.export_avatars(
+            filepath=path("avatars"),
+            lang=lang,
+            traveller_sex=variant["traveller_sex"],
+            traveller_name=variant["traveller_name"],
+            wanderer_name=variant["wanderer_name"],
+            unknown_name=args.unknown_name,
+            unknown_text=args.unknown_text,
+            replace_quotes=args.replace_quotes == "true",
+            replace_newline=args.replace_newline == "true",
+        )
+
+    if "items" in exported:
+        database.export_items(
+            filepath=path("items"),
+            lang=lang,
+            unknown_name=args.unknown_name,
+            unknown_text=args.unknown_text,
+            replace_quotes=args.replace_quotes == "true",
+            replace_newline=args.replace_newline == "true",
+            remove_absent_text=args.remove_absent_text == "true",
+        )
+
+    if "weapons" in exported:
+        database.export_weapons(
+            filepath=path("weapons"),
+            lang=lang,
+            unknown_name=args.unknown_name,
+            unknown_text=args.unknown_text,
+            replace_quotes=args.replace_quotes == "true",
+            replace_newline=args.replace_newline == "true",
+            remove_absent_text=args.remove_absent_text == "true",
+        )
+
+    if "reliquaries" in exported:
+        database.export_reliquaries(
+            filepath=path("reliquaries"),
+            lang=lang,
+            unknown_name=args.unknown_name,
+            unknown_text=args.unknown_text,
+            replace_quotes=args.replace_quotes == "true",
+            replace_newline=args.replace_newline == "true",
+        )
+    return results
+
+
+def export_variants(
+    database: "Database",
+    args,
+    lang: str,
+    output_dir: str,
+    exported: Set[str],
+    variants: List[dict],
+):
+    """
+    Export each of the variants into output_dir/<NAME>/.
+    Only the dialogs, quests and avatars depend on the variants. They are
+    exported once for each traveller's sex, with the names replaced by
+    NAME_MARKERS, and the names of each variant are patched into the texts
+    containing the markers. The variants whose names can not be patched this
+    way are exported separately.
+    """
+    # The other entities are exported once and copied.
+    shared = exported - VARIANT_ENTITIES
+    first_dir = os.path.join(output_dir, variants[0]["name"])
+    export_variant(database, args, lang, first_dir, shared, variants[0])
+    for variant in variants[1:]:
+        variant_dir = os.path.join(output_dir, variant["name"])
+        os.makedirs(variant_dir, exist_ok=True)
+        for entity in shared:
+            shutil.copyfile(os.path.join(first_dir, ENTITY_FILES[entity]),
+                            os.path.join(variant_dir, ENTITY_FILES[entity]))
+
+    entities = exported & VARIANT_ENTITIES
+    if len(entities) == 0:
+        return
+    for traveller_sex in dict.fromkeys(
+        variant["traveller_sex"] for variant in variants
+    ):
+        patchable = []
+        for variant in variants:
+            if variant["traveller_sex"] != traveller_sex:
+                continue
+            names = {
+                "traveller_name": variant["traveller_name"],
+                "wanderer_name": variant["wanderer_name"],
+            }
+            # The mate's name is only used in the dialogs.
+            if "dialogs" in entities:
+                names["mate_name"] = variant_mate_name(database, variant)
+            if all(can_patch_name(name, lang) for name in names.values()):
+                patchable.append((variant, names))
+            else:
+                logging.info(f'Exporting variant {variant["name"]} '
+                             'separately because of the characters in its '
+                             'names.')
+                export_variant(
+                    database, args, lang,
+                    os.path.join(output_dir, variant["name"]), entities,
+                    variant,
+                )
+        if len(patchable) == 0:
+            continue
+        logging.info(f'Exporting {len(patchable)} variants with '
+                     f'traveller_sex={traveller_sex}.')
+        results = export_variant(
+            database, args, lang, None, entities,
+            dict(NAME_MARKERS, traveller_sex=traveller_sex),
+        )
+        spans = find_marked_spans(results)
+        logging.info(f'Found {len(spans)} texts containing names.')
+        for variant, names in patchable:
+            for container, key, parts in spans:
+                container[key] = "".join([
+                    names[part] if i % 2 == 1 else part
+                    for i, part in enumerate(parts)
+                ])
+            variant_dir = os.path.join(output_dir, variant["name"])
+            os.makedirs(variant_dir, exist_ok=True)
+            for entity, result in results.items():
+                filepath = os.path.join(variant_dir, ENTITY_FILES[entity])
+                if entity == "avatars":
+                    write_csv(result, filepath)
+                else:
+                    write_json(
+                        result, filepath,
+                        entity == "dialogs" and args.dialog_format == "compact"
+                    )
+
+
+def export_language(task):
+    """
+    Export the texts of a language in a worker process, which is forked after
+    the global database is built.
+    Returns the decoding records of the worker.
+    """
+    lang, output_dir, args, exported, variants = task
+    # The records of the parent are inherited by the fork.
+    DECODE_RECORDS.clear()
+    export_texts(database.fork(), args, lang, output_dir, exported, variants)
+    return DECODE_RECORDS
+
+
+def main(args):
+    global database
+
+    # Collect the input files.
+    manifest = Manifest.scan(args.data_dir)
+    if args.manifest == "true":
+        manifest_path = os.path.join(args.output_dir, "manifest.json")
+        previous_manifest = Manifest.load(manifest_path)
+        if previous_manifest is not None:
+            logging.info(
+                f'{len(manifest.changed_files(previous_manifest))} input '
+                'files changed since the last run.'
+            )
+        manifest.save(manifest_path)
+
+    set_json_backend(args.json_backend)
+    exported, loaded = resolve_entities(args.only)
+    variants = (
+        load_variants(args.variants, args) if args.variants is not None else
+        None
     )
 
-    database.export_reliquaries(
-        filepath=os.path.join(args.output_dir, "reliquary.csv"),
-        lang=args.lang,
-        unknown_name=args.unknown_name,
-        unknown_text=args.unknown_text,
-        replace_quotes=args.replace_quotes == "true",
-        replace_newline=args.replace_newline == "true",
+    # The structure of the database only depends on these files and the
+    # options below. Reuse the snapshot if none of them changed.
+    fingerprint = fingerprint_inputs(
+        manifest.entries(),
+        options=[args.remove_quest_cycles, sorted(loaded)],
+    )
+    # Different data directories get different snapshots.
+    path_digest = hashlib.blake2b(
+        os.path.abspath(args.data_dir).encode("utf-8"), digest_size=4
+    ).hexdigest()
+    snapshot_path = os.path.join(
+        args.cache_dir, f'database.{path_digest}.snapshot'
     )
+    database = Database()
+    if (
+        args.snapshot == "true" and
+        database.load_snapshot(snapshot_path, fingerprint)
+    ):
+        logging.info(f'Loaded the database snapshot from {snapshot_path}')
+    else:
+        build_database(database, args, manifest, loaded)
+        if args.snapshot == "true":
+            logging.info(f'Saving the database snapshot to {snapshot_path}')
+            database.save_snapshot(snapshot_path, fingerprint)
+
+    # The names of the NPCs are resolved from the same hashes in every
+    # language.
+    if "dialogs" in exported:
+        database.load_npc_name(os.path.join(
+            args.data_dir, "ExcelBinOutput", "NpcExcelConfigData.json"
+        ))
+
+    # Export the texts of each language. With multiple languages, each of them
+    # is exported into its own subdirectory.
+    if len(args.lang) == 1:
+        tasks = [(args.lang[0], args.output_dir)]
+    else:
+        tasks = [
+            (lang, os.path.join(args.output_dir, lang)) for lang in args.lang
+        ]
+    if (
+        args.lang_jobs > 1 and len(tasks) > 1 and
+        "fork" in multiprocessing.get_all_start_methods()
+    ):
+        # The workers are forked after the database is built, so they share
+        # its structure copy-on-write. Each worker exports one language and
+        # exits, which releases its texts.
+        with multiprocessing.get_context("fork").Pool(
+            min(args.lang_jobs, len(tasks)), maxtasksperchild=1
+        ) as pool:
+            for records in pool.imap(export_language, [
+                (lang, output_dir, args, exported, variants)
+                for lang, output_dir in tasks
+            ]):
+                DECODE_RECORDS.extend(records)
+    else:
+        for lang, output_dir in tasks:
+            export_texts(
+                database.fork(), args, lang, output_dir, exported, variants
+            )
+    report_decode_records(args.decode_report)
 
 
 if __name__ == "__main__":
@@ -3079,11 +5647,19 @@ if __name__ == "__main__":
         help="Whether remove some connections among the quests to avoid cycles."
         "Default to true.")
     parser.add_argument(
-        "--lang", type=str, default="CHS", choices=[
+        "--lang", type=str, nargs="+", default=["CHS"], choices=[
             "CHS", "CHT", "DE", "EN", "ES", "FR", "ID", "IT", "JP", "KR", "PT",
             "RU", "TH", "TR", "VI",
         ],
-        help="The language of the outputted text.")
+        help="The languages of the outputted text. If multiple languages are "
+        "given, the data are parsed and connected once, and the output files "
+        "of each language are written into output_dir/<LANG>/.")
+    parser.add_argument(
+        "--lang_jobs", type=int, default=1,
+        help="Number of languages exported at the same time, each in a worker "
+        "process forked after the data are connected. Every worker loads the "
+        "texts of its language, so this bounds the memory usage. Default to 1, "
+        "i.e. one after another in the main process.")
     parser.add_argument(
         "--traveller_sex", choices=["male", "female"], default="female",
         help="Traveller's sex. Determines some contents of the text.")
@@ -3098,6 +5674,14 @@ if __name__ == "__main__":
         "--wanderer_name", type=str, default="流浪者",
         help="Wanderer (Scaramouche)'s name to be filled into the placeholders "
         "in the text.'")
+    parser.add_argument(
+        "--variants", type=str, default=None,
+        help="If given, a JSON file listing the variants to export, e.g. "
+        "[{\"name\": \"aether\", \"traveller_sex\": \"male\", "
+        "\"traveller_name\": \"空\"}, {\"name\": \"lumine\"}]. Each variant "
+        "may set traveller_sex, traveller_name, mate_name and wanderer_name, "
+        "which default to the arguments above, and is exported into "
+        "output_dir/<NAME>/. The texts are resolved once for all the variants.")
     parser.add_argument(
         "--narrator_name", type=str, default="`旁白`",
         help="The narrator's name to be used with texts on blackscreen, etc.")
@@ -3124,6 +5708,57 @@ if __name__ == "__main__":
         "--remove_absent_text", choices=["true", "false"], default="true",
         help="Whether remove the absent text. Default to true. If false, they "
         "will be replaced by the value of the argument `unknown_text`.")
+    parser.add_argument(
+        "--dialog_format", choices=["full", "compact"], default="full",
+        help="The format of dialog.json. \"full\" gives the role and content "
+        "of every line in each trace. \"compact\" stores the lines of each "
+        "source once, and each trace as a list of indices into them. "
+        "`load_dialogs` reads both formats into the full one. Default to full.")
+    parser.add_argument(
+        "--dialog_edges", choices=["true", "false"], default="false",
+        help="Whether also store the pairs of consecutive lines in the traces "
+        "of each source, when dialog_format is compact. Default to false.")
+    parser.add_argument(
+        "--filter_text_map", choices=["true", "false"], default="true",
+        help="Whether only load the texts referenced by the exported data from "
+        "the TextMap, which greatly reduces the memory usage. Default to true.")
+    parser.add_argument(
+        "--text_map_cache", choices=["true", "false"], default="false",
+        help="Whether compile the TextMap into a binary cache under cache_dir, "
+        "which is reused until the TextMap changes. This overrides "
+        "filter_text_map. Default to false.")
+    parser.add_argument(
+        "--cache_dir", type=str, default="exp/cache",
+        help="Directory of the cached intermediate files.")
+    parser.add_argument(
+        "--only", type=str, default=None,
+        help="Comma separated list of the entities to export, among dialogs, "
+        "quests, avatars, items, weapons and reliquaries. Data not needed by "
+        "them are not loaded. Default to export all of them.")
+    parser.add_argument(
+        "--snapshot", choices=["true", "false"], default="false",
+        help="Whether save the parsed and connected data into cache_dir, and "
+        "reuse it in later runs if the input data and remove_quest_cycles are "
+        "unchanged. Default to false.")
+    parser.add_argument(
+        "--manifest", choices=["true", "false"], default="false",
+        help="Whether save the list of input files with their sizes and mtimes "
+        "into output_dir/manifest.json, and report the number of files changed "
+        "since the last run. Default to false.")
+    parser.add_argument(
+        "--jobs", type=int, default=1,
+        help="Number of worker processes used to parse the talk, dialog and "
+        "quest files, and to find the traces of the sources. Default to 1, "
+        "i.e. all in the main process.")
+    parser.add_argument(
+        "--json_backend", choices=["auto", "orjson", "json"], default="auto",
+        help="The JSON decoder used to read the input files. \"auto\" uses "
+        "orjson if it is installed, otherwise the standard library. Default to "
+        "auto.")
+    parser.add_argument(
+        "--decode_report", type=str, default=None,
+        help="If given, write the per-file JSON decoding time into this csv "
+        "file.")
     args = parser.parse_args()
     main(args)
 